@@ -0,0 +1,75 @@
+import threading
+from Utils.Metrics import REGISTRY
+
+class BlockIndex:
+    '''
+    本地块索引: 以块的内容hash为key，记录本地哪些文件的哪个位置有这块数据
+    数据仍然只存放在共享目录的文件里，索引只是指向它们，不额外占用磁盘。下载时目录中的每个块先在这里查找，
+    本地任何一个文件里已经有的块(改名、复制的文件，共享基础镜像的虚拟机镜像等)直接拷贝，不再从网络传输
+    分块的文件按块hash列表登记，不分块的文件整个作为一块，用文件hash登记
+    文件变化或删除时去掉它的登记，没有文件再引用的块随之从索引中回收
+    '''
+    def __init__(self, blockBytes):
+        self.blockBytes = blockBytes
+        self.files = {}             # 文件名 -> [(块hash, 偏移, 长度)]
+        self.blocks = {}            # 块hash -> {文件名: (偏移, 长度)}
+        self.refs = {}              # 块hash -> 在本地文件中出现的次数
+        self.duplicateBytes = 0     # 本地文件中内容重复的字节数(同一块每多出现一次算一次)
+        self.lock = threading.Lock()
+        REGISTRY.gauge('peer_block_index_blocks', 'distinct block hashes in the local block index',
+                       fn=lambda: len(self.blocks))
+        REGISTRY.gauge('peer_block_index_duplicate_bytes', 'local bytes whose block also exists in another place',
+                       fn=lambda: self.duplicateBytes)
+        self.collected = REGISTRY.counter('peer_block_index_collected_total',
+                                          'block hashes dropped because no local file references them any more')
+
+    #登记文件的当前信息(get_single_file_info的结果)，info为None表示文件已删除
+    def update(self, name, info):
+        with self.lock:
+            self._drop(name)
+            if info is None or info["size"] == 0:
+                return
+            if info.get("blocks"):
+                entries = []
+                for i, digest in enumerate(info["blocks"]):
+                    offset = i * self.blockBytes
+                    entries.append((digest, offset, min(self.blockBytes, info["size"] - offset)))
+            else:
+                entries = [(info["md5"], 0, info["size"])]
+            self.files[name] = entries
+            for digest, offset, length in entries:
+                self.blocks.setdefault(digest, {}).setdefault(name, (offset, length))
+                if self.refs.get(digest, 0) > 0:
+                    self.duplicateBytes += length
+                self.refs[digest] = self.refs.get(digest, 0) + 1
+
+    #本地有这块数据的一个位置 (文件名, 偏移)，没有返回None
+    def find(self, digest, length):
+        with self.lock:
+            for name, (offset, size) in self.blocks.get(digest, {}).items():
+                if size == length:
+                    return name, offset
+            return None
+
+    #只保留names中的文件，深度扫描后清理漏掉删除事件的文件
+    def retain(self, names):
+        with self.lock:
+            for name in list(self.files):
+                if name not in names:
+                    self._drop(name)
+
+    def stats(self):
+        with self.lock:
+            return {'files': len(self.files), 'blocks': len(self.blocks), 'duplicateMB': self.duplicateBytes / 1048576}
+
+    #由调用方持锁。去掉文件的登记，回收不再被引用的块
+    def _drop(self, name):
+        for digest, offset, length in self.files.pop(name, ()):
+            self.blocks[digest].pop(name, None)
+            self.refs[digest] -= 1
+            if self.refs[digest] > 0:
+                self.duplicateBytes -= length
+            else:
+                del self.refs[digest]
+                del self.blocks[digest]
+                self.collected.inc()
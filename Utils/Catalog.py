@@ -0,0 +1,283 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from Utils.CatalogCodec import CatalogCodec
+from Utils.Metrics import REGISTRY
+
+class Catalog:
+    '''
+    tracker上的全局文件目录
+    files:      文件名 -> 文件信息字典，只记录最新版本 {'mtime':,'md5':,'size':,'blockNum':,'blocks':[块md5],'root':,'holders':[[ip,port],...]}
+                holders是持有这个版本(mtime和md5都相同)的所有peer，下载方可以同时从它们那里取不同的块
+                partials是正在下载这个版本的peer [[ip,port,块位图],...]，它们已经收到的块也可以提供给别人
+    peerFiles:  (ip,port) -> {文件名: 该peer最近一次宣告的文件信息}，即tracker上每个peer文件列表的镜像
+    holders:    文件名 -> 宣告过该文件(任意版本)的peer集合，持有者变化时从这里重新计算最新版本和它的持有者
+    users:      (ip,port) -> 最后一次心跳时间，按心跳先后排序。TTL是固定的，
+                所以最前面的就是最早过期的，过期检查只需从头部弹出，不必遍历所有peer
+    version:    目录版本号，files每变化一次加一。changes按顺序记录最近的变化，用于增量回复
+    store:      可选的持久化(Utils/CatalogStore.py)。peer的宣告和过期在锁内记入它的日志，
+                files、holders都可以由peerFiles推出，但快照里也保存它们，恢复时不用重新计算
+    encoded:    当前版本下已经编码好的回复 (上次的版本号或None表示全量, 编码) -> 回复，目录版本变化时清空
+    '''
+    MAX_ENCODED = 1024
+    def __init__(self, ttl=180, maxChanges=100000, store=None):
+        self.ttl = ttl
+        self.store = store
+        self.files = {}
+        self.peerFiles = {}
+        self.holders = {}
+        self.users = OrderedDict()
+        #epoch区分tracker的不同生命周期，tracker重启后peer手上的旧版本号自然失效(从持久化恢复时沿用原来的epoch)
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.changes = deque(maxlen=maxChanges)     # (version, name)
+        self.encoded = {}
+        self.encodedVersion = None
+        self.encodedHits = REGISTRY.counter('tracker_reply_cache_hits_total', 'replies served from the encoded cache')
+        self.encodedMisses = REGISTRY.counter('tracker_reply_cache_misses_total', 'replies that had to be encoded')
+        self.lock = threading.Lock()
+
+    #是否认识这个peer。不认识的peer发来的增量宣告无法应用，需要它重新全量宣告
+    def isKnown(self, user):
+        with self.lock:
+            return user in self.users
+
+    #记录一次心跳
+    def keepalive(self, user, now=None):
+        if now is None:
+            now = time.perf_counter()
+        with self.lock:
+            self.users[user] = now
+            self.users.move_to_end(user)
+            if user not in self.peerFiles:
+                self.peerFiles[user] = {}
+
+    #处理peer发来的文件变化，代价只和本次变化的文件数有关
+    #full为True时peerFiles是该peer的完整文件列表，没出现在里面的旧文件视为已删除
+    #有持久化时返回日志记录的序号，回复peer之前应该等它落盘(store.wait)；纯心跳不记日志，返回None
+    def announce(self, user, peerFiles, removed=(), full=False):
+        Catalog.validate(peerFiles, removed)
+        with self.lock:
+            self._announce(user, peerFiles, removed, full)
+            if self.store is not None and (full or peerFiles or removed):
+                return self.store.append(('a', list(user), peerFiles, list(removed), full, self.version))
+            return None
+
+    #在改动任何状态之前检查整个宣告，有一项格式不对就整个拒绝(ValueError)
+    #否则坏的一项留在peerFiles和holders里，之后任何peer宣告这个文件时_refresh都会出错
+    def validate(peerFiles, removed):
+        if not isinstance(peerFiles, list) or not isinstance(removed, (list, tuple)):
+            raise ValueError('files and removed must be lists')
+        for name in removed:
+            if not isinstance(name, str):
+                raise ValueError('bad removed name %r' % (name,))
+        for peerFile in peerFiles:
+            if not isinstance(peerFile, dict) or not isinstance(peerFile.get('name'), str) \
+                    or not isinstance(peerFile.get('md5'), str):
+                raise ValueError('bad file entry %r' % (peerFile,))
+            for key in ('mtime', 'size', 'blockNum'):
+                value = peerFile.get(key)
+                if not isinstance(value, int) or isinstance(value, bool) or value < 0:
+                    raise ValueError('bad %s in file entry %r' % (key, peerFile['name']))
+            if peerFile.get('partial') and not isinstance(peerFile.get('have'), str):
+                raise ValueError('bad block bitmap in file entry %r' % peerFile['name'])
+
+    #由调用方持锁，宣告和日志重放共用
+    def _announce(self, user, peerFiles, removed, full):
+        listing = self.peerFiles.setdefault(user, {})
+        if full:
+            names = set(peerFile['name'] for peerFile in peerFiles)
+            removed = [name for name in listing if name not in names]
+        for name in removed:
+            if listing.pop(name, None) is not None:
+                self._dropHolder(user, name)
+
+        for peerFile in peerFiles:
+            name = peerFile['name']
+            listing[name] = peerFile
+            self.holders.setdefault(name, set()).add(user)
+            #新文件、更新的同名文件或者已有版本多了一个持有者
+            self._refresh(name)
+
+    #删除过期的peer，并把它从所持有文件的持有者中去掉，返回被删除的peer列表
+    def expire(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        expired = []
+        with self.lock:
+            while self.users:
+                user, lastSeen = next(iter(self.users.items()))
+                if now - lastSeen <= self.ttl:
+                    break
+                self.users.popitem(last=False)
+                self._dropUser(user)
+                if self.store is not None:
+                    self.store.append(('x', list(user), self.version))
+                expired.append(user)
+        return expired
+
+    #目录的完整状态，可以直接用marshal编码。由调用方持锁
+    #walSegment是快照之后的变化开始记录的日志段
+    def dumpState(self, walSegment):
+        return {'format': 1, 'walSegment': walSegment, 'epoch': self.epoch, 'version': self.version,
+                'files': self.files, 'peerFiles': self.peerFiles, 'holders': self.holders,
+                'changes': list(self.changes)}
+
+    #从快照恢复。epoch和版本号保持不变，peer手上的版本号在tracker重启之后仍然有效，可以继续增量同步
+    def loadState(self, state):
+        with self.lock:
+            self.epoch = state['epoch']
+            self.version = state['version']
+            self.files = state['files']
+            self.peerFiles = state['peerFiles']
+            self.holders = state['holders']
+            self.changes.clear()
+            self.changes.extend(tuple(change) for change in state['changes'])
+
+    #重放一条日志记录。重放得到的版本号可能因为同时宣告的peer的处理顺序而略有出入，以记录中的为准
+    def apply(self, record):
+        with self.lock:
+            if record[0] == 'e':
+                self.epoch = record[1]
+            elif record[0] == 'a':
+                user = tuple(record[1])
+                self._announce(user, record[2], record[3], record[4])
+            elif record[0] == 'x':
+                self._dropUser(tuple(record[1]))
+            self.version = max(self.version, record[-1])
+
+    #恢复完毕，所有恢复的peer都视为在lastSeen时刻心跳过
+    def restored(self, lastSeen):
+        with self.lock:
+            self.users = OrderedDict((user, lastSeen) for user in self.peerFiles)
+
+    #返回token之后的目录变化: (是否全量, {文件名: 信息}, [删除的文件名], 新token)
+    #token是上次回复给peer的"epoch.version"，首次连接、tracker重启或变化记录已经被挤出时回复全量目录
+    def changesSince(self, token):
+        with self.lock:
+            return self._changesSince(self._parseToken(token))
+
+    #和changesSince一样，但目录部分已经按encoding编码好(见Utils/CatalogCodec.py): (是否全量, 新token, 编码后的目录, [删除的文件名])
+    #同一个版本区间的回复只编码一次: 空闲的peer每次心跳拿到的都是同一个空增量，全量目录也只在版本变化后编码一次
+    #编码在锁外进行，目录中的文件信息只会被替换不会被修改，锁外读取是安全的
+    def encodedSince(self, token, encoding='json'):
+        with self.lock:
+            version = (self.epoch, self.version)
+            if self.encodedVersion != version:
+                self.encoded = {}
+                self.encodedVersion = version
+            since = self._parseToken(token)
+            key = (None if self._needsFull(since) else since, encoding)
+            reply = self.encoded.get(key)
+            if reply is not None:
+                self.encodedHits.inc()
+                return reply
+            full, files, removed, newToken = self._changesSince(since)
+        self.encodedMisses.inc()
+        reply = (full, newToken, CatalogCodec.encodeFiles(files, encoding), removed)
+        with self.lock:
+            if self.encodedVersion == version:
+                if len(self.encoded) >= Catalog.MAX_ENCODED:
+                    self.encoded = {}
+                self.encoded[key] = reply
+        return reply
+
+    #下面两个方法由调用方持锁
+    #since之后的变化记录是否已经不全(或者since根本不是这个目录的版本号)，只能回复全量目录
+    def _needsFull(self, since):
+        oldest = self.changes[0][0] if self.changes else self.version + 1
+        return since is None or since > self.version or since < oldest - 1
+
+    def _changesSince(self, since):
+        newToken = '%s.%d' % (self.epoch, self.version)
+        if self._needsFull(since):
+            return True, dict(self.files), [], newToken
+
+        names = set()
+        for version, name in reversed(self.changes):
+            if version <= since:
+                break
+            names.add(name)
+        files = {}
+        removed = []
+        for name in names:
+            info = self.files.get(name)
+            if info is None:
+                removed.append(name)
+            else:
+                files[name] = info
+        return False, files, removed, newToken
+
+    #返回当前目录的一份拷贝，可以在锁外序列化
+    def snapshot(self):
+        with self.lock:
+            return dict(self.files)
+
+    def _parseToken(self, token):
+        if not token:
+            return None
+        epoch, _, version = str(token).partition('.')
+        if epoch != self.epoch or not version.isdigit():
+            return None
+        return int(version)
+
+    #下面几个方法由调用方持锁
+    def _dropUser(self, user):
+        for name in self.peerFiles.pop(user, {}):
+            self._dropHolder(user, name)
+
+    def _setFile(self, name, info):
+        self.files[name] = info
+        self.version += 1
+        self.changes.append((self.version, name))
+
+    def _removeFile(self, name):
+        del self.files[name]
+        self.version += 1
+        self.changes.append((self.version, name))
+
+    #user不再持有name
+    def _dropHolder(self, user, name):
+        holders = self.holders.get(name)
+        if holders is not None:
+            holders.discard(user)
+            if not holders:
+                del self.holders[name]
+        self._refresh(name)
+
+    #重新计算name的最新版本(mtime最大)及其所有持有者，有变化才更新目录版本号
+    #mtime相同而内容不同时取md5较大的，结果和持有者集合的遍历顺序无关，日志重放后得到同样的目录
+    #代价只和这个文件的持有者数量有关
+    def _refresh(self, name):
+        latest = None
+        current = []
+        for holder in self.holders.get(name, ()):
+            peerFile = self.peerFiles[holder][name]
+            if latest is None or (peerFile['mtime'], peerFile['md5']) > (latest['mtime'], latest['md5']):
+                latest = peerFile
+                current = [(holder, peerFile)]
+            elif peerFile['mtime'] == latest['mtime'] and peerFile['md5'] == latest['md5']:
+                current.append((holder, peerFile))
+
+        if latest is None:
+            if name in self.files:
+                self._removeFile(name)
+            return
+        info = {'mtime': latest['mtime'],
+                'md5': latest['md5'],
+                'size': latest['size'],
+                'blockNum': latest['blockNum'],
+                'holders': sorted([list(holder) for holder, peerFile in current
+                                   if not peerFile.get('partial')])}
+        #每个块的hash，下载方据此只取和本地旧版本不同的块
+        for key in ('blocks', 'root', 'weak'):
+            if latest.get(key):
+                info[key] = latest[key]
+        #正在下载这个版本的peer，附带它们已经收到的块的位图
+        partials = sorted([[holder[0], holder[1], peerFile['have']] for holder, peerFile in current
+                           if peerFile.get('partial')])
+        if partials:
+            info['partials'] = partials
+        if self.files.get(name) != info:
+            self._setFile(name, info)
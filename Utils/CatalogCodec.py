@@ -0,0 +1,217 @@
+import json
+import socket
+import struct
+from Utils.NetUtils import NetUtils
+
+class CatalogCodec:
+    '''
+    tracker回复中目录部分(files)的编码。两种编码:
+      json  和原来一样，整条回复是一个JSON对象
+      bin   回复先是一条JSON消息(版本号、删除的文件等，带encoding和length)，后面跟着length字节的二进制目录记录
+    二进制目录是一串记录，每条记录是 1字节类型 + 4字节长度 + 内容:
+      PEER    一个peer的IPv4地址和端口，按出现顺序编号
+      HOLDERS 一组持有者(peer编号的列表)，按出现顺序编号。大多数文件的持有者都是同一组peer，只编码一次
+      FILE    固定头(名字长度, mtime, size, blockNum, hash字节数, 标志, 持有者组编号) + 名字 + hash原始字节
+              [+ 块数 + 各块hash] [+ 根hash] [+ 弱校验和个数 + 弱校验和] [+ 下载中的peer]
+      JSON    不能按上面的格式表示的文件信息(比如不是十六进制的hash)，名字长度 + 名字 + JSON
+    hash和位图按原始字节而不是十六进制存放，peer和持有者组只编码一次，大约是JSON的三分之一大小；
+    每条记录带长度，接收方边收边解码，不用等整个目录到齐，也不用先拼出一个巨大的字符串
+    解码出的同一组持有者共用一个列表，peer只会整体替换持有者列表，不会原地修改
+    '''
+    ENCODINGS = ('json', 'bin')
+    HEAD = struct.Struct('<BI')             # 记录类型, 内容长度
+    FIXED = struct.Struct('<HqqIBBI')       # 名字长度, mtime, size, blockNum, hash字节数, 标志, 持有者组编号
+    COUNT = struct.Struct('<I')
+    SHORT = struct.Struct('<H')
+    PEER = struct.Struct('<4sH')            # IPv4地址, 端口
+    FILE, PEERS, HOLDERS, JSON = 1, 2, 3, 4
+    BLOCKS, ROOT, WEAK, PARTIALS = 1, 2, 4, 8
+    KEYS = frozenset(('mtime', 'md5', 'size', 'blockNum', 'holders', 'blocks', 'root', 'weak', 'partials'))
+
+    #把 {文件名: 信息} 编码成回复中的目录部分
+    def encodeFiles(files, encoding):
+        if encoding != 'bin':
+            return json.dumps(files).encode('utf-8')
+        out = []
+        peers = {}          # (ip, port) -> 编号
+        groups = {}         # (peer编号, ...) -> 编号
+        for name, info in files.items():
+            try:
+                body = CatalogCodec._pack(name, info, peers, groups, out)
+                kind = CatalogCodec.FILE
+            except (ValueError, TypeError, KeyError, OSError, struct.error):
+                nameBytes = name.encode('utf-8')
+                body = CatalogCodec.SHORT.pack(len(nameBytes)) + nameBytes + json.dumps(info).encode('utf-8')
+                kind = CatalogCodec.JSON
+            out.append(CatalogCodec.HEAD.pack(kind, len(body)))
+            out.append(body)
+        return b''.join(out)
+
+    #发送一条回复。head是回复中除目录之外的部分，files是encodeFiles的结果(可以是缓存的)
+    def sendReply(sock, head, files, encoding):
+        if encoding == 'bin':
+            head = dict(head, encoding='bin', length=len(files))
+            data = json.dumps(head).encode('utf-8')
+            sock.sendall(b''.join([NetUtils.HEADER.pack(len(data)), data, files]))
+            return
+        #JSON回复直接把编码好的目录拼进去，不用再序列化一遍
+        data = json.dumps(head).encode('utf-8')
+        length = len(data) - 1 + len(b', "files": ') + len(files) + 1
+        sock.sendall(b''.join([NetUtils.HEADER.pack(length), data[:-1], b', "files": ', files, b'}']))
+
+    #接收一条回复，二进制目录边收边解码，返回和JSON回复一样的字典
+    def recvReply(sock):
+        response = NetUtils.recvMsg(sock)
+        if response is not None and response.get('encoding') == 'bin':
+            response['files'] = CatalogCodec.recvFiles(sock, response['length'])
+        return response
+
+    #接收length字节的二进制目录，每收到一段就解码其中完整的记录
+    def recvFiles(sock, length, bufferSize=262144):
+        files = {}
+        tables = ([], [])       # 已经定义的peer和持有者组
+        pending = b''
+        remaining = length
+        head = CatalogCodec.HEAD
+        while remaining > 0:
+            need = bufferSize
+            if len(pending) >= head.size:
+                #一条很大的记录(块很多的文件)一次收完，不反复拼接
+                need = max(need, head.unpack_from(pending)[1] + head.size - len(pending))
+            if need > bufferSize:
+                chunk = NetUtils.recvExact(sock, min(need, remaining))
+            else:
+                chunk = sock.recv(min(need, remaining))
+                if not chunk:
+                    raise ConnectionError('connection closed with %d catalog bytes left' % remaining)
+            remaining -= len(chunk)
+            data = pending + chunk if pending else chunk
+            pos = CatalogCodec.decodeInto(data, files, tables)
+            pending = data[pos:]
+        if pending:
+            raise ValueError('truncated catalog record')
+        return files
+
+    #解码data中所有完整的记录放入files，返回解码到的位置。tables是同一个目录中之前的记录定义的peer和持有者组
+    def decodeInto(data, files, tables):
+        peers, groups = tables
+        pos = 0
+        end = len(data)
+        head = CatalogCodec.HEAD
+        while pos + head.size <= end:
+            kind, size = head.unpack_from(data, pos)
+            start = pos + head.size
+            pos = start + size
+            if pos > end:
+                return start - head.size
+            if kind == CatalogCodec.FILE:
+                name, info = CatalogCodec._unpack(data, start, groups)
+                files[name] = info
+            elif kind == CatalogCodec.PEERS:
+                ip, port = CatalogCodec.PEER.unpack_from(data, start)
+                peers.append([socket.inet_ntoa(ip), port])
+            elif kind == CatalogCodec.HOLDERS:
+                count = size // 4
+                groups.append([peers[index] for index in struct.unpack_from('<%dI' % count, data, start)])
+            elif kind == CatalogCodec.JSON:
+                nameLen = CatalogCodec.SHORT.unpack_from(data, start)[0]
+                start += CatalogCodec.SHORT.size
+                files[data[start:start + nameLen].decode('utf-8')] = json.loads(data[start + nameLen:pos].decode('utf-8'))
+            else:
+                raise ValueError('unknown catalog record type %d' % kind)
+        return pos
+
+    #编码一个文件，新出现的peer和持有者组先作为单独的记录放入out
+    def _pack(name, info, peers, groups, out):
+        if not CatalogCodec.KEYS.issuperset(info):
+            raise ValueError('unknown key')
+        nameBytes = name.encode('utf-8')
+        digest = bytes.fromhex(info['md5'])
+        flags = 0
+        parts = [None, nameBytes, digest]
+        blocks = info.get('blocks')
+        if blocks:
+            raw = bytes.fromhex(''.join(blocks))
+            if len(raw) != len(digest) * len(blocks):
+                raise ValueError('block hashes of mixed length')
+            flags |= CatalogCodec.BLOCKS
+            parts += [CatalogCodec.COUNT.pack(len(blocks)), raw]
+        root = info.get('root')
+        if root:
+            raw = bytes.fromhex(root)
+            if len(raw) != len(digest):
+                raise ValueError('root hash length')
+            flags |= CatalogCodec.ROOT
+            parts.append(raw)
+        weak = info.get('weak')
+        if weak:
+            flags |= CatalogCodec.WEAK
+            parts += [CatalogCodec.COUNT.pack(len(weak)), struct.pack('<%dI' % len(weak), *weak)]
+        partials = info.get('partials')
+        if partials:
+            flags |= CatalogCodec.PARTIALS
+            parts.append(CatalogCodec.SHORT.pack(len(partials)))
+            for ip, port, have in partials:
+                have = bytes.fromhex(have)
+                parts += [CatalogCodec.PEER.pack(socket.inet_aton(ip), port), CatalogCodec.COUNT.pack(len(have)), have]
+        group = CatalogCodec._group(info['holders'], peers, groups, out)
+        parts[0] = CatalogCodec.FIXED.pack(len(nameBytes), info['mtime'], info['size'], info['blockNum'],
+                                           len(digest), flags, group)
+        return b''.join(parts)
+
+    #持有者组的编号，第一次出现时先输出其中新的peer，再输出这个组
+    def _group(holders, peers, groups, out):
+        indexes = []
+        for ip, port in holders:
+            index = peers.get((ip, port))
+            if index is None:
+                body = CatalogCodec.PEER.pack(socket.inet_aton(ip), port)
+                index = peers[(ip, port)] = len(peers)
+                out += [CatalogCodec.HEAD.pack(CatalogCodec.PEERS, len(body)), body]
+            indexes.append(index)
+        key = tuple(indexes)
+        group = groups.get(key)
+        if group is None:
+            body = struct.pack('<%dI' % len(key), *key)
+            group = groups[key] = len(groups)
+            out += [CatalogCodec.HEAD.pack(CatalogCodec.HOLDERS, len(body)), body]
+        return group
+
+    def _unpack(data, pos, groups):
+        nameLen, mtime, size, blockNum, hashLen, flags, group = CatalogCodec.FIXED.unpack_from(data, pos)
+        pos += CatalogCodec.FIXED.size
+        name = data[pos:pos + nameLen].decode('utf-8')
+        pos += nameLen
+        info = {'mtime': mtime, 'md5': data[pos:pos + hashLen].hex(), 'size': size, 'blockNum': blockNum,
+                'holders': groups[group]}
+        if not flags:
+            return name, info
+        pos += hashLen
+        if flags & CatalogCodec.BLOCKS:
+            count = CatalogCodec.COUNT.unpack_from(data, pos)[0]
+            pos += CatalogCodec.COUNT.size
+            text = data[pos:pos + count * hashLen].hex()
+            width = hashLen * 2
+            info['blocks'] = [text[i:i + width] for i in range(0, len(text), width)]
+            pos += count * hashLen
+        if flags & CatalogCodec.ROOT:
+            info['root'] = data[pos:pos + hashLen].hex()
+            pos += hashLen
+        if flags & CatalogCodec.WEAK:
+            count = CatalogCodec.COUNT.unpack_from(data, pos)[0]
+            pos += CatalogCodec.COUNT.size
+            info['weak'] = list(struct.unpack_from('<%dI' % count, data, pos))
+            pos += 4 * count
+        if flags & CatalogCodec.PARTIALS:
+            count = CatalogCodec.SHORT.unpack_from(data, pos)[0]
+            pos += CatalogCodec.SHORT.size
+            partials = []
+            for i in range(count):
+                ip, port = CatalogCodec.PEER.unpack_from(data, pos)
+                pos += CatalogCodec.PEER.size
+                length = CatalogCodec.COUNT.unpack_from(data, pos)[0]
+                pos += CatalogCodec.COUNT.size
+                partials.append([socket.inet_ntoa(ip), port, data[pos:pos + length].hex()])
+                pos += length
+            info['partials'] = partials
+        return name, info
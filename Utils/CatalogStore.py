@@ -0,0 +1,246 @@
+import os
+import time
+import zlib
+import struct
+import marshal
+import logging
+import threading
+from Utils.Metrics import REGISTRY
+
+log = logging.getLogger('catalogstore')
+
+class CatalogStore:
+    '''
+    tracker目录的持久化: 定期的快照 + 只追加的变化日志(write-ahead log)，tracker重启后直接恢复目录，
+    不用等所有peer重新全量宣告，重启期间peer也不会收到不完整的目录
+    dirPath下:
+      snapshot.bin    Catalog.dumpState()的marshal编码，记录从哪个日志段开始是快照之后的变化
+      wal.<n>.log     日志段，每条记录是 4字节长度 + 4字节crc32 + marshal编码的记录，见Catalog.apply
+    append在目录锁内按顺序编号并放入缓冲区，由一个写线程批量写入并fdatasync；
+    wait(序号)等到这条记录落盘，多个并发的宣告共用一次fsync(组提交)
+    marshal只支持python内置类型，但编解码都在C里完成，几百万条目录项的快照也能很快读完
+    写日志出错(磁盘满、IO错误)时不再持久化: 放行所有等待中的宣告，删掉已经过时的快照和日志，
+    tracker退回到只在内存中的目录，重启后由peer重新全量宣告
+    '''
+    RECORD = struct.Struct('<II')       # 长度, crc32
+
+    def __init__(self, dirPath, snapshotInterval=300, snapshotRecords=200000):
+        self.dirPath = dirPath
+        self.snapshotInterval = snapshotInterval
+        self.snapshotRecords = snapshotRecords      #日志超过这么多条也做一次快照
+        self.segment = 0                # 当前日志段编号
+        self.file = None
+        self.buffer = []                # [(序号, 编码后的记录)]，或者(序号, None)表示切换到下一个日志段
+        self.seq = 0                    # 最后一条追加的记录的序号
+        self.durable = 0                # 已经落盘的最后一条记录的序号
+        self.records = 0                # 最近一次快照之后的记录数
+        self.failed = False             # 写日志出过错，已经停止持久化
+        self.lastSnapshot = time.monotonic()
+        self.snapshotLock = threading.Lock()
+        self.cond = threading.Condition()
+        self.fsyncSeconds = REGISTRY.histogram('tracker_wal_fsync_seconds', 'time of one batched write and fdatasync')
+        self.walRecords = REGISTRY.counter('tracker_wal_records_total', 'records appended to the catalog log')
+        self.snapshotSeconds = REGISTRY.histogram('tracker_snapshot_seconds', 'time to write one catalog snapshot')
+        self.restoreSeconds = REGISTRY.gauge('tracker_restore_seconds', 'time to restore the catalog at startup')
+
+    def pathOf(self, segment):
+        return os.path.join(self.dirPath, 'wal.%d.log' % segment)
+
+    def snapshotPath(self):
+        return os.path.join(self.dirPath, 'snapshot.bin')
+
+    #读取快照并重放之后的日志，恢复到catalog中，然后开一个新的日志段开始记录。返回恢复的peer数
+    #恢复的peer的心跳时间都设为现在，再宽限grace秒，给它们留出重新连上tracker的时间
+    def restore(self, catalog, grace=0):
+        start = time.monotonic()
+        os.makedirs(self.dirPath, exist_ok=True)
+        state = None
+        try:
+            with open(self.snapshotPath(), 'rb') as file:
+                state = marshal.loads(file.read())
+        except FileNotFoundError:
+            pass
+        except (ValueError, EOFError, TypeError):
+            log.warning('警告：目录快照%s损坏，只重放日志', self.snapshotPath())
+        first = 0
+        if state is not None:
+            catalog.loadState(state)
+            first = state['walSegment']
+
+        segments = self._segments()
+        replayed = 0
+        for segment in segments:
+            if segment >= first:
+                replayed += self._replay(catalog, segment)
+        self.segment = max(segments + [first - 1]) + 1
+        self.records = replayed
+        for segment in segments:
+            if segment < first:
+                self._remove(segment)
+        catalog.restored(time.perf_counter() + grace)
+
+        self.file = open(self.pathOf(self.segment), 'ab')
+        threading.Thread(target=self._writer, args=(self.segment,), daemon=True).start()
+        #每个日志段都以epoch开头，没有快照时也能恢复出原来的epoch
+        self.append(('e', catalog.epoch, catalog.version))
+        seconds = time.monotonic() - start
+        self.restoreSeconds.set(seconds)
+        log.info('catalog restored from %s in %.1f ms: %d peers, %d files, %d log records replayed',
+                 self.dirPath, seconds * 1000, len(catalog.users), len(catalog.files), replayed)
+        return len(catalog.users)
+
+    #由Catalog在目录锁内调用，返回记录的序号
+    def append(self, record):
+        data = marshal.dumps(record)
+        with self.cond:
+            if self.failed:
+                return None
+            self.seq += 1
+            self.buffer.append((self.seq, CatalogStore.RECORD.pack(len(data), zlib.crc32(data)) + data))
+            self.records += 1
+            self.cond.notify_all()
+            return self.seq
+
+    #等到序号seq及之前的记录都已经落盘
+    def wait(self, seq):
+        if seq is None:
+            return
+        with self.cond:
+            while self.durable < seq:
+                self.cond.wait()
+
+    #是否到了该做快照的时候
+    def snapshotDue(self):
+        return not self.failed and self.records >= self.snapshotRecords or \
+            (self.records > 0 and time.monotonic() - self.lastSnapshot >= self.snapshotInterval)
+
+    #写一份快照。在目录锁内编码目录的状态并切换到新的日志段，之后的变化都记在新日志段里；
+    #锁外写文件，快照落盘后删除旧日志段
+    def snapshot(self, catalog):
+        with self.snapshotLock:
+            if self.failed:
+                return
+            start = time.monotonic()
+            with catalog.lock:
+                with self.cond:
+                    self.segment += 1
+                    segment = self.segment
+                    self.seq += 1
+                    self.buffer.append((self.seq, None))
+                    self.records = 0
+                    self.cond.notify_all()
+                data = marshal.dumps(catalog.dumpState(segment))
+            tmpPath = self.snapshotPath() + '.tmp'
+            with open(tmpPath, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmpPath, self.snapshotPath())
+            self._syncDir()
+            for old in self._segments():
+                if old < segment:
+                    self._remove(old)
+            self.lastSnapshot = time.monotonic()
+            seconds = time.monotonic() - start
+            self.snapshotSeconds.observe(seconds)
+            log.info('catalog snapshot: %d bytes in %.1f ms', len(data), seconds * 1000)
+
+    #写线程: 取走缓冲区中的所有记录，一次写入一次fdatasync，然后唤醒等待这些记录的宣告
+    #segment是正在写的日志段，切换标记和snapshot中的段号按同样的顺序递增
+    def _writer(self, segment):
+        while True:
+            with self.cond:
+                while not self.buffer:
+                    self.cond.wait()
+                batch = self.buffer
+                self.buffer = []
+            start = time.monotonic()
+            chunks = []
+            try:
+                for seq, data in batch:
+                    if data is not None:
+                        chunks.append(data)
+                        continue
+                    #切换日志段: 先把旧日志段中的记录写完
+                    self._write(chunks)
+                    chunks = []
+                    self.file.close()
+                    segment += 1
+                    self.file = open(self.pathOf(segment), 'ab')
+                    self._syncDir()
+                self._write(chunks)
+            except OSError as e:
+                log.exception('catalog log write failed, running without persistence: %s', e)
+                self._disable()
+                return
+            self.fsyncSeconds.observe(time.monotonic() - start)
+            self.walRecords.inc(len(batch))
+            with self.cond:
+                self.durable = batch[-1][0]
+                self.cond.notify_all()
+
+    #停止持久化: 之后的append不再记录，等待中的宣告全部放行。磁盘上的快照和日志已经跟不上内存中的目录，
+    #尽量删掉，免得重启时恢复出过时的目录
+    def _disable(self):
+        with self.cond:
+            self.failed = True
+            self.buffer = []
+            self.durable = self.seq
+            self.cond.notify_all()
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        try:
+            with self.snapshotLock:
+                for segment in self._segments():
+                    self._remove(segment)
+                if os.path.exists(self.snapshotPath()):
+                    os.remove(self.snapshotPath())
+        except OSError as e:
+            log.warning('could not remove the stale catalog state in %s: %s', self.dirPath, e)
+
+    def _write(self, chunks):
+        if chunks:
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            os.fdatasync(self.file.fileno())
+
+    #重放一个日志段，遇到不完整或损坏的记录(写到一半时进程退出)就停止，返回重放的记录数
+    def _replay(self, catalog, segment):
+        count = 0
+        with open(self.pathOf(segment), 'rb') as file:
+            data = file.read()
+        pos = 0
+        header = CatalogStore.RECORD
+        while pos + header.size <= len(data):
+            length, crc = header.unpack_from(data, pos)
+            body = data[pos + header.size:pos + header.size + length]
+            if len(body) < length or zlib.crc32(body) != crc:
+                log.warning('警告：日志%s在%d字节处不完整，后面的记录已忽略', self.pathOf(segment), pos)
+                break
+            catalog.apply(marshal.loads(body))
+            pos += header.size + length
+            count += 1
+        return count
+
+    def _segments(self):
+        segments = []
+        for name in os.listdir(self.dirPath):
+            parts = name.split('.')
+            if len(parts) == 3 and parts[0] == 'wal' and parts[2] == 'log' and parts[1].isdigit():
+                segments.append(int(parts[1]))
+        return sorted(segments)
+
+    def _remove(self, segment):
+        try:
+            os.remove(self.pathOf(segment))
+        except FileNotFoundError:
+            pass
+
+    def _syncDir(self):
+        fd = os.open(self.dirPath, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
@@ -0,0 +1,41 @@
+import zlib
+import lzma
+
+class Compression:
+    '''
+    块传输的流式压缩。请求方在块请求中列出可以接受的压缩方式，
+    发送方取第一个自己支持的，先压缩块开头的一段样本，压缩效果不明显(已经压缩过的数据)就直接发原始数据
+    压缩后的数据分成若干帧发送，见NetUtils.sendFrames；hash始终按解压后的原始数据校验
+    '''
+    ENCODINGS = ('zlib', 'lzma')
+    SAMPLE = 65536              #样本大小
+    MAX_RATIO = 0.9             #样本压缩后超过原大小的90%就不压缩
+
+    def compressor(encoding):
+        if encoding == 'lzma':
+            return lzma.LZMACompressor(preset=1)
+        return zlib.compressobj(6)
+
+    def decompressor(encoding):
+        if encoding == 'lzma':
+            return lzma.LZMADecompressor()
+        return zlib.decompressobj()
+
+    #根据样本决定用哪种压缩方式，不压缩时返回None
+    def choose(sample, accepted):
+        for encoding in accepted or ():
+            if encoding in Compression.ENCODINGS:
+                if not sample:
+                    return None
+                compressor = Compression.compressor(encoding)
+                size = len(compressor.compress(sample)) + len(compressor.flush())
+                return encoding if size < len(sample) * Compression.MAX_RATIO else None
+        return None
+
+    #解压一帧数据，最多输出limit字节。输出超过limit说明数据和块头中的长度不符，抛出ValueError，
+    #这样恶意构造的高压缩比数据也不会占用大量内存
+    def decompress(decompressor, data, limit):
+        out = decompressor.decompress(data, limit + 1)
+        if len(out) > limit or getattr(decompressor, 'unconsumed_tail', b''):
+            raise ValueError('compressed block larger than announced')
+        return out
@@ -0,0 +1,217 @@
+import os
+import json
+import time
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from Utils.IOUtils import IOUtils
+from Utils.Metrics import REGISTRY
+
+log = logging.getLogger('hashcache')
+
+class HashCache:
+    '''
+    持久化的文件hash缓存
+    以文件名为key，记录(size, mtime_ns, inode)和文件的hash，以及每个块的hash(不足一块的文件没有)。
+    只有这几项和hash算法都没变时才直接复用缓存的hash，否则读一遍文件重新计算。缓存保存在磁盘上，重启后依然有效
+    weak为True时还缓存每个块的rsync弱校验和，供滚动校验模式使用
+    algo是hash算法(md5或blake2b)，由tracker决定。为了和旧版本兼容，文件的hash仍然放在md5字段中
+    warm可以用线程池并行计算一批文件的hash，全量扫描时用它加快冷启动
+    磁盘上是一份JSON快照(cachePath)加一个只追加的变化日志(cachePath.log，每行一个[文件名, 缓存项或null])，
+    save只追加上次之后的变化，日志比缓存本身还大时才重写快照，写文件时不持锁
+    '''
+    COMPACT_MIN = 10000         #日志至少有这么多条时才考虑重写快照
+    def __init__(self, cachePath, blockBytes, weak=False, algo='md5', workers=4):
+        self.cachePath = cachePath
+        self.blockBytes = blockBytes
+        self.weak = weak
+        self.algo = algo
+        self.workers = workers
+        self.entries = {}           # name -> {'size':,'mtime_ns':,'ino':,'algo':,'md5':,'blockBytes':,'blocks':[],'weak':[]}
+        self.hits = REGISTRY.counter('peer_hash_cache_hits_total', 'file hashes taken from the cache')
+        self.misses = REGISTRY.counter('peer_hash_cache_misses_total', 'file hashes that had to be computed')
+        self.hashedBytes = 0        #实际读文件计算hash的字节数和耗时，用于统计hash速度
+        self.hashSeconds = 0.0
+        self.pending = []           # 上次save之后的变化 [(文件名, 缓存项或None)]
+        self.logPath = cachePath + '.log'
+        self.logRecords = 0         # 日志中的记录数
+        self.lock = threading.Lock()
+        REGISTRY.gauge('peer_hash_cache_entries', 'files in the hash cache', fn=lambda: len(self.entries))
+        self.saveLock = threading.Lock()
+        self.load()
+
+    #从磁盘读取快照，再重放日志。快照损坏时直接丢弃，日志最后一行可能只写了一半，读到坏行就停止
+    def load(self):
+        try:
+            with open(self.cachePath, 'r') as file:
+                self.entries = json.load(file)
+        except FileNotFoundError:
+            self.entries = {}
+        except (ValueError, TypeError):
+            log.warning('警告：hash缓存文件损坏，已忽略')
+            self.entries = {}
+        try:
+            with open(self.logPath, 'r') as file:
+                for line in file:
+                    try:
+                        name, entry = json.loads(line)
+                    except (ValueError, TypeError):
+                        break
+                    if entry is None:
+                        self.entries.pop(name, None)
+                    else:
+                        self.entries[name] = entry
+                    self.logRecords += 1
+        except FileNotFoundError:
+            pass
+
+    #把上次之后的变化追加到日志，代价和变化量成正比。日志比缓存本身还大时把整个缓存重写成新的快照并清空日志
+    #在锁内只取走变化(重写快照时复制一份字典)，锁外写文件，扫描和块服务线程可以照常查缓存
+    #重写快照后、清空日志前进程退出的话，重放的旧记录最多让一些文件重新计算hash，缓存项按(size, mtime, inode)校验
+    def save(self):
+        with self.saveLock:
+            with self.lock:
+                pending = self.pending
+                self.pending = []
+                snapshot = None
+                if self.logRecords + len(pending) > max(HashCache.COMPACT_MIN, len(self.entries)):
+                    snapshot = dict(self.entries)
+            if not pending:
+                return
+            os.makedirs(os.path.dirname(self.cachePath), exist_ok=True)
+            if snapshot is not None:
+                #先写临时文件再rename，防止写到一半进程退出导致快照损坏
+                tmpPath = self.cachePath + '.tmp'
+                with open(tmpPath, 'w') as file:
+                    json.dump(snapshot, file)
+                os.replace(tmpPath, self.cachePath)
+                open(self.logPath, 'w').close()
+                self.logRecords = 0
+            else:
+                with open(self.logPath, 'a') as file:
+                    file.write(''.join(json.dumps([name, entry]) + '\n' for name, entry in pending))
+                self.logRecords += len(pending)
+
+    #获取文件md5，命中缓存则不读文件
+    def getMD5(self, name, path, stat=None):
+        entry = self.getEntry(name, path, stat)
+        return entry['md5'] if entry is not None else None
+
+    #获取文件的缓存项，没有命中时读一遍文件，同时算出整个文件和每个块的hash
+    def getEntry(self, name, path, stat=None):
+        if stat is None:
+            stat = os.stat(path)
+        with self.lock:
+            entry = self.entries.get(name)
+            if self._fresh(entry, stat):
+                self.hits.inc()
+                return entry
+            self.misses.inc()
+
+        #不持锁计算，避免大文件阻塞其他线程
+        algo = self.algo
+        start = time.monotonic()
+        md5, blocks, weaks = IOUtils.getFileHashes(path, self.blockBytes, self.weak, algo)
+        if md5 is None:
+            return None
+        entry = {'size': stat.st_size,
+                 'mtime_ns': stat.st_mtime_ns,
+                 'ino': stat.st_ino,
+                 'algo': algo,
+                 'md5': md5,
+                 'blockBytes': self.blockBytes,
+                 'blocks': blocks}
+        if self.weak:
+            entry['weak'] = weaks
+        with self.lock:
+            self.hashedBytes += stat.st_size
+            self.hashSeconds += time.monotonic() - start
+            if algo == self.algo:
+                self.entries[name] = entry
+                self.pending.append((name, entry))
+        return entry
+
+    #用线程池并行计算一批文件的hash并放入缓存，items是[(name, path)]。已经缓存的文件只stat一次
+    #返回这一批实际计算的字节数和墙钟时间
+    def warm(self, items):
+        misses = []
+        for name, path in items:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            with self.lock:
+                entry = self.entries.get(name)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime_ns'] != stat.st_mtime_ns \
+                    or entry['ino'] != stat.st_ino or entry.get('algo', 'md5') != self.algo \
+                    or entry.get('blockBytes') != self.blockBytes or (self.weak and 'weak' not in entry):
+                misses.append((name, path, stat))
+        if len(misses) < 2:
+            return 0, 0.0
+        start = time.monotonic()
+        with ThreadPoolExecutor(self.workers) as pool:
+            for name, path, stat in misses:
+                pool.submit(self.getEntry, name, path, stat)
+        seconds = time.monotonic() - start
+        nbytes = sum(stat.st_size for name, path, stat in misses)
+        log.info('hashed %d files, %.1f MB in %.2f s (%.1f MB/s, %s, %d threads)',
+                 len(misses), nbytes / 1048576, seconds, nbytes / 1048576 / max(seconds, 1e-6), self.algo, self.workers)
+        return nbytes, seconds
+
+    #换一种hash算法，之后所有的缓存项都会失效重新计算
+    def setAlgo(self, algo):
+        with self.lock:
+            self.algo = algo
+
+    #直接写入一个已知hash的文件，例如刚下载完、每个块都校验过的文件，下次扫描时不必再读一遍
+    #只查缓存，不读文件: 缓存项和文件当前的stat一致时返回它，否则返回None(由下一次扫描重新计算)
+    #提供块的线程用它，文件刚被改过时不能在那里同步地把整个文件再hash一遍
+    def lookup(self, name, stat):
+        with self.lock:
+            entry = self.entries.get(name)
+            return entry if self._fresh(entry, stat) else None
+
+    #由调用方持锁。缓存项是否还对应stat描述的文件，并且是按当前的分块大小和算法计算的
+    def _fresh(self, entry, stat):
+        return entry is not None and entry['size'] == stat.st_size \
+            and entry['mtime_ns'] == stat.st_mtime_ns and entry['ino'] == stat.st_ino \
+            and entry.get('blockBytes') == self.blockBytes and entry.get('algo', 'md5') == self.algo \
+            and (not self.weak or 'weak' in entry)
+
+    def put(self, name, path, md5, blocks, weaks=None):
+        if self.weak and blocks and not weaks:
+            return
+        stat = os.stat(path)
+        entry = {'size': stat.st_size,
+                 'mtime_ns': stat.st_mtime_ns,
+                 'ino': stat.st_ino,
+                 'algo': self.algo,
+                 'md5': md5,
+                 'blockBytes': self.blockBytes,
+                 'blocks': list(blocks)}
+        if self.weak:
+            entry['weak'] = list(weaks or [])
+        with self.lock:
+            self.entries[name] = entry
+            self.pending.append((name, entry))
+
+    #删除一个文件的缓存项
+    def remove(self, name):
+        with self.lock:
+            if self.entries.pop(name, None) is not None:
+                self.pending.append((name, None))
+
+    #只保留names中的文件，删除已经不存在的文件的缓存项
+    def retain(self, names):
+        with self.lock:
+            for name in list(self.entries):
+                if name not in names:
+                    del self.entries[name]
+                    self.pending.append((name, None))
+
+    #命中统计和hash速度
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'hits': self.hits.value, 'misses': self.misses.value,
+                    'algo': self.algo, 'hashedMB': self.hashedBytes / 1048576,
+                    'rate': self.hashedBytes / 1048576 / self.hashSeconds if self.hashSeconds > 0 else 0.0}
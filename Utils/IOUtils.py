@@ -1,6 +1,16 @@
 import os
+import mmap
 import hashlib
+import time
+import logging
+import itertools
 from Utils.ConversionUtils import ConversionUtils
+from Utils.Metrics import REGISTRY
+
+log = logging.getLogger('io')
+hashSeconds = REGISTRY.histogram('io_hash_file_seconds', 'time to hash one whole file (file hash plus block hashes)')
+hashedBytes = REGISTRY.counter('io_hashed_bytes_total', 'bytes read to compute content hashes')
+scanSeconds = REGISTRY.histogram('io_rolling_scan_seconds', 'time of one rolling checksum scan over an old file')
 
 class IOUtils:
     #获取文件大小(MB)
@@ -11,35 +21,36 @@ class IOUtils:
                 fileSize = ConversionUtils.bytes2Megabytes(fileSize)
                 return fileSize
         except FileNotFoundError as reason:
-            print('错误：文件不存在！')
+            log.error('错误：文件不存在！')
             return -1
         except TypeError as reason:
-            print('错误：可能是文件损坏！')
+            log.error('错误：可能是文件损坏！')
             return -1
 
     #获取文件md5值
     def getMD5(path):
         if os.path.isdir(path):
-            print('错误：路径是一个目录！')
+            log.error('错误：路径是一个目录！')
             return
         md5 = hashlib.md5()
         try:
-            with open(path,'rb') as file:
+            with hashSeconds.time(), open(path,'rb') as file:
                 while True:
                     tempSize = file.read(10240)
                     if not tempSize:
                         break
                     md5.update(tempSize)
+                    hashedBytes.inc(len(tempSize))
             return md5.hexdigest()
         except FileNotFoundError as reason:
-            print('错误：文件不存在！')
+            log.error('错误：文件不存在！')
 
     #递归列举文件(私有静态)
     def __fileRecursionList(path,pList):
         try:
             ret = os.listdir(path)
         except FileNotFoundError as reason:
-            print('错误：目录不存在！')
+            log.error('错误：目录不存在！')
             return
         for each in ret:
             myPath = path + os.sep + each
@@ -51,40 +62,129 @@ class IOUtils:
         return pList
 
 
-    #分割文件，默认块大小为100MB
-    def partitionFile(path,blockSize=100):
-        if os.path.isdir(path):
-            print('错误：应该是一个文件，不是一个目录')
-            return
-        
-        toPath = os.path.dirname(path) + os.sep + 'MEtemp'
-        filename=os.path.basename(path)
+    #支持的内容hash算法。md5是默认算法，保持和旧版本peer兼容；blake2b更快，由tracker决定整个网络使用哪一种
+    HASH_ALGOS = ('md5', 'blake2b')
 
-        #首先判断是否已经分好块了
-        if os.path.exists(toPath+os.sep+filename+ '_PART' + '1'):
-            return          #已经分好了，直接退出
+    #新建一个hash对象
+    def newHash(algo='md5'):
+        if algo == 'blake2b':
+            return hashlib.blake2b(digest_size=32)
+        return hashlib.md5()
 
-        blockBytes = ConversionUtils.megabytes2Bytes(blockSize)
-        blockNum = IOUtils.getPartionBlockNum(path,blockSize) 
-        if not os.path.exists(toPath):
-            os.mkdir(toPath)      #创建缓存文件夹  
+    #读一遍文件，同时算出整个文件的hash和每个块的hash，返回(hash, [块hash], [块弱校验和])
+    #文件不足一块时块列表为空；weak为True时才计算rsync式的弱校验和
+    #每次读bufferSize字节到同一个缓冲区，hashlib处理大块数据时会释放GIL，多个文件可以在线程池中并行计算
+    def getFileHashes(path,blockBytes,weak=False,algo='md5',bufferSize=4194304):
+        fileHash = IOUtils.newHash(algo)
+        blocks = []
+        weaks = []
+        blockHash = IOUtils.newHash(algo)
+        filled = 0
+        a = b = 0
+        buffer = bytearray(min(blockBytes, bufferSize))
+        view = memoryview(buffer)
+        total = 0
+        start = time.monotonic()
+        try:
+            with open(path,'rb', buffering=0) as file:
+                while True:
+                    count = file.readinto(view[:min(len(buffer), blockBytes - filled)])
+                    if not count:
+                        break
+                    data = view[:count]
+                    fileHash.update(data)
+                    blockHash.update(data)
+                    if weak:
+                        a, b = IOUtils.extendWeak(a, b, data)
+                    filled += count
+                    total += count
+                    if filled == blockBytes:
+                        blocks.append(blockHash.hexdigest())
+                        weaks.append(IOUtils.packWeak(a, b))
+                        blockHash = IOUtils.newHash(algo)
+                        filled = 0
+                        a = b = 0
+        except FileNotFoundError as reason:
+            log.error('错误：文件不存在！')
+            return None, [], []
+        if filled > 0 and blocks:           #最后一个不满的块；不足一块的文件不分块
+            blocks.append(blockHash.hexdigest())
+            weaks.append(IOUtils.packWeak(a, b))
+        hashSeconds.observe(time.monotonic() - start)
+        hashedBytes.inc(total)
+        return fileHash.hexdigest(), blocks, (weaks if weak else [])
+
+    #rsync的弱校验和: a是字节和，b是每个字节乘以它到窗口末尾的距离之和
+    #b等于所有前缀和之和，所以一段数据接在后面时 b += len(data)*a + sum(前缀和)，循环在C里完成
+    def extendWeak(a, b, data):
+        b += len(data) * a + sum(itertools.accumulate(data))
+        a += sum(data)
+        return a, b
+
+    def packWeak(a, b):
+        return (a & 0xffff) | ((b & 0xffff) << 16)
 
+    #在文件中按字节滑动一个blockBytes大小的窗口，寻找和wanted中的块内容相同的位置
+    #wanted: 弱校验和 -> [(块序号, 块hash)]，返回{块序号: 在文件中的偏移}
+    #弱校验和可以O(1)滚动，命中后再用块hash确认。这是纯python逐字节循环，只适合不太大的文件
+    #maxSeconds限制扫描时间，超时就返回已经找到的块
+    def findBlocks(path,blockBytes,wanted,algo='md5',maxSeconds=None):
+        found = {}
+        start = time.monotonic()
         try:
-            with open(path, 'rb') as orgFile:
-                for i in range(int(blockNum)):
-                    print('正在分割第' + str(i + 1) + '块')
-                    totalBufferSize = 0
-                    with open(toPath+os.sep+filename + '_PART' + str(i+1), 'wb') as toFile:
-                        while totalBufferSize < blockBytes:
-                            #缓冲区大小为1M=1024x1024
-                            data = orgFile.read(1048576)
-                            if not data:
+            with open(path,'rb') as file:
+                size = os.fstat(file.fileno()).st_size
+                if size < blockBytes or not wanted:
+                    return found
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    total = sum(len(candidates) for candidates in wanted.values())
+                    k = 0
+                    a, b = IOUtils.extendWeak(0, 0, memoryview(mm)[0:blockBytes])
+                    while len(found) < total:
+                        match = None
+                        for idx, digest in wanted.get(IOUtils.packWeak(a, b), ()):
+                            blockHash = IOUtils.newHash(algo)
+                            blockHash.update(mm[k:k + blockBytes])
+                            if idx not in found and blockHash.hexdigest() == digest:
+                                match = idx
                                 break
-                            toFile.write(data)
-                            totalBufferSize += 1048576
-            print('分割完成！')
-        except FileNotFoundError as reason:
-            print('错误！无法创建文件！')
+                        if match is not None:
+                            #命中一整块，直接跳到这块之后重新计算
+                            found[match] = k
+                            k += blockBytes
+                            if k + blockBytes > size:
+                                break
+                            a, b = IOUtils.extendWeak(0, 0, memoryview(mm)[k:k + blockBytes])
+                        else:
+                            if k + blockBytes >= size:
+                                break
+                            if maxSeconds is not None and k & 0xffff == 0 and time.monotonic() - start > maxSeconds:
+                                log.info('rolling scan of %s stopped after %d of %d bytes', path, k, size)
+                                break
+                            out = mm[k]
+                            a = a - out + mm[k + blockBytes]
+                            b = b - blockBytes * out + a
+                            k += 1
+        except (FileNotFoundError, ValueError) as reason:
+            log.error('错误：文件不存在或为空！')
+        scanSeconds.observe(time.monotonic() - start)
+        return found
+
+    #块hash列表的根: 所有块hash(二进制)连起来再算一次hash，相当于只有一层的hash树
+    #整个文件的hash不能由块的hash组合出来，所以用它来代表整个文件的块列表，收到的块列表和它对得上才能用来校验块
+    def getHashRoot(blocks,algo='md5'):
+        root = IOUtils.newHash(algo)
+        root.update(b''.join(bytes.fromhex(digest) for digest in blocks))
+        return root.hexdigest()
+
+    #得到第blockIdx块(从1开始)在原文件中的字节范围(offset, length)
+    #块不再拷贝成单独的文件，只是原文件上的一段虚拟区间
+    def getBlockRange(path,blockIdx,blockSize=100):
+        blockBytes = ConversionUtils.megabytes2Bytes(blockSize)
+        totalSize = os.path.getsize(path)
+        offset = (blockIdx - 1) * blockBytes
+        length = max(0, min(blockBytes, totalSize - offset))
+        return offset, length
 
 
     #得到文件的分块数
@@ -93,7 +193,7 @@ class IOUtils:
         try:
             totalSize = os.path.getsize(path)
         except FileNotFoundError as reason:
-            print('错误：目录不存在！')
+            log.error('错误：目录不存在！')
             return
         blockNum = 0
         if totalSize % blockBytes != 0:
@@ -112,7 +212,7 @@ class IOUtils:
                 else:
                     os.rmdir(fileList[index])
             except FileNotFoundError as reason:
-                print('错误！找不到文件！')
+                log.error('错误！找不到文件！')
     #删除单个文件或目录(递归删除)
     def deleteFile(path):
         try:
@@ -127,32 +227,22 @@ class IOUtils:
                     IOUtils.deleteFiles(fList)
                     os.rmdir(path)
         except FileNotFoundError as reason:
-            print('错误！找不到文件')
-    #合并文件
-    def combineFile(blockPrefix,targetFilePath,blockNum):
+            log.error('错误！找不到文件')
+    #创建并预分配指定大小的文件，返回可读写的文件描述符
+    #优先使用posix_fallocate真正分配磁盘块，不支持的平台/文件系统只做truncate
+    def preallocate(path,size):
+        tmpDir = os.path.dirname(path)
+        if not os.path.exists(tmpDir):
+            os.mkdir(tmpDir)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        os.ftruncate(fd, size)          #残留的旧临时文件可能更大，先截断
         try:
-            with open(targetFilePath, 'wb') as file:
-                for i in range(blockNum):
-                    print('正在合并第' + str(i+1) + '块')
-                    with open(blockPrefix + str(i+1), 'rb') as tmpFile:
-                        while True:
-                            # 缓冲区大小为1M
-                            data = tmpFile.read(1048576)
-                            if not data:
-                                break
-                            file.write(data)
-            print('合并完成')
-        except FileNotFoundError as reason:
-            print('错误！块路径不正确！或文件块丢失！')
+            if size > 0 and hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fd, 0, size)
+        except OSError:
+            pass
+        return fd
 
     #判断是否为目录
     def isDir(path):
         return True if os.path.isdir(path) else False
-
-    def delFileBlocks(path,blockNum):
-        filename = os.path.basename(path)
-        prefix = os.path.dirname(path) + os.sep + 'MEtemp'+ os.sep + filename + '_PART'
-        for i in range(blockNum):
-            if os.path.exists(prefix+str(i+1)):
-                os.remove(prefix+str(i+1))
-        print('已删除'+path+"文件块")
\ No newline at end of file
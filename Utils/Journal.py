@@ -0,0 +1,80 @@
+import os
+import json
+import urllib.parse
+import threading
+import logging
+from Utils.Transfer import BlockBitmap
+
+log = logging.getLogger('journal')
+
+class TransferJournal:
+    '''
+    下载进度日志，每个正在下载的文件在MEtemp下有一个 文件名.journal
+    记录目标版本(md5, mtime, size, 块大小, 块hash列表)和已经写入临时文件并校验过的块的位图。
+    块数据先fdatasync再记日志，所以日志里记为完成的块一定已经落盘。
+    进程重启后按日志继续下载，目标版本变了的日志连同临时文件一起丢弃
+    '''
+    def __init__(self, dirPath, blockBytes):
+        self.dirPath = dirPath
+        self.blockBytes = blockBytes
+        self.states = {}            # 文件名 -> {'info':, 'have': BlockBitmap}
+        self.lock = threading.Lock()
+
+    #文件名是相对路径，日志都放在dirPath下一层，/转义掉
+    def pathOf(self, name):
+        return self.dirPath + os.sep + urllib.parse.quote(name, safe='') + '.journal'
+
+    #读取name的日志，返回已完成的块位图。没有日志，或者日志的版本和info不同时返回None，并删除旧日志
+    def resume(self, name, info):
+        try:
+            with open(self.pathOf(name), 'r') as file:
+                saved = json.load(file)
+        except FileNotFoundError:
+            return None
+        except (ValueError, TypeError):
+            log.warning('警告：' + name + '的下载日志损坏，已忽略')
+            saved = None
+        if saved is None or saved.get('blockBytes') != self.blockBytes \
+                or any(saved.get(key) != info.get(key) for key in ('md5', 'mtime', 'size', 'blockNum', 'root')):
+            self.remove(name)
+            return None
+        return BlockBitmap.fromHex(info['blockNum'] or 1, saved['have'])
+
+    #开始(或继续)下载一个文件，have是已经完成的块
+    def begin(self, name, info, have):
+        state = {'info': dict((key, value) for key, value in info.items() if key not in ('holders', 'partials')),
+                 'have': BlockBitmap(have.count, have.bits)}
+        with self.lock:
+            self.states[name] = state
+            self._write(name, state)
+
+    #这些块已经落盘
+    def record(self, name, idxs):
+        with self.lock:
+            state = self.states.get(name)
+            if state is None or not idxs:
+                return
+            for idx in idxs:
+                state['have'].set(idx)
+            self._write(name, state)
+
+    #文件已经完成或者被放弃，删除它的日志
+    def remove(self, name):
+        with self.lock:
+            self.states.pop(name, None)
+            try:
+                os.remove(self.pathOf(name))
+            except FileNotFoundError:
+                pass
+
+    #由调用方持锁。先写临时文件再rename，日志不会只写一半
+    def _write(self, name, state):
+        if not os.path.exists(self.dirPath):
+            os.mkdir(self.dirPath)
+        saved = dict(state['info'])
+        saved['blockBytes'] = self.blockBytes
+        saved['have'] = state['have'].toHex()
+        tmpPath = self.pathOf(name) + '.tmp'
+        with open(tmpPath, 'w') as file:
+            json.dump(saved, file)
+        os.replace(tmpPath, self.pathOf(name))
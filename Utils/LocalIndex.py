@@ -0,0 +1,144 @@
+import os
+
+class LocalIndex:
+    '''
+    共享目录的本地文件索引，递归包含所有子目录，文件以相对路径(用/分隔)为key
+    files:   相对路径 -> 文件信息(由describe(相对路径)给出，返回None表示不共享这个文件)
+    dirs:    相对目录(''是共享目录本身) -> {'mtime_ns':, 'files': set(文件), 'dirs': set(子目录)}
+    changes: 上次drainChanges之后新增、修改或删除的文件，sync只处理这些文件，代价和变化量成正比
+    目录的mtime只在其中有文件新建、删除、改名时才变，所以快速扫描跳过mtime没变的目录，不必列出其中的文件；
+    文件内容的修改由inotify(update)或者定期的深度扫描发现
+    扫描时先遍历目录收集要检查的文件，交给prepare([相对路径])(例如并行计算hash)，再逐个describe
+    '''
+    def __init__(self, root, describe, forget, ignoreDirs=('MEtemp', '__pycache__'), prepare=None):
+        self.root = root
+        self.describe = describe
+        self.forget = forget            #文件从索引中删除时调用，用于清理hash缓存
+        self.prepare = prepare
+        self.ignoreDirs = set(ignoreDirs)
+        self.files = {}
+        self.dirs = {}
+        self.changes = set()
+        self.pending = []               #本次扫描要检查的文件
+
+    #相对路径对应的本地路径
+    def pathOf(self, rel):
+        if not rel:
+            return self.root
+        return self.root + os.sep + rel.replace('/', os.sep)
+
+    #扫描整个目录树。deep为False时跳过mtime没变的目录(只stat目录本身)，为True时重新检查每一个文件
+    def scan(self, deep):
+        self._scanDir('', deep)
+        self._flush()
+
+    #inotify报告了这些相对路径有变化: 新目录扫描整个子树，文件重新获取信息，不存在了就从索引中删除
+    def update(self, paths):
+        for rel in paths:
+            if any(part in self.ignoreDirs for part in rel.split('/')):
+                continue
+            path = self.pathOf(rel)
+            parent = self.dirs.get(self._parentOf(rel))
+            if os.path.isdir(path) and not os.path.islink(path):
+                if parent is not None:
+                    parent['dirs'].add(rel)
+                self._scanDir(rel, True)
+            elif os.path.isfile(path):
+                self.pending.append(rel)
+            elif rel in self.files:
+                self._dropFile(rel)
+            else:
+                self._dropDir(rel)
+        self._flush()
+
+    #取走并清空变化记录
+    def drainChanges(self):
+        changes = self.changes
+        self.changes = set()
+        return changes
+
+    def _parentOf(self, rel):
+        return rel.rpartition('/')[0]
+
+    def _flush(self):
+        pending = self.pending
+        self.pending = []
+        if self.prepare is not None and pending:
+            self.prepare(pending)
+        for name in pending:
+            self._updateFile(name)
+
+    def _scanDir(self, rel, deep):
+        path = self.pathOf(rel)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._dropDir(rel)
+            return
+        cached = self.dirs.get(rel)
+        if cached is not None and not deep and cached['mtime_ns'] == stat.st_mtime_ns:
+            for sub in list(cached['dirs']):
+                self._scanDir(sub, deep)
+            return
+
+        files = set()
+        dirs = set()
+        try:
+            with os.scandir(path) as entries:
+                for entry in entries:
+                    child = rel + '/' + entry.name if rel else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.name not in self.ignoreDirs:
+                                dirs.add(child)
+                        elif entry.is_file():
+                            files.add(child)
+                    except OSError:
+                        pass
+        except OSError:
+            self._dropDir(rel)
+            return
+
+        if cached is not None:
+            for name in cached['files'] - files:
+                self._dropFile(name)
+            for sub in cached['dirs'] - dirs:
+                self._dropDir(sub)
+        self.dirs[rel] = {'mtime_ns': stat.st_mtime_ns,
+                          'files': cached['files'] & files if cached is not None else set(),
+                          'dirs': dirs}
+        self.pending.extend(files)
+        for sub in dirs:
+            self._scanDir(sub, deep)
+
+    def _updateFile(self, name):
+        info = self.describe(name)
+        if info is None:
+            self._dropFile(name)
+            return
+        parent = self.dirs.get(self._parentOf(name))
+        if parent is not None:
+            parent['files'].add(name)
+        if self.files.get(name) != info:
+            self.files[name] = info
+            self.changes.add(name)
+
+    def _dropFile(self, name):
+        parent = self.dirs.get(self._parentOf(name))
+        if parent is not None:
+            parent['files'].discard(name)
+        if self.files.pop(name, None) is not None:
+            self.changes.add(name)
+            self.forget(name)
+
+    def _dropDir(self, rel):
+        entry = self.dirs.pop(rel, None)
+        if entry is None:
+            return
+        parent = self.dirs.get(self._parentOf(rel))
+        if parent is not None and rel:
+            parent['dirs'].discard(rel)
+        for name in list(entry['files']):
+            self._dropFile(name)
+        for sub in list(entry['dirs']):
+            self._dropDir(sub)
@@ -0,0 +1,47 @@
+import sys
+import json
+import logging
+
+class Log:
+    '''
+    分级的结构化日志，基于标准库logging。每个模块用logging.getLogger(名字)取自己的logger
+    热路径上的日志把字段放在extra=Log.fields(...)里: 文本格式输出为 "消息 key=value ..."，json格式每行一个对象
+    逐块的收发日志是DEBUG级别，默认的INFO级别下不输出
+    '''
+    LEVELS = ('debug', 'info', 'warning', 'error')
+
+    #配置根logger，程序启动时调用一次
+    def setup(level='info', asJson=False, stream=None):
+        handler = logging.StreamHandler(stream if stream is not None else sys.stdout)
+        handler.setFormatter(JsonFormatter() if asJson else TextFormatter())
+        root = logging.getLogger()
+        for old in list(root.handlers):
+            root.removeHandler(old)
+        root.addHandler(handler)
+        root.setLevel(getattr(logging, level.upper()))
+
+    def fields(**kwargs):
+        return {'fields': kwargs}
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        logging.Formatter.__init__(self, '%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        line = logging.Formatter.format(self, record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + ' '.join('%s=%s' % (key, value) for key, value in fields.items())
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        obj = {'time': record.created, 'level': record.levelname, 'logger': record.name, 'msg': record.getMessage()}
+        fields = getattr(record, 'fields', None)
+        if fields:
+            obj.update(fields)
+        if record.exc_info:
+            obj['exc'] = self.formatException(record.exc_info)
+        return json.dumps(obj, default=str)
@@ -0,0 +1,223 @@
+import json
+import time
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+class Counter:
+    '''只增不减的计数，例如请求数、字节数'''
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def sample(self):
+        return self.value
+
+
+class Gauge:
+    '''当前值，例如连接数、队列长度。给了fn时每次读取都调用fn()取值，不用在代码各处维护'''
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def dec(self, n=1):
+        self.inc(-n)
+
+    def sample(self):
+        if self.fn is not None:
+            try:
+                return self.fn()
+            except Exception:
+                return None
+        return self.value
+
+
+class Histogram:
+    '''
+    分布，例如延迟(秒)、吞吐量。buckets是各个桶的上界，从小到大，最后隐含一个+Inf桶
+    observe只做一次二分查找和加法，可以放在热路径上
+    '''
+    kind = 'histogram'
+    LATENCY = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self, name, help, buckets=LATENCY):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        pos = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[pos] += 1
+            self.sum += value
+            self.count += 1
+
+    #with histogram.time(): ... 记录代码块的耗时
+    def time(self):
+        return _Timer(self)
+
+    def sample(self):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        cumulative = []
+        running = 0
+        for bound, n in zip(self.buckets + (float('inf'),), counts):
+            running += n
+            cumulative.append((bound, running))
+        return {'count': count, 'sum': total, 'mean': total / count if count else 0.0, 'buckets': cumulative}
+
+
+class _Timer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.monotonic() - self.start)
+        return False
+
+
+class MetricsRegistry:
+    '''
+    进程内所有指标。counter/gauge/histogram按名字取指标，第一次取时创建，所以各模块直接取同名指标即可，不用传来传去
+    snapshot()返回json可以序列化的字典，prometheus()返回Prometheus文本格式
+    '''
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+
+    def counter(self, name, help=''):
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help='', fn=None):
+        gauge = self._get(Gauge, name, help)
+        if fn is not None:
+            gauge.fn = fn
+        return gauge
+
+    def histogram(self, name, help='', buckets=Histogram.LATENCY):
+        return self._get(Histogram, name, help, buckets)
+
+    def snapshot(self):
+        result = {}
+        for metric in self._sorted():
+            value = metric.sample()
+            if metric.kind == 'histogram':
+                value = dict(value)
+                value['buckets'] = dict((_formatBound(bound), n) for bound, n in value['buckets'])
+            result[metric.name] = value
+        return result
+
+    def prometheus(self):
+        lines = []
+        for metric in self._sorted():
+            lines.append('# HELP %s %s' % (metric.name, metric.help))
+            lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+            value = metric.sample()
+            if metric.kind != 'histogram':
+                if value is not None:
+                    lines.append('%s %s' % (metric.name, value))
+                continue
+            for bound, n in value['buckets']:
+                lines.append('%s_bucket{le="%s"} %d' % (metric.name, _formatBound(bound), n))
+            lines.append('%s_sum %s' % (metric.name, value['sum']))
+            lines.append('%s_count %d' % (metric.name, value['count']))
+        return '\n'.join(lines) + '\n'
+
+    def _get(self, cls, name, help, *args):
+        metric = self.metrics.get(name)
+        if metric is None:
+            with self.lock:
+                metric = self.metrics.get(name)
+                if metric is None:
+                    metric = cls(name, help, *args)
+                    self.metrics[name] = metric
+        if not isinstance(metric, cls):
+            raise ValueError('metric %s is a %s, not a %s' % (name, metric.kind, cls.kind))
+        return metric
+
+    def _sorted(self):
+        with self.lock:
+            return [self.metrics[name] for name in sorted(self.metrics)]
+
+
+def _formatBound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+#进程内唯一的指标注册表
+REGISTRY = MetricsRegistry()
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer:
+    '''
+    本地http统计接口，默认只监听127.0.0.1
+    GET /metrics  Prometheus文本格式
+    GET /stats    json
+    '''
+    def __init__(self, port, host='127.0.0.1', registry=REGISTRY):
+        self.port = port
+        self.host = host
+        self.registry = registry
+        self.httpd = None
+
+    def start(self):
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split('?')[0]
+                if path == '/metrics':
+                    body = registry.prometheus().encode('utf-8')
+                    contentType = 'text/plain; version=0.0.4'
+                elif path in ('/stats', '/metrics.json'):
+                    body = json.dumps(registry.snapshot(), indent=1).encode('utf-8')
+                    contentType = 'application/json'
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', contentType)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _ThreadingHTTPServer((self.host, self.port), Handler)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
@@ -0,0 +1,138 @@
+import os
+import json
+import struct
+import asyncio
+from Utils.Compression import Compression
+
+class NetUtils:
+    #消息头格式: 4字节大端无符号整数表示后面JSON的字节数
+    HEADER = struct.Struct('!I')
+    #单条消息的上限，防止收到错误数据时按一个巨大的长度去分配内存
+    MAX_MESSAGE = 256 * 1024 * 1024
+
+    #发送一条带长度前缀的JSON消息
+    def sendMsg(sock, obj):
+        data = json.dumps(obj).encode('utf-8')
+        sock.sendall(NetUtils.HEADER.pack(len(data)) + data)
+
+    #接收一条带长度前缀的JSON消息。对端在消息边界上正常关闭连接时返回None
+    def recvMsg(sock):
+        header = NetUtils.recvExact(sock, NetUtils.HEADER.size, allowEOF=True)
+        if header is None:
+            return None
+        length = NetUtils.HEADER.unpack(header)[0]
+        if length > NetUtils.MAX_MESSAGE:
+            raise ValueError('message too large: %d bytes' % length)
+        return json.loads(NetUtils.recvExact(sock, length).decode('utf-8'))
+
+    #恰好接收n个字节。数据不完整时抛出ConnectionError，
+    #allowEOF为True时，如果一个字节都没收到就被关闭，返回None
+    def recvExact(sock, n, allowEOF=False):
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        received = 0
+        while received < n:
+            count = sock.recv_into(view[received:])
+            if count == 0:
+                if received == 0 and allowEOF:
+                    return None
+                raise ConnectionError('connection closed after %d of %d bytes' % (received, n))
+            received += count
+        return bytes(buffer)
+
+    #接收size字节的数据块，每收到一段就调用一次consumer(memoryview)，不会多读属于下一条消息的数据
+    #throttle(字节数)用于限速，在每次收到数据后调用，它睡眠时不读socket，TCP窗口会让对端也慢下来
+    def recvPayload(sock, size, consumer, bufferSize=8192, throttle=None):
+        buffer = bytearray(min(bufferSize, size) or 1)
+        view = memoryview(buffer)
+        remaining = size
+        while remaining > 0:
+            count = sock.recv_into(view, min(len(buffer), remaining))
+            if count == 0:
+                raise ConnectionError('connection closed with %d bytes missing' % remaining)
+            if throttle is not None:
+                throttle(count)
+            consumer(view[:count])
+            remaining -= count
+
+    #用sendfile发送文件中[offset, offset+size)这段数据，返回发送的字节数(文件被截断时小于size)
+    #没有限速时一次sendfile发完；有限速时每chunkSize字节先调用throttle(字节数)
+    def sendFile(sock, file, offset, size, throttle=None, chunkSize=262144):
+        if throttle is None:
+            return sock.sendfile(file, offset, size)
+        sent = 0
+        while sent < size:
+            count = min(chunkSize, size - sent)
+            throttle(count)
+            count = sock.sendfile(file, offset + sent, count)
+            if count == 0:
+                break
+            sent += count
+        return sent
+
+    #压缩发送文件中[offset, offset+size)这段数据: 每帧是4字节长度加压缩后的数据，长度为0的帧表示结束
+    #返回实际发送的字节数(不含帧头)
+    def sendFrames(sock, fd, offset, size, encoding, chunkSize=1048576, throttle=None):
+        compressor = Compression.compressor(encoding)
+        sent = 0
+        end = offset + size
+        while offset < end:
+            data = os.pread(fd, min(chunkSize, end - offset), offset)
+            if not data:
+                raise ConnectionError('file shrank while sending')
+            offset += len(data)
+            out = compressor.compress(data)
+            if out:
+                if throttle is not None:
+                    throttle(len(out))
+                sock.sendall(NetUtils.HEADER.pack(len(out)) + out)
+                sent += len(out)
+        out = compressor.flush()
+        if out:
+            sock.sendall(NetUtils.HEADER.pack(len(out)) + out)
+            sent += len(out)
+        sock.sendall(NetUtils.HEADER.pack(0))
+        return sent
+
+    #接收sendFrames发来的压缩数据，解压后的size字节依次交给consumer，返回收到的压缩数据字节数
+    def recvFrames(sock, size, encoding, consumer, throttle=None):
+        decompressor = Compression.decompressor(encoding)
+        remaining = size
+        received = 0
+        while True:
+            length = NetUtils.HEADER.unpack(NetUtils.recvExact(sock, NetUtils.HEADER.size))[0]
+            if length == 0:
+                break
+            if length > NetUtils.MAX_MESSAGE:
+                raise ValueError('frame too large: %d bytes' % length)
+            data = NetUtils.recvExact(sock, length)
+            received += length
+            if throttle is not None:
+                throttle(length)
+            out = Compression.decompress(decompressor, data, remaining)
+            if out:
+                consumer(out)
+                remaining -= len(out)
+        return received
+
+    #asyncio版本: 向StreamWriter写入一条带长度前缀的JSON消息，调用方负责drain
+    def writeMsg(writer, obj):
+        data = json.dumps(obj).encode('utf-8')
+        writer.write(NetUtils.HEADER.pack(len(data)) + data)
+
+    #asyncio版本: 从StreamReader读取一条带长度前缀的JSON消息，对端在消息边界上关闭时返回None
+    async def readMsg(reader):
+        try:
+            header = await reader.readexactly(NetUtils.HEADER.size)
+        except asyncio.IncompleteReadError as e:
+            if not e.partial:
+                return None
+            raise ConnectionError('connection closed inside a message header')
+        length = NetUtils.HEADER.unpack(header)[0]
+        if length > NetUtils.MAX_MESSAGE:
+            raise ValueError('message too large: %d bytes' % length)
+        try:
+            data = await reader.readexactly(length)
+        except asyncio.IncompleteReadError:
+            raise ConnectionError('connection closed inside a message')
+        return json.loads(data.decode('utf-8'))
@@ -0,0 +1,92 @@
+import time
+import socket
+import threading
+from Utils.NetUtils import NetUtils
+
+class PeerConnection:
+    '''
+    到某个peer的一条长连接，可以在上面流水线式地请求多个块
+    请求: {"name":, "md5":, "blockIdx":, "compress": [可以接受的压缩方式]}
+    响应: {"name":, "blockIdx":, "md5":, "size":, "encoding":}，没有encoding时后面紧跟size字节的块数据，
+          否则后面是压缩后的数据帧，见NetUtils.sendFrames
+    一组小文件可以只发一个请求: {"bundle": [块请求, ...]}，对端按顺序对每一项回复一个上面的响应，整组是一个连续的流
+    '''
+    def __init__(self, addr, timeout=60.0):
+        self.addr = addr
+        self.sock = socket.create_connection(addr, timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.lastUsed = time.monotonic()
+
+    #流水线请求: 最多window个请求在途，响应按请求顺序返回
+    #openSink(request, header)返回接收该块的sink，块数据通过sink.feed写入，收完调用sink.close()
+    #throttle(字节数)用于下载限速，见NetUtils.recvPayload
+    def fetch(self, requests, openSink, window=16, throttle=None):
+        sent = 0
+        received = 0
+        while received < len(requests):
+            while sent < len(requests) and sent - received < window:
+                NetUtils.sendMsg(self.sock, requests[sent])
+                sent += 1
+            self.recvBlock(requests[received], openSink, throttle)
+            received += 1
+        self.lastUsed = time.monotonic()
+
+    #一个请求取回一组小文件(每个文件的0号块)，边收边交给各自的sink写入和校验
+    def fetchBundle(self, requests, openSink, throttle=None):
+        NetUtils.sendMsg(self.sock, {"bundle": requests})
+        for request in requests:
+            self.recvBlock(request, openSink, throttle)
+        self.lastUsed = time.monotonic()
+
+    #接收一个块的响应。openSink检查响应头，返回的sink决定最多写入多少数据(expectedSize)
+    def recvBlock(self, request, openSink, throttle):
+        header = NetUtils.recvMsg(self.sock)
+        if header is None:
+            raise ConnectionError('peer closed the connection')
+        sink = openSink(request, header)
+        size = min(header['size'], sink.expectedSize)
+        if header.get('encoding'):
+            sink.wireBytes = NetUtils.recvFrames(self.sock, sink.expectedSize, header['encoding'], sink.feed, throttle)
+        else:
+            NetUtils.recvPayload(self.sock, size, sink.feed, throttle=throttle)
+            sink.wireBytes = size
+        sink.close()
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class ConnectionPool:
+    '''
+    按peer地址缓存空闲的长连接，避免每个块都重新建立TCP连接和经历慢启动
+    对端空闲60s会关闭连接，所以空闲超过idleTimeout的连接直接丢弃
+    '''
+    def __init__(self, timeout=60.0, idleTimeout=50.0):
+        self.timeout = timeout
+        self.idleTimeout = idleTimeout
+        self.idle = {}          # addr -> [PeerConnection]
+        self.lock = threading.Lock()
+
+    def acquire(self, addr):
+        addr = tuple(addr)
+        now = time.monotonic()
+        with self.lock:
+            conns = self.idle.get(addr, [])
+            while conns:
+                conn = conns.pop()
+                if now - conn.lastUsed < self.idleTimeout:
+                    return conn
+                conn.close()
+        return PeerConnection(addr, self.timeout)
+
+    #用完归还，下次请求同一个peer时复用
+    def release(self, conn):
+        with self.lock:
+            self.idle.setdefault(conn.addr, []).append(conn)
+
+    #连接出错时丢弃，不放回池中
+    def discard(self, conn):
+        conn.close()
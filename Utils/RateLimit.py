@@ -0,0 +1,103 @@
+import time
+import threading
+
+class TokenBucket:
+    '''
+    令牌桶限速，rate是每秒字节数，0表示不限速
+    用"下一个空闲时刻"代替令牌数: 每次预约n字节就把这个时刻往后推n/rate秒，返回调用方需要等待的秒数，
+    桶本身不睡眠，线程版用time.sleep，asyncio版用asyncio.sleep。空闲时最多积攒burst字节的额度
+    urgent的预约(交互式、小文件)只在urgent之间排队，不用等已经预约出去的普通块，
+    它们占用的带宽记在普通块的账上，普通块之后的预约相应推迟，总速率不变
+    '''
+    def __init__(self, rate=0, burst=None):
+        self.lock = threading.Lock()
+        self.nextFree = 0.0         #普通预约的下一个空闲时刻
+        self.urgentFree = 0.0       #urgent预约的下一个空闲时刻
+        self.setRate(rate, burst)
+
+    #运行中修改速率，已经预约出去的不受影响
+    def setRate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst if burst is not None else max(rate / 4, 262144)
+
+    #预约n字节，返回需要等待的秒数
+    def reserve(self, n, urgent=False):
+        rate = self.rate
+        if rate <= 0:
+            return 0.0
+        cost = n / rate
+        with self.lock:
+            now = time.monotonic()
+            floor = now - self.burst / rate         #空闲时积攒的额度不超过burst
+            if urgent:
+                start = max(self.urgentFree, floor)
+                self.urgentFree = start + cost
+                self.nextFree = max(self.nextFree, floor) + cost
+            else:
+                start = max(self.nextFree, floor)
+                self.nextFree = start + cost
+            return max(0.0, start + cost - now)
+
+
+class RateLimiter:
+    '''
+    一个peer的全部限速: 总上传、总下载，以及每个对端peer(按ip)单独的上传、下载限速，都是令牌桶
+    direction是'upload'或'download'。一次传输要同时满足总限速和对端的限速，等待时间取两者中较长的
+    等待时间很短时不睡眠，欠下的额度由后面的数据补上，这样8KB一次的收发也不会每次都切换线程
+    '''
+    MIN_SLEEP = 0.005
+
+    def __init__(self, upload=0, download=0, peerUpload=0, peerDownload=0, smallFile=1048576):
+        self.lock = threading.Lock()
+        self.totals = {'upload': TokenBucket(), 'download': TokenBucket()}
+        self.peers = {'upload': {}, 'download': {}}        # ip -> TokenBucket
+        self.peerRates = {'upload': 0, 'download': 0}
+        self.smallFile = smallFile
+        self.setLimits(upload, download, peerUpload, peerDownload)
+
+    #运行中修改限速(字节/秒)，参数为None的保持不变
+    def setLimits(self, upload=None, download=None, peerUpload=None, peerDownload=None, smallFile=None):
+        with self.lock:
+            for direction, rate in (('upload', upload), ('download', download)):
+                if rate is not None:
+                    self.totals[direction].setRate(rate)
+            for direction, rate in (('upload', peerUpload), ('download', peerDownload)):
+                if rate is not None:
+                    self.peerRates[direction] = rate
+                    for bucket in self.peers[direction].values():
+                        bucket.setRate(rate)
+            if smallFile is not None:
+                self.smallFile = smallFile
+
+    #不超过smallFile的文件的传输优先
+    def isUrgent(self, fileSize):
+        return fileSize <= self.smallFile
+
+    #和peer之间传输n字节需要等待的秒数，不需要睡眠时返回0
+    def reserve(self, direction, peer, n, urgent=False):
+        wait = self.totals[direction].reserve(n, urgent)
+        if self.peerRates[direction] > 0:
+            wait = max(wait, self._peerBucket(direction, peer).reserve(n, urgent))
+        return wait if wait >= RateLimiter.MIN_SLEEP else 0.0
+
+    #线程版: 预约并睡眠
+    def throttle(self, direction, peer, n, urgent=False):
+        wait = self.reserve(direction, peer, n, urgent)
+        if wait > 0:
+            time.sleep(wait)
+
+    #是否有任何限速，没有限速时发送方可以一次sendfile整个块
+    def limited(self, direction):
+        return self.totals[direction].rate > 0 or self.peerRates[direction] > 0
+
+    def _peerBucket(self, direction, peer):
+        buckets = self.peers[direction]
+        bucket = buckets.get(peer[0])
+        if bucket is None:
+            with self.lock:
+                bucket = buckets.get(peer[0])
+                if bucket is None:
+                    bucket = TokenBucket(self.peerRates[direction])
+                    buckets[peer[0]] = bucket
+        return bucket
@@ -0,0 +1,477 @@
+import time
+import heapq
+import random
+import itertools
+import threading
+import logging
+from Utils.Transfer import BlockBitmap
+from Utils.Metrics import REGISTRY
+
+log = logging.getLogger('scheduler')
+
+class FileTask:
+    '''
+    一个待下载的文件。blocks是它的块序号列表，holders是持有这个版本完整文件的peer [(ip, port)]，
+    partials是正在下载这个版本的peer {(ip, port): 块位图}，它们已经收到的块也可以提供给我们
+    have是我们自己已经收到并校验过的块，会宣告给tracker，让别的peer也能从我们这里取这些块
+    reuse是可以直接从本地文件拷贝的块 {块序号: (本地文件名, 偏移)}，它们不在blocks中，不需要下载
+    done是重启前已经收到的块(来自下载日志)，它们也不在blocks中
+    fd是预分配的临时文件，由第一次取到它的块的工作线程打开，整个文件完成或放弃后关闭
+    '''
+    def __init__(self, name, info, blocks, holders, partials=(), reuse=None, done=()):
+        self.name = name
+        self.info = info
+        self.blocks = list(blocks)
+        self.reuse = dict(reuse) if reuse else {}
+        self.count = info['blockNum'] or 1          #文件的总块数
+        self.setSources(holders, partials)
+        self.size = info['size']
+        self.remaining = len(self.blocks)
+        self.have = BlockBitmap(self.count)
+        for idx in done:
+            self.have.set(idx)
+        #每个peer从随机的位置开始按顺序取块，同时下载同一个文件的peer手上的块就各不相同，可以互相交换
+        self.rotation = random.randrange(self.count)
+        self.inFlight = 0
+        self.attempts = {}          # 块序号 -> 失败次数
+        self.badPeers = {}          # 块序号 -> 这个块失败过的peer集合，重试时优先换别的持有者
+        self.fileAttempts = 0       # 整个文件校验失败的次数
+        self.aborted = False
+        self.fd = None
+        self.lock = threading.Lock()
+
+    #partials是tracker回复中的[[ip, port, 块位图], ...]
+    def setSources(self, holders, partials):
+        self.holders = [tuple(holder) for holder in holders]
+        self.partials = {}
+        for ip, port, bitmap in partials:
+            self.partials[(ip, port)] = BlockBitmap.fromHex(self.count, bitmap)
+
+    #peer能否提供第idx块
+    def canServe(self, peer, idx):
+        if peer in self.holders:
+            return True
+        bitmap = self.partials.get(peer)
+        return bitmap is not None and bitmap.has(idx)
+
+    #能提供第idx块的所有peer
+    def sourcesOf(self, idx):
+        sources = list(self.holders)
+        for peer, bitmap in self.partials.items():
+            if bitmap.has(idx):
+                sources.append(peer)
+        return sources
+
+    #块在优先队列中的排序位置
+    def order(self, idx):
+        pos = idx - 1 if idx > 0 else 0
+        return (pos - self.rotation) % self.count
+
+
+class FileBundle:
+    '''
+    一组从同一个peer一次取回的小文件，每个文件只有一个0号块。整组只发一个请求，
+    对端在一个流里依次发回每个文件(带大小和hash)，所以整组在全局和该peer的在途数中只算一个
+    '''
+    def __init__(self, tasks):
+        self.tasks = tasks
+
+
+class DownloadScheduler:
+    '''
+    下载调度器: 所有需要下载的块排成一个优先队列，由固定数量的工作线程取出执行
+    - 小文件优先，同一个文件的块排在一起，让文件尽快一个个完成，而不是所有文件都下到一半
+    - 全局在途块数不超过maxInFlight，每个来源peer的在途块数不超过maxPerPeer
+    - 一个文件的块分散到它的所有来源上(完整文件的持有者，以及已经有这个块的正在下载的peer):
+      每次取块时选预计最快完成的来源(在途块数/实测速度)，
+      一次最多取batchSize个同一文件的连续块，在到该来源的一条连接上流水线请求
+    - 不超过bundleFileBytes的不分块小文件，同一个来源能提供的合成一组(FileBundle)一次取回，
+      每组最多bundleFiles个文件、bundleBytes字节，省掉每个文件一次请求往返的开销
+    - 来源都满了的块暂存到其中一个满了的来源下(waiting)，等它有块完成腾出空位时再考虑，
+      不用每次取块都把排在前面取不了的块全部取出又放回
+    - 块失败后先立即换一个没失败过的持有者重试；所有持有者都失败过才按指数退避(带随机抖动)延后重试，
+      失败maxAttempts次后放弃整个文件，由下一次sync重新发起
+    '''
+    def __init__(self, workers=8, maxInFlight=64, maxPerPeer=16, batchSize=8,
+                 maxAttempts=8, baseDelay=1.0, maxDelay=60.0, notify=None,
+                 bundleFiles=64, bundleBytes=8388608, bundleFileBytes=1048576):
+        self.workers = workers
+        self.maxInFlight = maxInFlight
+        self.maxPerPeer = maxPerPeer
+        self.batchSize = batchSize
+        self.bundleFiles = bundleFiles
+        self.bundleBytes = bundleBytes
+        self.bundleFileBytes = bundleFileBytes
+        self.maxAttempts = maxAttempts
+        self.baseDelay = baseDelay
+        self.maxDelay = maxDelay
+        self.notify = notify            #有新任务可取时的回调，asyncio版用它唤醒协程
+
+        self.ready = []                 # 堆: (文件大小, 文件序号, 块的排序位置, 块序号, task)
+        self.delayed = []               # 堆: (可以重试的时间, 序号, ready中的条目)
+        self.waiting = {}               # (ip, port) -> 堆: 来源都满了而暂存的ready条目；None下是没有来源的条目
+        self.inFlight = 0
+        self.peerInFlight = {}          # (ip, port) -> 在途块数
+        self.peerSpeed = {}             # (ip, port) -> 实测下载速度(字节/秒)的滑动平均
+        self.tasks = {}                 # 文件名 -> 排队中的task
+        self.seq = itertools.count()
+        self.cond = threading.Condition()
+
+        #队列深度直接读调度器的状态，不加锁，只是用于观察
+        REGISTRY.gauge('scheduler_ready_blocks', 'blocks waiting for a worker', fn=lambda: len(self.ready))
+        REGISTRY.gauge('scheduler_waiting_blocks', 'blocks whose sources are all busy',
+                       fn=lambda: sum(len(queue) for queue in list(self.waiting.values())))
+        REGISTRY.gauge('scheduler_delayed_blocks', 'blocks waiting out a retry backoff', fn=lambda: len(self.delayed))
+        REGISTRY.gauge('scheduler_inflight_blocks', 'blocks being downloaded', fn=lambda: self.inFlight)
+        REGISTRY.gauge('scheduler_tasks', 'files queued for download', fn=lambda: len(self.tasks))
+        self.failedBlocks = REGISTRY.counter('scheduler_failed_blocks_total', 'block downloads that failed and were retried')
+        self.abortedFiles = REGISTRY.counter('scheduler_aborted_files_total', 'files given up after too many failures')
+        self.bundles = REGISTRY.counter('scheduler_bundles_total', 'bundles of small files taken')
+        self.bundledFiles = REGISTRY.counter('scheduler_bundled_files_total', 'small files fetched in bundles')
+
+    def submit(self, task):
+        with self.cond:
+            task.seq = next(self.seq)
+            self.tasks[task.name] = task
+            for idx in task.blocks:
+                heapq.heappush(self.ready, self._entry(task, idx))
+            self._wake()
+
+    #取出一批可以执行的块，返回(task, 来源peer, [块序号])；一组小文件返回(FileBundle, 来源peer, [0])
+    #block为False时没有可执行的块直接返回None
+    def take(self, block=True):
+        with self.cond:
+            while True:
+                batch = self._take()
+                if batch is not None or not block:
+                    return batch
+                timeout = None
+                if self.delayed:
+                    timeout = max(0, self.delayed[0][0] - time.monotonic())
+                self.cond.wait(timeout)
+
+    #一批块执行完毕。返回'done'表示整个文件的块都已收到，调用方应校验文件后调用finished；
+    #返回'aborted'表示文件已被放弃且没有在途的块了，调用方应清理临时文件
+    def complete(self, task, peer, idxs, failed):
+        with self.cond:
+            self.inFlight -= len(idxs)
+            self._releasePeer(peer, len(idxs))
+            state = self._complete(task, peer, idxs, failed)
+            self._wake()
+            return state
+
+    #一组小文件执行完毕，failed是没有成功收到的task。返回[(task, 状态)]，状态和complete的返回值相同
+    def completeBundle(self, bundle, peer, failed):
+        with self.cond:
+            self.inFlight -= 1
+            self._releasePeer(peer, 1)
+            states = [(task, self._complete(task, peer, [0], [0] if task in failed else []))
+                      for task in bundle.tasks]
+            self._wake()
+            return states
+
+    #整个文件校验完毕。校验失败时整个文件退避后重新排队，返回False表示重试次数用完，文件被放弃
+    def finished(self, task, ok):
+        with self.cond:
+            if ok:
+                self._forget(task)
+                return True
+            task.fileAttempts += 1
+            if task.fileAttempts >= self.maxAttempts:
+                self.abortedFiles.inc()
+                task.aborted = True
+                self._forget(task)
+                return False
+            #本地拷贝的块和重启前收到的块都不再可信，重试时所有块都从网络下载
+            task.blocks = [0] if task.info['blockNum'] == 0 else list(range(1, task.count + 1))
+            task.reuse = {}
+            task.remaining = len(task.blocks)
+            task.attempts = {}
+            task.badPeers = {}
+            task.have.clear()
+            notBefore = time.monotonic() + self.backoff(task.fileAttempts)
+            for idx in task.blocks:
+                self._delay(task, idx, notBefore)
+            self._wake()
+            return True
+
+    #目录中文件的持有者变了: 同一版本就更新持有者列表，新加入的持有者马上可以分担块；
+    #版本变了或文件已从目录中删除(info为None)就放弃正在下载的旧版本。返回task时调用方应清理它的临时文件
+    def updateTask(self, name, info):
+        with self.cond:
+            task = self.tasks.get(name)
+            if task is None or task.aborted:
+                return None
+            if info is None or info['mtime'] != task.info['mtime'] or info['md5'] != task.info['md5']:
+                task.aborted = True
+                self._forget(task)
+            else:
+                task.setSources(info['holders'], info.get('partials', ()))
+                #之前没有来源的块现在可能有了
+                for entry in self.waiting.pop(None, ()):
+                    heapq.heappush(self.ready, entry)
+                self._wake()
+            if task.aborted and task.inFlight == 0:
+                return task
+            return None
+
+    #正在下载的文件，块服务用它把已经收到的块提供给别的peer
+    def getTask(self, name):
+        with self.cond:
+            return self.tasks.get(name)
+
+    #已经收到部分块的多块文件，用于宣告
+    def partialTasks(self):
+        with self.cond:
+            return [task for task in self.tasks.values()
+                    if not task.aborted and task.info['blockNum'] > 0 and task.have.any()]
+
+    #从本地旧版本拷贝的块已经写入临时文件，可以提供给别的peer了
+    def markHave(self, task, idxs):
+        with self.cond:
+            for idx in idxs:
+                task.have.set(idx)
+
+    #本地拷贝后校验失败的块，改为从网络下载
+    def addBlocks(self, task, idxs):
+        with self.cond:
+            for idx in idxs:
+                task.reuse.pop(idx, None)
+                task.blocks.append(idx)
+                task.remaining += 1
+                heapq.heappush(self.ready, self._entry(task, idx))
+            self._wake()
+
+    #记录一次从peer下载的耗时，用于挑选持有者
+    def recordSpeed(self, peer, nbytes, seconds, alpha=0.3):
+        if seconds <= 0 or nbytes <= 0:
+            return
+        speed = nbytes / seconds
+        with self.cond:
+            old = self.peerSpeed.get(peer)
+            self.peerSpeed[peer] = speed if old is None else old * (1 - alpha) + speed * alpha
+
+    #第attempts次失败后的等待时间
+    def backoff(self, attempts):
+        delay = min(self.maxDelay, self.baseDelay * (2 ** (attempts - 1)))
+        return delay * (0.5 + random.random() / 2)
+
+    #启动固定数量的工作线程。fetch(task, peer, idxs)返回失败的块序号，fetchBundle(tasks, peer)返回失败的task，
+    #finish(task)校验并完成文件返回是否成功，abort(task)清理被放弃的文件
+    def start(self, fetch, finish, abort, fetchBundle):
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, args=(fetch, finish, abort, fetchBundle), daemon=True).start()
+
+    def _worker(self, fetch, finish, abort, fetchBundle):
+        while True:
+            task, peer, idxs = self.take()
+            if isinstance(task, FileBundle):
+                try:
+                    failed = fetchBundle(task.tasks, peer)
+                except Exception as e:
+                    log.exception('Download error: %s', e)
+                    failed = task.tasks
+                states = self.completeBundle(task, peer, failed)
+            else:
+                try:
+                    failed = fetch(task, peer, idxs)
+                except Exception as e:
+                    log.exception('Download error: %s', e)
+                    failed = idxs
+                states = [(task, self.complete(task, peer, idxs, failed))]
+            #完成或放弃文件时出错(比如fsync、写下载日志失败)也不能让工作线程退出，当作这次完成失败
+            for task, state in states:
+                if state == 'done':
+                    try:
+                        ok = finish(task)
+                    except Exception as e:
+                        log.exception('Finish error: %s', e)
+                        ok = False
+                    if not self.finished(task, ok):
+                        self._abort(abort, task)
+                elif state == 'aborted':
+                    self._abort(abort, task)
+
+    #放弃文件，清理时出错只记录下来
+    def _abort(self, abort, task):
+        try:
+            abort(task)
+        except Exception as e:
+            log.exception('Abort error: %s', e)
+
+    #下面的方法由调用方持锁
+    def _take(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            heapq.heappush(self.ready, heapq.heappop(self.delayed)[2])
+        if self.inFlight >= self.maxInFlight:
+            return None
+
+        while True:
+            queue = self._nextQueue()
+            if queue is None:
+                return None
+            entry = heapq.heappop(queue)
+            task = entry[4]
+            if task.aborted:
+                continue
+            peer = self._choosePeer(task, entry[3])
+            if peer is not None:
+                break
+            self._park(task, entry)         #持有者都满了，先看后面别的文件的块
+
+        if self._bundled(task):
+            skipped = []
+            bundle = self._takeBundle(task, peer, queue, skipped)
+            for other in skipped:
+                heapq.heappush(queue, other)
+            if bundle is not None:
+                return bundle, peer, [0]
+        #一批不超过文件块数/来源数，保证块能分散到所有来源
+        share = -(-len(task.blocks) // max(1, len(task.holders) + len(task.partials)))
+        room = min(self.batchSize, share, self.maxPerPeer - self.peerInFlight.get(peer, 0),
+                   self.maxInFlight - self.inFlight)
+        batch = [entry[3]]
+        while queue and len(batch) < room and queue[0][4] is task \
+                and task.canServe(peer, queue[0][3]) \
+                and peer not in task.badPeers.get(queue[0][3], ()):
+            batch.append(heapq.heappop(queue)[3])
+
+        self.inFlight += len(batch)
+        task.inFlight += len(batch)
+        self.peerInFlight[peer] = self.peerInFlight.get(peer, 0) + len(batch)
+        return task, peer, batch
+
+    #排在最前面的块所在的队列: ready，或者某个有空位的peer下暂存的块，都没有时返回None
+    def _nextQueue(self):
+        best = self.ready if self.ready else None
+        for peer, queue in self.waiting.items():
+            if queue and peer is not None and self.peerInFlight.get(peer, 0) < self.maxPerPeer \
+                    and (best is None or queue[0][:4] < best[0][:4]):
+                best = queue
+        return best
+
+    #块的来源都满了: 暂存到其中一个满了的来源下，它有在途的块，完成后腾出空位时这些块会重新被考虑。
+    #没有来源的块暂存到None下，持有者列表更新时放回ready
+    def _park(self, task, entry):
+        key = None
+        for source in task.sourcesOf(entry[3]):
+            if self.peerInFlight.get(source, 0) >= self.maxPerPeer:
+                key = source
+                break
+        heapq.heappush(self.waiting.setdefault(key, []), entry)
+
+    #为task的第idx块挑一个持有者(完整文件的持有者，或者已经有这个块的正在下载的peer): 跳过这个块失败过的和在途块数已满的，
+    #剩下的按(在途块数+1)/实测速度取最小，即预计最早完成的。没测过速度的按已知最快的算，让新peer有机会被试用
+    def _choosePeer(self, task, idx):
+        sources = task.sourcesOf(idx)
+        bad = task.badPeers.get(idx, ())
+        if all(source in bad for source in sources):
+            bad = ()                #持有者列表更新过，失败记录已经没有意义
+        default = max(self.peerSpeed.values()) if self.peerSpeed else 1.0
+        best = None
+        bestCost = None
+        for holder in sources:
+            inFlight = self.peerInFlight.get(holder, 0)
+            if holder in bad or inFlight >= self.maxPerPeer:
+                continue
+            cost = (inFlight + 1) / self.peerSpeed.get(holder, default)
+            if best is None or cost < bestCost:
+                best = holder
+                bestCost = cost
+        return best
+
+    #小文件可以和别的小文件合成一组下载
+    def _bundled(self, task):
+        return self.bundleFiles > 1 and task.info['blockNum'] == 0 and task.size <= self.bundleFileBytes
+
+    #task是刚从queue中取出的小文件，再从queue中取出peer也能提供的小文件，凑成一组。
+    #队列按文件大小排序，小文件都在前面，遇到大文件就停止；peer不能提供的放入skipped，之后放回queue
+    #凑不成一组(只有task一个)时返回None，按普通的块下载
+    def _takeBundle(self, task, peer, queue, skipped):
+        tasks = [task]
+        total = task.size
+        scanned = 0
+        while queue and len(tasks) < self.bundleFiles and scanned < 4 * self.bundleFiles:
+            entry = queue[0]
+            other = entry[4]
+            if not other.aborted and not self._bundled(other):
+                break
+            if not other.aborted and total + other.size > self.bundleBytes:
+                break
+            heapq.heappop(queue)
+            scanned += 1
+            if other.aborted:
+                continue
+            if not other.canServe(peer, 0) or peer in other.badPeers.get(0, ()):
+                skipped.append(entry)
+                continue
+            tasks.append(other)
+            total += other.size
+        if len(tasks) == 1:
+            return None
+        self.inFlight += 1
+        self.peerInFlight[peer] = self.peerInFlight.get(peer, 0) + 1
+        for task in tasks:
+            task.inFlight += 1
+        self.bundles.inc()
+        self.bundledFiles.inc(len(tasks))
+        return FileBundle(tasks)
+
+    #由调用方持锁。一批块执行完毕后更新task，返回task的状态
+    def _complete(self, task, peer, idxs, failed):
+        task.inFlight -= len(idxs)
+        task.remaining -= len(idxs) - len(failed)
+        for idx in idxs:
+            if idx not in failed:
+                task.have.set(idx)
+
+        now = time.monotonic()
+        self.failedBlocks.inc(len(failed))
+        for idx in failed:
+            attempts = task.attempts.get(idx, 0) + 1
+            task.attempts[idx] = attempts
+            if attempts >= self.maxAttempts:
+                log.warning('%s[%d] failed %d times, giving up', task.name, idx, attempts)
+                self.abortedFiles.inc()
+                task.aborted = True
+                self._forget(task)
+                break
+            bad = task.badPeers.setdefault(idx, set())
+            bad.add(peer)
+            if any(source not in bad for source in task.sourcesOf(idx)):
+                heapq.heappush(self.ready, self._entry(task, idx))   #马上换一个持有者
+            else:
+                bad.clear()         #所有持有者都试过了，退避之后从头再来
+                self._delay(task, idx, now + self.backoff(attempts))
+        return self._state(task)
+
+    #task的状态: 所有块都收到了返回'done'，被放弃且没有在途块了返回'aborted'
+    def _state(self, task):
+        if task.aborted:
+            return 'aborted' if task.inFlight == 0 else None
+        if task.remaining == 0:
+            return 'done'
+        return None
+
+    def _forget(self, task):
+        if self.tasks.get(task.name) is task:
+            del self.tasks[task.name]
+
+    def _entry(self, task, idx):
+        return (task.size, task.seq, task.order(idx), idx, task)
+
+    def _delay(self, task, idx, notBefore):
+        heapq.heappush(self.delayed, (notBefore, next(self.seq), self._entry(task, idx)))
+
+    def _releasePeer(self, peer, count):
+        left = self.peerInFlight.get(peer, 0) - count
+        if left > 0:
+            self.peerInFlight[peer] = left
+        else:
+            self.peerInFlight.pop(peer, None)
+
+    def _wake(self):
+        self.cond.notify_all()
+        if self.notify is not None:
+            self.notify()
@@ -0,0 +1,169 @@
+import time
+import bisect
+import socket
+import hashlib
+import threading
+from Utils.NetUtils import NetUtils
+
+class HashRing:
+    '''
+    一致性hash环: 每个分片在环上放replicas个虚拟节点，文件名顺时针落到的第一个虚拟节点所属的分片负责它
+    增减一个分片只会移动大约1/N的文件，其它文件仍在原来的分片上
+    nodes是分片的名字(地址)，环只和名字有关，所有路由器用同样的分片列表就得到同样的划分
+    '''
+    def __init__(self, nodes, replicas=100):
+        self.nodes = list(nodes)
+        points = []
+        for index, node in enumerate(self.nodes):
+            for i in range(replicas):
+                points.append((HashRing.hashOf('%s#%d' % (node, i)), index))
+        points.sort()
+        self.keys = [point[0] for point in points]
+        self.owners = [point[1] for point in points]
+        #分片列表的标识，放在回复给peer的版本号里，分片列表变了peer手上的版本号就失效
+        self.id = hashlib.md5('\n'.join(self.nodes).encode('utf-8')).hexdigest()[:8]
+
+    def hashOf(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    #负责name的分片序号
+    def shardOf(self, name):
+        pos = bisect.bisect(self.keys, HashRing.hashOf(name))
+        return self.owners[pos % len(self.owners)]
+
+
+class ShardRouter:
+    '''
+    分片tracker的路由: 目录按文件名的一致性hash分到多个tracker(分片)上，每个分片就是一个普通的Tracker，
+    只保存分给它的文件。一条宣告按文件名拆开，同时发给所有分片(没有文件的分片收到的就是心跳，peer在每个分片上都保持存活)，
+    再把各分片的回复合并成一条回复，peer看到的协议和单个tracker完全一样
+    回复给peer的版本号是 "环标识;分片0的版本号;分片1的版本号;..."，下次宣告时再拆开发给各个分片
+    到每个分片的连接放在连接池里，多个peer的宣告可以并发地经过同一个路由器
+    '''
+    IDLE = 60               #连接池中空闲超过这么多秒的连接不再使用，分片那边可能已经超时关闭了它
+
+    def __init__(self, shards, timeout=180):
+        self.shards = list(shards)          # [(host, port)]
+        self.timeout = timeout
+        self.ring = HashRing(['%s:%d' % (host, port) for host, port in self.shards])
+        self.idle = [[] for shard in self.shards]       # 每个分片的空闲连接 [(socket, 归还时间)]
+        self.lock = threading.Lock()
+
+    #把一条宣告转发给各个分片并合并回复。ip是peer的地址，分片看到的连接来自路由器，需要告诉它peer是谁
+    #某个分片连不上时抛出异常，peer会断开连接，下次重新全量宣告
+    def route(self, request, ip=None):
+        full = request.get('full', False)
+        tokens = self.splitToken(request.get('version'))
+        if tokens is None:
+            if not full:
+                #分片列表变了，旧版本号对应的分片已经不是现在的分片，增量宣告也可能发到了错误的分片
+                return {'resync': True, 'hash': request.get('hash', 'md5')}
+            tokens = [None] * len(self.shards)
+
+        files = [[] for shard in self.shards]
+        removed = [[] for shard in self.shards]
+        for info in request.get('files', []):
+            files[self.ring.shardOf(info['name'])].append(info)
+        for name in request.get('removed', []):
+            removed[self.ring.shardOf(name)].append(name)
+        messages = []
+        for index in range(len(self.shards)):
+            message = {'port': request['port'], 'version': tokens[index], 'full': full,
+                       'files': files[index], 'removed': removed[index], 'hash': request.get('hash', 'md5')}
+            if ip is not None:
+                message['ip'] = ip
+            messages.append(message)
+        replies = self.exchange(list(enumerate(messages)))
+
+        for reply in replies:
+            if reply.get('resync'):
+                return {'resync': True, 'hash': reply.get('hash', request.get('hash', 'md5'))}
+        #合并后的回复要么全是增量，要么全是全量。只有部分分片回复了全量(分片重启过或者变化记录被挤出)时，
+        #其它分片也要全量目录，用一个不带变化的心跳去取
+        partial = [index for index, reply in enumerate(replies) if not reply['full']]
+        if len(partial) < len(replies) and partial:
+            again = self.exchange([(index, dict(messages[index], version=None, files=[], removed=[], full=False))
+                                   for index in partial])
+            for index, reply in zip(partial, again):
+                if reply.get('resync'):
+                    return {'resync': True, 'hash': reply.get('hash', request.get('hash', 'md5'))}
+                replies[index] = reply
+
+        merged = {}
+        mergedRemoved = []
+        for reply in replies:
+            merged.update(reply['files'])
+            mergedRemoved.extend(reply['removed'])
+        version = ';'.join([self.ring.id] + [reply['version'] for reply in replies])
+        return {'version': version, 'full': replies[0]['full'], 'files': merged, 'removed': mergedRemoved,
+                'you': replies[0]['you'], 'hash': replies[0]['hash']}
+
+    #把peer的版本号拆成各个分片的版本号。首次连接返回全None，分片列表不符返回None
+    def splitToken(self, token):
+        if not token:
+            return [None] * len(self.shards)
+        parts = str(token).split(';')
+        if parts[0] != self.ring.id or len(parts) != len(self.shards) + 1:
+            return None
+        return parts[1:]
+
+    #targets是[(分片序号, 消息)]，返回各分片的回复。先全部发出再逐个接收，各分片并行处理
+    def exchange(self, targets):
+        conns = []
+        try:
+            for index, message in targets:
+                conn, reused = self._checkout(index)
+                try:
+                    NetUtils.sendMsg(conn, message)
+                except (socket.error, ConnectionError):
+                    if not reused:
+                        conn.close()
+                        raise
+                    #池里的旧连接已经被分片关闭了，换一条新连接
+                    conn.close()
+                    conn, reused = self._connect(index), False
+                    NetUtils.sendMsg(conn, message)
+                conns.append([index, conn, reused])
+            replies = []
+            for entry, (index, message) in zip(conns, targets):
+                try:
+                    reply = self._recv(entry)
+                except (socket.error, ConnectionError):
+                    if not entry[2]:
+                        raise
+                    entry[1].close()
+                    entry[1], entry[2] = self._connect(index), False
+                    NetUtils.sendMsg(entry[1], message)
+                    reply = self._recv(entry)
+                replies.append(reply)
+        except BaseException:
+            for index, conn, reused in conns:
+                conn.close()
+            raise
+        for index, conn, reused in conns:
+            self._checkin(index, conn)
+        return replies
+
+    def _recv(self, entry):
+        reply = NetUtils.recvMsg(entry[1])
+        if reply is None:
+            raise ConnectionError('shard %s:%d closed the connection' % self.shards[entry[0]])
+        return reply
+
+    def _checkout(self, index):
+        now = time.monotonic()
+        with self.lock:
+            conns = self.idle[index]
+            while conns:
+                conn, returned = conns.pop()
+                if now - returned < ShardRouter.IDLE:
+                    return conn, True
+                conn.close()
+        return self._connect(index), False
+
+    def _checkin(self, index, conn):
+        with self.lock:
+            self.idle[index].append((conn, time.monotonic()))
+
+    def _connect(self, index):
+        return socket.create_connection(self.shards[index], self.timeout)
@@ -0,0 +1,61 @@
+import os
+from Utils.IOUtils import IOUtils
+
+class BlockSink:
+    '''
+    接收一个块: 收到的数据直接pwrite到目标文件中该块的偏移处，同时用algo算法计算hash
+    close之后ok表示块数据完整且hash和预期的一致，这时调用onDone()
+    '''
+    def __init__(self, fd, offset, expectedMD5, expectedSize, onDone=None, algo='md5'):
+        self.fd = fd
+        self.onDone = onDone
+        self.offset = offset
+        self.expectedMD5 = expectedMD5
+        self.expectedSize = expectedSize
+        self.received = 0
+        self.wireBytes = 0          #网络上实际收到的字节数，压缩传输时小于received
+        self.md5 = IOUtils.newHash(algo)
+        self.ok = False
+
+    def feed(self, data):
+        os.pwrite(self.fd, data, self.offset + self.received)
+        self.md5.update(data)
+        self.received += len(data)
+
+    def close(self):
+        self.ok = self.received == self.expectedSize and self.md5.hexdigest() == self.expectedMD5
+        if self.ok and self.onDone is not None:
+            self.onDone()
+
+
+class BlockBitmap:
+    '''
+    文件的块位图，记录已经收到并校验过的块。块序号从1开始(不分块的文件只有0号块，对应第0位)
+    用十六进制字符串在宣告消息中传输
+    '''
+    def __init__(self, count, bits=None):
+        self.count = count
+        self.bits = bytearray(bits) if bits is not None else bytearray((count + 7) // 8)
+
+    def fromHex(count, text):
+        return BlockBitmap(count, bytes.fromhex(text))
+
+    def toHex(self):
+        return self.bits.hex()
+
+    def _pos(idx):
+        return idx - 1 if idx > 0 else 0
+
+    def set(self, idx):
+        pos = BlockBitmap._pos(idx)
+        self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def has(self, idx):
+        pos = BlockBitmap._pos(idx)
+        return pos < self.count and bool(self.bits[pos >> 3] & (1 << (pos & 7)))
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+
+    def any(self):
+        return any(self.bits)
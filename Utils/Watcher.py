@@ -0,0 +1,122 @@
+import os
+import struct
+import ctypes
+import ctypes.util
+import threading
+import logging
+
+log = logging.getLogger('watcher')
+
+class DirectoryWatcher:
+    '''
+    用Linux inotify监视共享目录及其所有子目录，有文件或目录新建、写完关闭、删除、改名或改mtime时
+    调用onChange([相对路径])，路径用/分隔。不监视每次写入(IN_MODIFY)，否则追加中的文件每写一次都要重新hash一遍，
+    一直写着不关闭的文件由调用方定期的深度扫描发现。inotify本身不递归，所以每个子目录单独添加监视，新建的子目录随时补上
+    通过ctypes直接调用libc的inotify_init1/inotify_add_watch，不依赖第三方库
+    事件队列溢出时调用onChange(None)，表示有事件丢失，调用方应该全量扫描一次
+    不支持inotify的平台上start()返回False，调用方继续每次心跳都全量扫描
+    '''
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    IN_CLOEXEC = 0o2000000
+    EVENT = struct.Struct('iIII')       # wd, mask, cookie, len，后面跟len字节的文件名
+
+    def __init__(self, path, onChange, ignoreDirs=('MEtemp', '__pycache__')):
+        self.path = path
+        self.onChange = onChange
+        self.ignoreDirs = set(ignoreDirs)
+        self.fd = None
+        self.libc = None
+        self.watches = {}           # wd -> 相对目录
+        self.running = False
+
+    #开始监视，成功返回True
+    def start(self):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = libc.inotify_init1(DirectoryWatcher.IN_CLOEXEC)
+        except (OSError, AttributeError):
+            return False
+        if fd < 0:
+            return False
+        self.fd = fd
+        self.libc = libc
+        if not self._addTree(''):
+            os.close(fd)
+            self.fd = None
+            return False
+        self.running = True
+        threading.Thread(target=self._run, daemon=True).start()
+        return True
+
+    #监视rel目录及其所有子目录。已经监视的目录(例如改名之后)返回同一个wd，只更新它的路径
+    #超过系统的监视数上限(fs.inotify.max_user_watches)时返回False
+    def _addTree(self, rel):
+        mask = DirectoryWatcher.IN_ATTRIB | DirectoryWatcher.IN_CLOSE_WRITE \
+            | DirectoryWatcher.IN_MOVED_FROM | DirectoryWatcher.IN_MOVED_TO \
+            | DirectoryWatcher.IN_CREATE | DirectoryWatcher.IN_DELETE
+        stack = [rel]
+        while stack:
+            rel = stack.pop()
+            path = self.path + os.sep + rel.replace('/', os.sep) if rel else self.path
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+            if wd < 0:
+                errno = ctypes.get_errno()
+                if errno in (2, 20):            #ENOENT, ENOTDIR: 目录已经又被删掉了
+                    continue
+                log.warning('inotify_add_watch failed: %s', os.strerror(errno))
+                return False
+            self.watches[wd] = rel
+            try:
+                with os.scandir(path) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False) and entry.name not in self.ignoreDirs:
+                            stack.append(rel + '/' + entry.name if rel else entry.name)
+            except OSError:
+                pass
+        return True
+
+    #阻塞读取事件，一次read可能包含多个事件，整批交给onChange
+    def _run(self):
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except OSError as e:
+                log.error('inotify read failed: %s', e)
+                self.running = False
+                self.onChange(None)
+                return
+            names = set()
+            overflow = False
+            pos = 0
+            while pos + DirectoryWatcher.EVENT.size <= len(data):
+                wd, mask, cookie, length = DirectoryWatcher.EVENT.unpack_from(data, pos)
+                pos += DirectoryWatcher.EVENT.size
+                name = data[pos:pos + length].rstrip(b'\0')
+                pos += length
+                if mask & DirectoryWatcher.IN_Q_OVERFLOW:
+                    overflow = True
+                    continue
+                if mask & DirectoryWatcher.IN_IGNORED:
+                    self.watches.pop(wd, None)          #目录被删除，内核自动移除了监视
+                    continue
+                parent = self.watches.get(wd)
+                if parent is None or not name:
+                    continue
+                name = os.fsdecode(name)
+                if name in self.ignoreDirs and mask & DirectoryWatcher.IN_ISDIR:
+                    continue
+                rel = parent + '/' + name if parent else name
+                names.add(rel)
+                if mask & DirectoryWatcher.IN_ISDIR and mask & (DirectoryWatcher.IN_CREATE | DirectoryWatcher.IN_MOVED_TO):
+                    if not self._addTree(rel):
+                        overflow = True             #监视数不够了，只能退回定期全量扫描
+                        self.running = False
+            self.onChange(None if overflow else sorted(names))
@@ -0,0 +1,325 @@
+#!/usr/bin/python3
+#==============================================================================
+#usage           :python3 benchmark.py [options]
+#python_version  :3.5
+#==============================================================================
+#本机回环基准测试: 在127.0.0.1上启动一个tracker和N个peer，每个进程在自己的临时目录中运行
+#(peer共享的就是它的程序所在的目录)，给第一个peer准备测试数据，测量所有peer收敛所需的时间、
+#总吞吐量、tracker每次心跳的CPU时间、各进程的内存峰值和线程数，结果输出为json，可以和之前的结果比较
+import os, sys, json, time, shutil, socket, random, hashlib, tempfile, platform, subprocess, optparse
+import urllib.request
+
+REPO = os.path.dirname(os.path.abspath(__file__))
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+
+
+#找一个空闲的tcp端口
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+#把程序拷贝到一个单独的目录
+def install(directory, script):
+    os.makedirs(directory)
+    shutil.copy(os.path.join(REPO, script), directory)
+    shutil.copytree(os.path.join(REPO, 'Utils'), os.path.join(directory, 'Utils'),
+                    ignore=shutil.ignore_patterns('__pycache__'))
+
+
+def write_random(path, size, rng, chunk=1048576):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as file:
+        while size > 0:
+            n = min(chunk, size)
+            file.write(rng.getrandbits(n * 8).to_bytes(n, 'little'))
+            size -= n
+
+
+#生成测试数据，返回[相对路径]
+#small: 很多小文件，分散在多级子目录中；huge: 少量大文件；modified: 中等大小的文件，所有peer一开始都有，之后在第一个peer上修改
+def make_dataset(root, kind, files, fileBytes, rng):
+    names = []
+    for i in range(files):
+        if kind == 'small':
+            name = 'd%02d/e%02d/f%05d.bin' % (i % 16, (i // 16) % 8, i)
+        else:
+            name = '%s%03d.bin' % (kind, i)
+        write_random(os.path.join(root, name), fileBytes, rng)
+        names.append(name)
+    return names
+
+
+#修改数据: 每个文件中间覆盖一段，结尾追加一段，大部分块保持不变
+def modify_dataset(root, names, rng, patchBytes=65536):
+    changed = 0
+    for name in names:
+        path = os.path.join(root, name)
+        size = os.path.getsize(path)
+        with open(path, 'r+b') as file:
+            file.seek(rng.randrange(max(1, size - patchBytes)))
+            file.write(os.urandom(patchBytes))
+            file.seek(0, os.SEEK_END)
+            file.write(os.urandom(patchBytes))
+        changed += size + patchBytes
+    return changed
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as file:
+        while True:
+            data = file.read(4194304)
+            if not data:
+                break
+            md5.update(data)
+    return md5.hexdigest()
+
+
+#期望的结果: 相对路径 -> (size, mtime)，peer完成一个文件时会把mtime设置成来源的mtime(目录中的mtime精确到秒)
+def manifest(root, names):
+    result = {}
+    for name in names:
+        stat = os.stat(os.path.join(root, name))
+        result[name] = (stat.st_size, stat.st_mtime)
+    return result
+
+
+#peer的目录和期望的结果是否一致，只比较大小和mtime，最后再统一校验内容
+def converged(root, expected):
+    for name, (size, mtime) in expected.items():
+        try:
+            stat = os.stat(os.path.join(root, name))
+        except OSError:
+            return False
+        if stat.st_size != size or int(stat.st_mtime) != int(mtime):
+            return False
+    return True
+
+
+class Process:
+    '''一个被测进程，采样它的CPU时间、内存峰值和线程数(读/proc，其他平台上这些值为None)'''
+    def __init__(self, name, args, cwd, logPath):
+        self.name = name
+        self.log = open(logPath, 'wb')
+        self.popen = subprocess.Popen(args, cwd=cwd, stdout=self.log, stderr=subprocess.STDOUT)
+        self.peakThreads = None
+        self.peakRSS = None
+
+    def cpu(self):
+        try:
+            with open('/proc/%d/stat' % self.popen.pid) as file:
+                fields = file.read().rsplit(')', 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / CLOCK_TICKS        #utime + stime
+        except (OSError, IndexError, ValueError):
+            return None
+
+    def sample(self):
+        try:
+            with open('/proc/%d/status' % self.popen.pid) as file:
+                for line in file:
+                    key, _, value = line.partition(':')
+                    if key == 'Threads':
+                        self.peakThreads = max(self.peakThreads or 0, int(value))
+                    elif key == 'VmHWM':                #内核记录的RSS峰值(kB)
+                        self.peakRSS = int(value.split()[0]) * 1024
+        except (OSError, ValueError):
+            pass
+
+    def stop(self):
+        if self.popen.poll() is None:
+            self.popen.terminate()
+            try:
+                self.popen.wait(5)
+            except subprocess.TimeoutExpired:
+                self.popen.kill()
+                self.popen.wait()
+        self.log.close()
+
+
+def fetch_stats(port):
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:%d/stats' % port, timeout=2) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except (OSError, ValueError):
+        return {}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    rng = random.Random(options.seed)
+    workdir = tempfile.mkdtemp(prefix='p2p-bench-')
+    processes = []
+    try:
+        trackerDir = os.path.join(workdir, 'tracker')
+        install(trackerDir, 'tracker.py')
+        peerDirs = []
+        for i in range(options.peers):
+            peerDirs.append(os.path.join(workdir, 'peer%d' % i))
+            install(peerDirs[-1], 'fileSynchronizer.py')
+
+        fileBytes = int(options.fileSize * 1048576)
+        names = make_dataset(peerDirs[0], options.dataset, options.files, fileBytes, rng)
+        if options.dataset == 'modified':
+            #所有peer一开始就有相同的文件(包括mtime)，测的是修改之后的增量同步
+            for directory in peerDirs[1:]:
+                for name in names:
+                    os.makedirs(os.path.dirname(os.path.join(directory, name)), exist_ok=True)
+                    shutil.copy2(os.path.join(peerDirs[0], name), os.path.join(directory, name))
+
+        trackerPort = free_port()
+        trackerMetrics = free_port()
+        processes.append(Process('tracker', [sys.executable, '-u', 'tracker.py', '127.0.0.1', str(trackerPort),
+                                             '--metrics-port', str(trackerMetrics)] + options.trackerArgs.split(),
+                                 trackerDir, os.path.join(workdir, 'tracker.log')))
+        time.sleep(0.5)
+        peerMetrics = []
+        for i, directory in enumerate(peerDirs):
+            peerMetrics.append(free_port())
+            processes.append(Process('peer%d' % i, [sys.executable, '-u', 'fileSynchronizer.py', '127.0.0.1',
+                                                    str(trackerPort), '--engine', options.engine,
+                                                    '--metrics-port', str(peerMetrics[-1])] + options.peerArgs.split(),
+                                     directory, os.path.join(workdir, 'peer%d.log' % i)))
+            time.sleep(0.2)         #peer启动时自己找空闲端口，错开启动避免抢同一个端口
+
+        if options.dataset == 'modified':
+            #等所有peer都至少心跳两次，初始状态稳定之后再修改
+            deadline = time.monotonic() + options.timeout
+            while fetch_stats(trackerMetrics).get('tracker_requests_total', 0) < 2 * options.peers:
+                if time.monotonic() > deadline:
+                    raise RuntimeError('peers did not start')
+                time.sleep(0.2)
+            payload = modify_dataset(peerDirs[0], names, rng)
+        else:
+            payload = options.files * fileBytes
+
+        expected = manifest(peerDirs[0], names)
+        trackerCPU = processes[0].cpu()
+        trackerRequests = fetch_stats(trackerMetrics).get('tracker_requests_total', 0)
+        start = time.monotonic()
+        pending = set(range(1, options.peers))
+        finish = {}
+        while pending and time.monotonic() - start < options.timeout:
+            for process in processes:
+                process.sample()
+            for i in list(pending):
+                if converged(peerDirs[i], expected):
+                    finish[i] = time.monotonic() - start
+                    pending.discard(i)
+            time.sleep(options.poll)
+        elapsed = time.monotonic() - start
+        for process in processes:
+            process.sample()
+
+        trackerStats = fetch_stats(trackerMetrics)
+        requests = trackerStats.get('tracker_requests_total', 0) - trackerRequests
+        cpuEnd = processes[0].cpu()
+        verified = not pending and all(file_md5(os.path.join(peerDirs[0], name)) == file_md5(os.path.join(directory, name))
+                                       for directory in peerDirs[1:] for name in names)
+
+        peers = []
+        for i, process in enumerate(processes[1:]):
+            stats = fetch_stats(peerMetrics[i])
+            peers.append({'name': process.name, 'convergenceSeconds': finish.get(i),
+                          'peakRSS': process.peakRSS, 'peakThreads': process.peakThreads,
+                          'downloadBytes': stats.get('peer_download_bytes_total'),
+                          'wireBytes': stats.get('peer_download_wire_bytes_total'),
+                          'uploadBytes': stats.get('peer_upload_bytes_total'),
+                          'failedBlocks': stats.get('peer_blocks_failed_total')})
+        delivered = payload * (options.peers - 1)
+        return {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'config': {'dataset': options.dataset, 'peers': options.peers, 'files': options.files,
+                       'fileMB': options.fileSize, 'engine': options.engine, 'peerArgs': options.peerArgs,
+                       'trackerArgs': options.trackerArgs, 'seed': options.seed},
+            'converged': not pending,
+            'verified': verified,
+            'convergenceSeconds': elapsed if not pending else None,
+            'payloadBytes': payload,
+            'aggregateMBps': delivered / 1048576 / elapsed if not pending and elapsed > 0 else None,
+            'tracker': {'requests': requests,
+                        'cpuSeconds': cpuEnd - trackerCPU if cpuEnd is not None and trackerCPU is not None else None,
+                        'cpuPerHeartbeatMs': (cpuEnd - trackerCPU) * 1000 / requests
+                        if requests and cpuEnd is not None and trackerCPU is not None else None,
+                        'requestMeanMs': trackerStats.get('tracker_request_seconds', {}).get('mean', 0) * 1000,
+                        'peakRSS': processes[0].peakRSS, 'peakThreads': processes[0].peakThreads},
+            'peers': peers,
+            'workdir': workdir if options.keep else None,
+        }
+    finally:
+        for process in processes:
+            process.stop()
+        if not options.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+#和之前的结果比较，收敛时间或tracker每次心跳的CPU时间变差超过tolerance时返回False
+def compare(result, baseline, tolerance):
+    ok = result['converged'] and result['verified']
+    checks = [('convergenceSeconds', result['convergenceSeconds'], baseline.get('convergenceSeconds')),
+              ('tracker.cpuPerHeartbeatMs', result['tracker']['cpuPerHeartbeatMs'],
+               baseline.get('tracker', {}).get('cpuPerHeartbeatMs'))]
+    for name, now, before in checks:
+        if now is None or not before:
+            continue
+        change = (now - before) / before
+        regressed = change > tolerance
+        print('%-28s %10.3f -> %10.3f  %+6.1f%%%s' % (name, before, now, change * 100, '  REGRESSION' if regressed else ''),
+              file=sys.stderr)
+        ok = ok and not regressed
+    return ok
+
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--dataset", dest="dataset", default="small", choices=["small", "huge", "modified"],
+                      help="small: many small files in nested dirs; huge: a few large files; "
+                           "modified: all peers start with the same files, then the first peer changes them")
+    parser.add_option("--peers", dest="peers", type="int", default=3, help="number of peers, the first one seeds")
+    parser.add_option("--files", dest="files", type="int", default=None, help="number of files in the dataset")
+    parser.add_option("--file-size", dest="fileSize", type="float", default=None, help="size of each file in MB")
+    parser.add_option("-e", "--engine", dest="engine", default="thread", choices=["thread", "async"],
+                      help="peer runtime")
+    parser.add_option("--peer-args", dest="peerArgs", default="", help="extra fileSynchronizer.py options")
+    parser.add_option("--tracker-args", dest="trackerArgs", default="", help="extra tracker.py options")
+    parser.add_option("--timeout", dest="timeout", type="float", default=300, help="seconds to wait for convergence")
+    parser.add_option("--poll", dest="poll", type="float", default=0.1, help="seconds between convergence checks")
+    parser.add_option("--seed", dest="seed", type="int", default=1, help="random seed for the dataset")
+    parser.add_option("-o", "--output", dest="output", default=None, help="write the json result here (default stdout)")
+    parser.add_option("--compare", dest="compare", default=None,
+                      help="json result of an earlier run; exit with status 1 if this run is slower")
+    parser.add_option("--tolerance", dest="tolerance", type="float", default=0.2,
+                      help="allowed slowdown against --compare, as a fraction")
+    parser.add_option("--keep", dest="keep", action="store_true", default=False,
+                      help="keep the temp directories and logs")
+    options, args = parser.parse_args()
+    if options.peers < 2:
+        parser.error("need at least 2 peers")
+    #modified的文件要大于一个块(100MB)，才能测到只传输变化的块
+    defaults = {'small': (500, 0.01), 'huge': (2, 256), 'modified': (2, 256)}[options.dataset]
+    if options.files is None:
+        options.files = defaults[0]
+    if options.fileSize is None:
+        options.fileSize = defaults[1]
+
+    result = run(options)
+    text = json.dumps(result, indent=2)
+    if options.output:
+        with open(options.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print(text)
+    if options.compare:
+        with open(options.compare) as file:
+            baseline = json.load(file)
+        sys.exit(0 if compare(result, baseline, options.tolerance) else 1)
+    sys.exit(0 if result['converged'] and result['verified'] else 1)
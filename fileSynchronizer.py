@@ -5,10 +5,30 @@
 #==============================================================================
 
 import socket, sys, threading, json,os,time
+import urllib.parse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import os.path
 import optparse
+import logging
 from Utils.IOUtils import IOUtils
 from Utils.ConversionUtils import ConversionUtils
+from Utils.HashCache import HashCache
+from Utils.NetUtils import NetUtils
+from Utils.CatalogCodec import CatalogCodec
+from Utils.PeerConnection import ConnectionPool
+from Utils.Transfer import BlockSink, BlockBitmap
+from Utils.Scheduler import DownloadScheduler, FileTask, FileBundle
+from Utils.Journal import TransferJournal
+from Utils.Watcher import DirectoryWatcher
+from Utils.LocalIndex import LocalIndex
+from Utils.BlockIndex import BlockIndex
+from Utils.Compression import Compression
+from Utils.RateLimit import RateLimiter
+from Utils.Metrics import REGISTRY, MetricsServer
+from Utils.Log import Log
+
+log = logging.getLogger('peer')
 
 
 def validate_ip(s):
@@ -44,38 +64,67 @@ def validate_port(x):
     return True
 
 
-# 获取文件夹内文件信息
-# 可过滤指定后缀类型文件
-def get_file_info(blockSize):
+# 文件在共享目录中的相对路径(用/分隔)对应的本地路径。sys.path[0]是调用python解释器的脚本所在的目录
+def local_path(name):
+    return sys.path[0] + os.sep + name.replace('/', os.sep)
 
-    file_info = []
-    ignoredTypes = [".exe", ".py", ".pyd", ".dll"]
-
-    entryList = os.scandir(sys.path[0]) #sys.path[0]是调用python解释器的脚本所在的目录
-    for entry in entryList:             #os.scandir不会递归到子目录中
-        if os.path.isfile(entry):
-            isValidFile = True
+# 检查其他peer发来的相对路径，防止用绝对路径或者..写到共享目录之外
+def validate_name(name):
+    if not isinstance(name, str) or not name or name.startswith('/') or '\\' in name:
+        return False
+    for part in name.split('/'):
+        if part in ('', '.', '..'):
+            return False
+    return True
 
-            for type in ignoredTypes:
-                if type in entry.name:
-                    isValidFile = False
-                    break
 
-            if isValidFile:
-                fullName=sys.path[0]+os.sep+entry.name
-                fileSize=os.path.getsize(fullName)
-                if fileSize < ConversionUtils.megabytes2Bytes(blockSize):
-                    blockNum = 0            #不分块的话，为num=0
-                else:
-                    blockNum = IOUtils.getPartionBlockNum(fullName,blockSize)       #文件分块总数
-                    IOUtils.partitionFile(fullName,blockSize)           #进行文件分块      但是应该等真正要传输的时候，再分块
+# 被过滤的文件类型不共享
+def is_ignored(name):
+    ignoredTypes = [".exe", ".py", ".pyd", ".dll"]
+    for type in ignoredTypes:
+        if type in name:
+            return True
+    return False
+
+# 获取单个文件的信息，name是相对路径。文件不存在、是目录或者是被过滤的类型时返回None
+# 分块的文件还带上每个块的hash(blocks)和它们的根(root)，滚动校验模式下还有每个块的弱校验和(weak)
+# 文件和块的hash用hashCache当前的算法计算，为了兼容旧版本，文件的hash仍然放在md5字段中
+def get_single_file_info(name, blockSize, hashCache=None):
+    if is_ignored(name):
+        return None
+
+    fullName=local_path(name)
+    try:
+        stat=os.stat(fullName)
+    except OSError:
+        return None
+    if not os.path.isfile(fullName):
+        return None
+    fileSize=stat.st_size
+    if fileSize < ConversionUtils.megabytes2Bytes(blockSize):
+        blockNum = 0            #不分块的话，为num=0
+    else:
+        blockNum = IOUtils.getPartionBlockNum(fullName,blockSize)       #文件分块总数，块只是原文件上的字节区间，不再预先分割
 
-                file_info.append({"name": entry.name,
-                                  "mtime": int(os.path.getmtime(entry)), 
-                                  "md5":IOUtils.getMD5(fullName), 
-                                  "blockNum":blockNum})
+    if hashCache is not None:
+        hashes = hashCache.getEntry(name, fullName, stat)
+        if hashes is None:
+            return None
+        md5, blocks, weaks = hashes["md5"], hashes["blocks"], hashes.get("weak")
+    else:
+        md5, blocks, weaks = IOUtils.getFileHashes(fullName, ConversionUtils.megabytes2Bytes(blockSize))
 
-    return file_info        #只是获取当前所有文件(去除subfolder)
+    info = {"name": name,
+            "mtime": int(stat.st_mtime), 
+            "size": fileSize,
+            "md5":md5, 
+            "blockNum":blockNum}
+    if blocks:
+        info["blocks"] = blocks
+        info["root"] = IOUtils.getHashRoot(blocks, hashCache.algo if hashCache is not None else 'md5')
+    if weaks:
+        info["weak"] = weaks
+    return info
 
 
 def check_port_available(check_port):
@@ -105,8 +154,13 @@ def get_next_available_port(initial_port):
 
 
 class FileSynchronizer(threading.Thread):
+    MAX_BUNDLE = 1024           #一个小文件组请求最多包含的文件数
+    ROLLING_SECONDS = 30        #滚动校验在一个旧文件中最多扫描这么多秒，没找到的块从网络下载
+    POLL_RESCAN = 60            #没有inotify时深度扫描的最长间隔，平时每次心跳只做快速扫描
+    REDESCRIBE_SECONDS = 5      #同一个路径两次按inotify事件重新检查之间至少隔这么久，反复写入关闭的文件不会每次都重新hash
     #这里其实很巧妙。因为我们并不知道ip层会用本机的哪个ip地址，所以我们该peer当服务器时，bind到0.0.0.0，这样监听所有ip地址
-    def __init__(self, trackerhost,trackerport,port, host='0.0.0.0'):   
+    def __init__(self, trackerhost,trackerport,port, host='0.0.0.0', scheduler=None, rolling=False, rescanInterval=300,
+                 hashAlgo='md5', hashWorkers=4, compress=None, limiter=None, limitsFile=None, catalogEncoding='json'):   
 
         threading.Thread.__init__(self)
         #Port for serving file requests
@@ -120,18 +174,95 @@ class FileSynchronizer(threading.Thread):
         self.BUFFER_SIZE = 8192    #8k缓冲区大小
         self.blockSize=100         #文件分块大小默认为100M
         self.fileInProcess=set()      #应用于正在请求的文件     因为大文件的话，防止正在请求的文件被多次请求
-        self.lock=threading.Lock()      #用于self.fileInProcess
-
-        #与tracker的tcp socket
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
-        self.client.settimeout(180)
+        self.retryNames=set()         #下载失败被放弃的文件，下一次sync时重新比对
+        self.lock=threading.Lock()      #用于self.fileInProcess和self.retryNames
+        #增量协议的状态: 上次回复中的目录版本、上次宣告给tracker的文件、本地镜像的全局目录
+        self.catalogVersion=None
+        self.announced={}
+        self.partialNames=set()       #上次作为正在下载的文件宣告出去的文件
+        self.remoteFiles={}
+        self.swept=False              #启动后是否已经按目录清理过MEtemp
+        self.selfAddr=None            #tracker看到的本节点地址[ip, port]
+        #tracker回复中目录的编码，bin是更紧凑的二进制编码，边收边解码(见Utils/CatalogCodec.py)，不支持的tracker照常回复JSON
+        self.catalogEncoding=catalogEncoding
+        #hash缓存，存放在MEtemp下，重启后依然有效
+        #rolling为True时额外计算块的弱校验和，更新的文件中间插入了数据时也能找到可以复用的旧块
+        #hash算法以tracker回复的为准，hashAlgo只是第一次宣告时使用的算法
+        self.rolling=rolling
+        self.hashAlgo=hashAlgo
+        self.hashCache=HashCache(sys.path[0] + os.sep + 'MEtemp' + os.sep + 'hashcache.json',
+                                 ConversionUtils.megabytes2Bytes(self.blockSize), rolling, hashAlgo, hashWorkers)
+
+        #本地文件索引，递归包含所有子目录，由inotify事件增量更新，每rescanInterval秒深度扫描一次作为兜底
+        #inotify不可用或者已经停止时每次心跳快速扫描(只stat目录)，文件原地修改由至少每POLL_RESCAN秒一次的深度扫描发现
+        self.localIndex=LocalIndex(sys.path[0],
+                                   lambda name: get_single_file_info(name, self.blockSize, self.hashCache),
+                                   self.hashCache.remove,
+                                   prepare=lambda names: self.hashCache.warm(
+                                       [(name, local_path(name)) for name in names if not is_ignored(name)]))
+        #本地块索引: 块hash -> 本地文件中的位置，下载时任何本地文件里已有的块都直接拷贝
+        #整个文件都能从本地拼出来时(改名、复制的文件)不经过调度器，在localCopies中拷贝完直接替换到位
+        self.blockIndex=BlockIndex(ConversionUtils.megabytes2Bytes(self.blockSize))
+        self.localCopies=ThreadPoolExecutor(2)
+        self.scanned=False
+        self.dirtyNames=set()
+        self.describedAt={}           #路径 -> 最近一次按inotify事件重新检查的时间
+        self.deferredUntil=None       #推迟检查的路径最早什么时候可以检查，sync到时提前醒来
+        self.rescanNeeded=False
+        self.rescanInterval=rescanInterval
+        self.lastScan=0
+        self.watcher=DirectoryWatcher(sys.path[0], self.onLocalChange)
+        self.syncWake=threading.Event()     #本地文件有变化时提前唤醒sync
+
+        #下载时在块请求中列出可以接受的压缩方式，由发送方决定是否压缩
+        self.compress=list(compress) if compress else None
+
+        #上传、下载限速。limitsFile是可选的json限速配置，每次sync检查它的mtime，改了就重新加载，运行中调整限速
+        self.limiter = limiter if limiter is not None else RateLimiter()
+        self.limitsFile=limitsFile
+        self.limitsMtime=None
+
+        #下载进度日志，进程重启后从中断的地方继续下载
+        self.journal=TransferJournal(sys.path[0] + os.sep + 'MEtemp', ConversionUtils.megabytes2Bytes(self.blockSize))
+
+        #指标，见Utils/Metrics.py，由--metrics-port开启的本地http接口输出
+        self.syncSeconds = REGISTRY.histogram('peer_sync_seconds', 'duration of one sync: local scan, announce and diff')
+        self.heartbeatSeconds = REGISTRY.histogram('peer_heartbeat_seconds', 'round trip of one announce to the tracker')
+        self.syncErrors = REGISTRY.counter('peer_sync_errors_total', 'syncs that failed with an exception')
+        self.trackerErrors = REGISTRY.counter('peer_tracker_errors_total', 'announces that failed on the tracker connection')
+        self.uploadConnections = REGISTRY.gauge('peer_upload_connections', 'open block serving connections')
+        self.blocksSent = REGISTRY.counter('peer_blocks_sent_total', 'blocks served to other peers')
+        self.uploadBytes = REGISTRY.counter('peer_upload_bytes_total', 'block bytes sent to other peers, on the wire')
+        self.blockSendSeconds = REGISTRY.histogram('peer_block_send_seconds', 'time to send one block')
+        self.blocksReceived = REGISTRY.counter('peer_blocks_received_total', 'blocks received and verified')
+        self.blocksFailed = REGISTRY.counter('peer_blocks_failed_total', 'blocks that failed to arrive or to verify')
+        self.downloadBytes = REGISTRY.counter('peer_download_bytes_total', 'verified block bytes received')
+        self.downloadWireBytes = REGISTRY.counter('peer_download_wire_bytes_total', 'block bytes received on the wire')
+        self.batchSeconds = REGISTRY.histogram('peer_batch_seconds', 'time to fetch one batch of blocks from one peer')
+        self.batchThroughput = REGISTRY.histogram('peer_batch_throughput_mbps', 'effective MB/s of one batch of blocks',
+                                                  (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500))
+        self.filesCompleted = REGISTRY.counter('peer_files_completed_total', 'files downloaded and moved into place')
+        self.finishSeconds = REGISTRY.histogram('peer_finish_seconds', 'time to move a finished file into place')
+        self.dedupBytes = REGISTRY.counter('peer_dedup_bytes_total', 'block bytes copied from other local files instead of downloaded')
+        self.localFiles = REGISTRY.counter('peer_local_assembled_files_total', 'files built entirely from local blocks')
+        REGISTRY.gauge('peer_local_files', 'files in the local index', fn=lambda: len(self.localIndex.files))
+        REGISTRY.gauge('peer_remote_files', 'files in the mirrored catalog', fn=lambda: len(self.remoteFiles))
+
+        #与tracker的tcp长连接，第一次sync时建立
+        self.client = None
+        #到其他peer的长连接池，块请求在上面流水线传输
+        self.pool = ConnectionPool()
+        #下载调度器，限制全局和每个来源peer的在途块数
+        self.scheduler = scheduler if scheduler is not None else DownloadScheduler()
+        #对端拒绝超过MAX_BUNDLE个文件的小文件组，组再大就永远下载不下来
+        self.scheduler.bundleFiles = min(self.scheduler.bundleFiles, FileSynchronizer.MAX_BUNDLE)
 
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) 
 
         try:
             self.server.bind((self.host, self.port))
         except socket.error:
-            print(('Bind failed %s' % (socket.error)))
+            log.error('Bind failed %s', socket.error)
             sys.exit()
         self.server.listen(10)
 
@@ -142,214 +273,1220 @@ class FileSynchronizer(threading.Thread):
     def process_message(self, conn, addr):          
         timeout = 60.0
         conn.settimeout(timeout)
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 
-        print("Client connected with " + addr[0] + ":" + str(addr[1]))
+        log.debug('Client connected with %s:%s', addr[0], addr[1])
+        self.uploadConnections.inc()
     
+        #长连接: 对端可以在一个连接上连续(流水线式)请求多个块，直到它关闭连接或空闲超时
         try:
-            # Read file name
-            requestMsg = ""
             while True:
-                requestMsg += conn.recv(self.BUFFER_SIZE).decode()
-                if len(requestMsg) < self.BUFFER_SIZE:
+                requestMsg = NetUtils.recvMsg(conn)
+                if requestMsg is None:
                     break
-            
-            requestMsg=json.loads(requestMsg)
-            requestedFileName=requestMsg["name"]
-            requestedIdx=requestMsg["blockIdx"]
-
-            if(requestedIdx==0):
-                target=sys.path[0]+ os.sep + requestedFileName
-            else:
-                target=sys.path[0]+ os.sep + 'MEtemp' +os.sep+requestedFileName+ '_PART' + str(requestedIdx)
-                #IOUtils.partitionFile(sys.path[0]+ os.sep + requestedFileName,self.blockSize)   #进行文件分块
-
-            #send md5
-            md5=IOUtils.getMD5(target)
-            conn.send(bytes(md5,"utf-8"))       #32字节
-            #print(target+" md5:"+" "+md5)
-
-            sendSize=0
-
-            # send file
-            with open(target, "rb") as file:
-                while True:
-                    content = file.read(self.BUFFER_SIZE)       #因为文件块较大，所以一次只读缓冲区大小，分多次send
-                    conn.send(content)  
-                    sendSize+=len(content) 
-                    #time.sleep(0.1)
-                    #if len(content)<self.BUFFER_SIZE:
-                    if len(content)==0:
-                        break         
+                #一组小文件: 依次发送每个文件，整组是一个连续的流
+                for request in self.bundleOf(requestMsg):
+                    self.sendBlock(conn, request, addr)
 
         except socket.timeout:
-            print("Conn socket timeout!")
-        except socket.error as e:
-            print('Socket error: %s' % e)
-        except json.decoder.JSONDecodeError:
-            print('Incorrect format (JSON required)')
+            log.info("Conn socket timeout!")
+        except (socket.error, ConnectionError) as e:
+            log.warning('Socket error: %s', e)
+        except (ValueError, KeyError, TypeError, IndexError):
+            log.warning('Incorrect format (JSON required)')
 
+        self.uploadConnections.dec()
         conn.close()
-        print(target+" sended "+str(sendSize)+ "bytes")
 
+    #请求中的所有块请求。{"bundle": [...]}是一组小文件，每一项都是一个0号块的请求
+    #格式不对的请求抛出ValueError，连接会被关闭
+    def bundleOf(self, requestMsg):
+        if not isinstance(requestMsg, dict):
+            raise ValueError('invalid block request')
+        if "bundle" not in requestMsg:
+            return [requestMsg]
+        requests=requestMsg["bundle"]
+        if not isinstance(requests, list) or len(requests) > FileSynchronizer.MAX_BUNDLE \
+                or not all(isinstance(request, dict) for request in requests):
+            raise ValueError('invalid bundle request')
+        return requests
+
+    #发送一个块: 先发带长度前缀的块头(md5和字节数)，再发块数据
+    def sendBlock(self, conn, requestMsg, addr):
+        file, offset, header = self.openBlock(requestMsg)
+        NetUtils.sendMsg(conn, header)
+        if file is None:
+            return
+
+        throttle=self.throttleOf('upload', addr, os.fstat(file.fileno()).st_size)
+        start=time.monotonic()
+        if header.get("encoding"):
+            #压缩发送，不能再用sendfile
+            with file:
+                sendSize=NetUtils.sendFrames(conn, file.fileno(), offset, header["size"], header["encoding"],
+                                             throttle=throttle)
+        else:
+            # send file     用sendfile零拷贝，数据直接从page cache发到socket，不经过用户态
+            with file:
+                sendSize=NetUtils.sendFile(conn, file, offset, header["size"], throttle)
+            if sendSize!=header["size"]:
+                #文件在发送过程中被截断，块头中的长度已经不对了，只能断开连接
+                raise ConnectionError(file.name+' shrank while sending')
+        self.blockSent(file.name, header, sendSize, addr, time.monotonic()-start)
+
+    #发送完一个块后记录指标和日志，wireSize是网络上发送的字节数(压缩时小于块大小)
+    def blockSent(self, path, header, wireSize, addr, seconds):
+        self.blocksSent.inc()
+        self.uploadBytes.inc(wireSize)
+        self.blockSendSeconds.observe(seconds)
+        log.debug('block sent', extra=Log.fields(file=path, idx=header["blockIdx"], bytes=header["size"], wire=wireSize,
+                                                 encoding=header.get("encoding"), peer='%s:%s' % (addr[0], addr[1]),
+                                                 seconds=round(seconds, 4)))
+
+    #打开请求的块，返回(文件对象, 块在文件中的偏移, 块头)。没有这个块时文件对象为None，块头中带error
+    #完整的本地文件优先；本地没有请求的版本时，如果正在下载这个版本并且已经收到了这一块，就从临时文件中提供
+    #线程版和asyncio版共用，只是发送方式不同
+    def openBlock(self, requestMsg):
+        requestedFileName=requestMsg["name"]
+        requestedIdx=requestMsg["blockIdx"]
+        requestedMD5=requestMsg.get("md5")
+
+        #块直接对应源文件中的一段字节区间，不需要MEtemp中的分块文件
+        #块的md5取自hash缓存或者下载任务，不用为每次请求再读一遍这个块
+        #文件在上次扫描之后改过时缓存对不上，直接当作没有这个版本，重新hash留给scanLocal
+        #只提供本地索引中的共享文件，不在索引中的路径(比如MEtemp下的文件)一律当作不存在
+        file=None
+        target=str(requestedFileName)
+        if validate_name(requestedFileName) and requestedFileName in self.localIndex.files:
+            target=local_path(requestedFileName)
+            try:
+                file=open(target, "rb")
+                hashes=self.hashCache.lookup(requestedFileName, os.fstat(file.fileno()))
+                if hashes is not None and (requestedMD5 is None or hashes["md5"] == requestedMD5):
+                    fileInfo=hashes
+                else:
+                    file.close()
+                    file=None
+            except OSError:
+                if file is not None:
+                    file.close()
+                    file=None
+        if file is None:
+            task=self.scheduler.getTask(requestedFileName)
+            if task is not None and task.info["md5"]==requestedMD5 and task.have.has(requestedIdx):
+                target=self.tempPathOf(requestedFileName)
+                try:
+                    file=open(target, "rb")
+                    fileInfo=task.info
+                except OSError:
+                    pass
+        if file is None:
+            log.info('File not found: %s', target)
+            return None, 0, {"name": target, "blockIdx": requestedIdx,
+                             "error": "not found", "size": 0}
+        #块序号必须是0(整个文件)或者在块hash列表的范围内
+        if not isinstance(requestedIdx, int) or isinstance(requestedIdx, bool) \
+                or not (requestedIdx == 0 or 1 <= requestedIdx <= len(fileInfo.get("blocks") or ())):
+            file.close()
+            log.info('Invalid block %r of %s', requestedIdx, target)
+            return None, 0, {"name": requestedFileName, "blockIdx": requestedIdx,
+                             "error": "invalid block", "size": 0}
+
+        if(requestedIdx==0):
+            offset=0
+            length=os.fstat(file.fileno()).st_size
+        else:
+            offset,length=IOUtils.getBlockRange(target,requestedIdx,self.blockSize)
+
+        header={"name": requestedFileName, "blockIdx": requestedIdx,
+                "md5": self.blockMD5(fileInfo, requestedIdx), "size": length}
+        #请求方接受压缩时，先压缩块开头的一段样本，效果明显才压缩整个块
+        if requestMsg.get("compress"):
+            sample=os.pread(file.fileno(), min(Compression.SAMPLE, length), offset)
+            encoding=Compression.choose(sample, requestMsg["compress"])
+            if encoding is not None:
+                header["encoding"]=encoding
+        return file, offset, header
+
+
+    #限速回调，没有限速时返回None，收发时不必每段数据都经过限速器
+    #fileSize不超过limiter.smallFile的文件优先，不用排在大文件的块后面
+    def throttleOf(self, direction, peer, fileSize):
+        if not self.limiter.limited(direction):
+            return None
+        urgent=self.limiter.isUrgent(fileSize)
+        return lambda n: self.limiter.throttle(direction, peer, n, urgent)
+
+    #限速配置文件改过了就重新加载。文件是json，速率单位MB/s，0表示不限速:
+    #{"upload":, "download":, "peerUpload":, "peerDownload":, "smallFile": 优先传输的文件大小上限(MB)}
+    def loadLimits(self):
+        if self.limitsFile is None:
+            return
+        try:
+            mtime=os.stat(self.limitsFile).st_mtime_ns
+            if mtime==self.limitsMtime:
+                return
+            with open(self.limitsFile, 'r') as file:
+                limits=json.load(file)
+            self.limitsMtime=mtime
+            self.limiter.setLimits(**dict((key, ConversionUtils.megabytes2Bytes(float(limits[key])))
+                                          for key in ('upload', 'download', 'peerUpload', 'peerDownload', 'smallFile')
+                                          if key in limits))
+            log.info('rate limits loaded from %s: %s', self.limitsFile, limits)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            log.warning('警告：限速配置%s无效: %s', self.limitsFile, e)
 
     def run(self):
-        self.client.connect((self.trackerhost,self.trackerport))
-        t = threading.Timer(5, self.sync)          #心跳包由sync发送，并进行文件比对，向其他节点要文件     要文件应该多线程并行！！
+        self.scheduler.start(self.fetchTask, self.finishTask, self.abortTask, self.fetchBundle)
+        self.watcher.start()
+        t = threading.Thread(target=self.sync)          #心跳包由sync发送，并进行文件比对，向其他节点要文件     要文件应该多线程并行！！
         t.start()
-        print(('Waiting for connections on port %s' % (self.port)))
+        log.info('Waiting for connections on port %s', self.port)
         while True:
             conn, addr = self.server.accept()       #在这里peer作为server一直监听。收到一个请求，就开一个线程处理，然后继续循环监听。所以发送文件实现了多线程
             threading.Thread(target=self.process_message, args=(conn,addr)).start()
 
 
     #给tracker发送心跳包（包含当前节点的所有文件信息），并根据tracker返回的文件信息表去检查需要哪些文件
+    #每5秒一次，本地文件有变化时立即进行
     def sync(self):
-        print(('connect to:' + self.trackerhost, self.trackerport))
-        
-        localFileList = get_file_info(self.blockSize)
-        self.msg = json.dumps({"port": self.port, "files": localFileList}) 
-        self.client.send(bytes(self.msg, "utf-8"))
+        while True:
+            self.waitSync(5)
+            self.syncStep()
 
-        directory_response_message = ""
+    #一次sync，记录耗时，出错只记日志，下一次心跳再试。线程版和asyncio版共用
+    def syncStep(self):
         try:
-            while True:
-                directory_response_message += self.client.recv(self.BUFFER_SIZE).decode()
-                if len(directory_response_message) < self.BUFFER_SIZE:
-                    self.client.close()                 #收完response，就关闭socket
-                    break
-        except socket.error as e:
-            print('Socket error: %s' % e)
-
+            with self.syncSeconds.time():
+                self.syncOnce()
+        except Exception as e:
+            self.syncErrors.inc()
+            log.exception('Sync error: %s', e)
+
+    #等到下一次sync的时间，有推迟检查的路径时到时就醒来。被本地文件变化唤醒时再稍等一会，把一次写入产生的多个事件合并到一起
+    def waitSync(self, timeout):
+        if self.deferredUntil is not None:
+            timeout=max(0, min(timeout, self.deferredUntil-time.monotonic()))
+            self.deferredUntil=None
+        if self.syncWake.wait(timeout):
+            time.sleep(0.2)
+        self.syncWake.clear()
+
+    #inotify回调，names为None表示有事件丢失
+    def onLocalChange(self, names):
+        self.lock.acquire()
+        if names is None:
+            self.rescanNeeded=True
+        else:
+            self.dirtyNames.update(names)
+        self.lock.release()
+        self.syncWake.set()
+
+    #更新本地文件索引，返回上次之后有变化的文件名。只重新检查inotify报告过变化的路径；
+    #第一次、事件丢失或者到了兜底时间时深度扫描(没变的文件只stat一次，hash从缓存中取)
+    #inotify不可用时每次心跳做只看目录mtime的快速扫描，代价和目录数成正比，能发现新建、删除、改名的文件；
+    #它发现不了文件原地修改(追加、重写)，所以这时深度扫描的间隔不超过POLL_RESCAN秒
+    def scanLocal(self):
+        self.lock.acquire()
+        dirty=self.dirtyNames
+        self.dirtyNames=set()
+        rescan=self.rescanNeeded
+        self.rescanNeeded=False
+        self.lock.release()
+
+        now=time.monotonic()
+        interval=self.rescanInterval if self.watcher.running else min(self.rescanInterval, self.POLL_RESCAN)
+        if rescan or not self.scanned or now-self.lastScan >= interval:
+            self.localIndex.scan(True)
+            self.hashCache.retain(self.localIndex.files)      #清理已删除文件的缓存项
+            self.blockIndex.retain(self.localIndex.files)
+            self.scanned=True
+            self.lastScan=now
+        elif not self.watcher.running:
+            self.localIndex.scan(False)
+        elif dirty:
+            #最近刚检查过的路径留到下一次心跳再看，期间的事件合并成一次
+            due=set()
+            for name in dirty:
+                if now-self.describedAt.get(name, -self.REDESCRIBE_SECONDS) >= self.REDESCRIBE_SECONDS:
+                    due.add(name)
+            if len(due)<len(dirty):
+                self.lock.acquire()
+                self.dirtyNames.update(dirty-due)
+                self.lock.release()
+                self.deferredUntil=min(self.describedAt[name] for name in dirty-due)+self.REDESCRIBE_SECONDS
+            for name in [name for name, at in self.describedAt.items() if now-at >= self.REDESCRIBE_SECONDS]:
+                del self.describedAt[name]
+            for name in due:
+                self.describedAt[name]=now
+            self.localIndex.update(due)
+        self.hashCache.save()
+        changes=self.localIndex.drainChanges()
+        for name in changes:
+            self.blockIndex.update(name,self.localIndex.files.get(name))
+        return changes
+
+    #换成tracker使用的hash算法: 所有文件用新算法重新计算，下次全量宣告
+    def switchHash(self,algo):
+        if algo not in IOUtils.HASH_ALGOS:
+            log.error('Unsupported hash algorithm: %s', algo)
+            return
+        log.info('switching content hash to %s', algo)
+        self.hashAlgo=algo
+        self.hashCache.setAlgo(algo)
+        self.lock.acquire()
+        self.rescanNeeded=True
+        self.lock.release()
+        self.syncWake.set()
+
+    #第一次扫描之前先问tracker用哪种hash算法，免得先用错误的算法把整个目录hash一遍，全量宣告被拒后再重算
+    #发一个空的增量宣告: tracker不认识本节点，回复resync并带上它的算法，目录不会有任何变化。连不上时按原来的算法扫描
+    def probeHash(self):
+        request = {"port": self.port, "version": None, "full": False, "files": [], "removed": [], "hash": self.hashAlgo}
+        try:
+            if self.client is None:
+                self.client = socket.create_connection((self.trackerhost, self.trackerport), 180)
+            NetUtils.sendMsg(self.client, request)
+            response = CatalogCodec.recvReply(self.client)
+            if response is None:
+                raise ConnectionError('tracker closed the connection')
+        except (socket.error, ConnectionError, ValueError) as e:
+            self.trackerErrors.inc()
+            log.warning('Socket error: %s', e)
+            if self.client is not None:
+                self.client.close()
+            self.client = None
+            return
+        if response.get("hash", self.hashAlgo) != self.hashAlgo:
+            self.switchHash(response["hash"])
+
+    #本节点现在要宣告的name的信息: 正在下载比本地更新的版本时宣告下载中的版本和已收到的块的位图
+    def announceInfo(self,name,partials):
+        partial=partials.get(name)
+        if partial is not None:
+            return partial
+        return self.localIndex.files.get(name)
+
+    def syncOnce(self):
+        log.debug('connect to: %s:%s', self.trackerhost, self.trackerport)
+        
+        self.loadLimits()
+        if not self.scanned:
+            self.probeHash()
+        changedNames = self.scanLocal()
+        localFiles = self.localIndex.files
+        log.debug('hash cache', extra=Log.fields(**self.hashCache.stats()))
+        log.debug('block index', extra=Log.fields(**self.blockIndex.stats()))
+
+        #正在下载的文件也宣告出去，带上已收到的块的位图，别的peer不必等我们下载完就能从这里取这些块
+        partials = {}
+        for task in self.scheduler.partialTasks():
+            localFile = localFiles.get(task.name)
+            if localFile is None or localFile["mtime"] < task.info["mtime"]:
+                partial = {"name": task.name, "partial": True, "have": task.have.toHex()}
+                for key in ("mtime", "size", "md5", "blockNum", "blocks", "root", "weak"):
+                    if key in task.info:
+                        partial[key] = task.info[key]
+                partials[task.name] = partial
+
+        #只宣告上次宣告之后新增、变化和删除的文件；没有变化时就是一个单纯的心跳
+        #只比较本地有变化的文件和正在下载的文件，代价和变化量成正比，与文件总数无关
+        full = self.catalogVersion is None
+        if full:
+            announceFiles = dict(localFiles)
+            announceFiles.update(partials)
+            changed = list(announceFiles.values())
+            removed = []
+        else:
+            changed = []
+            removed = []
+            for name in changedNames | set(partials) | self.partialNames:
+                info = self.announceInfo(name, partials)
+                if info is None:
+                    if name in self.announced:
+                        removed.append(name)
+                elif self.announced.get(name) != info:
+                    changed.append(info)
+        request = {"port": self.port, "version": self.catalogVersion, "full": full,
+                   "files": changed, "removed": removed, "hash": self.hashAlgo}
+        if self.catalogEncoding != "json":
+            request["catalogEncoding"] = self.catalogEncoding
+
+        #与tracker保持一条长连接，消息带长度前缀。连接断开的话下一次心跳重新连接并全量宣告
+        try:
+            if self.client is None:
+                self.client = socket.create_connection((self.trackerhost, self.trackerport), 180)
+            with self.heartbeatSeconds.time():
+                NetUtils.sendMsg(self.client, request)
+                response = CatalogCodec.recvReply(self.client)
+            if response is None:
+                raise ConnectionError('tracker closed the connection')
+        except (socket.error, ConnectionError, ValueError) as e:
+            self.trackerErrors.inc()
+            log.warning('Socket error: %s', e)
+            if self.client is not None:
+                self.client.close()
+            self.client = None
+            response = {"resync": True}
+
+        if response.get("resync"):
+            #tracker不认识本节点(tracker重启过或本节点已过期)，或者hash算法和tracker不同，下次全量宣告
+            self.catalogVersion = None
+            self.announced = {}
+            candidates = ()
+            if response.get("hash", self.hashAlgo) != self.hashAlgo:
+                self.switchHash(response["hash"])
+        else:
+            self.catalogVersion = response["version"]
+            if full:
+                self.announced = announceFiles
+            else:
+                for info in changed:
+                    self.announced[info["name"]] = info
+                for name in removed:
+                    del self.announced[name]
+            self.partialNames = set(partials)
+            self.selfAddr = response.get("you")
+            #本地镜像一份全局目录，tracker只回复变化的部分
+            if response["full"]:
+                self.remoteFiles = response["files"]
+                if not self.swept:
+                    self.sweepTemp()
+                    self.swept = True
+            else:
+                self.remoteFiles.update(response["files"])
+                for name in response["removed"]:
+                    self.remoteFiles.pop(name, None)
+            #只比对目录中变化的文件，本地变化/删除过的文件，以及之前下载失败的文件
+            candidates = set(response["files"])
+            candidates.update(response["removed"])
+            candidates.update(removed)
+            candidates.update(info["name"] for info in changed)
+            self.lock.acquire()
+            candidates.update(self.retryNames)
+            self.retryNames.clear()
+            self.lock.release()
 
-        for filename, fileInfo in json.loads(directory_response_message).items():
+        for filename in candidates:
+            if not validate_name(filename):
+                log.warning('Invalid file name: %r', filename)
+                continue
+            fileInfo = self.remoteFiles.get(filename)
             self.lock.acquire()
             if filename in self.fileInProcess:
                 self.lock.release()
-                continue            #如果这个文件正在被请求，直接略过
+                #如果这个文件正在被请求，把新的持有者告诉调度器；版本变了或被删除则放弃旧的下载
+                task = self.scheduler.updateTask(filename, self.withoutSelf(fileInfo))
+                if task is not None:
+                    self.abortTask(task)
+                continue
             self.lock.release()
+            if fileInfo is None:
+                #文件已经从目录中删除，之前没下载完留下的下载日志和临时文件也不再需要
+                self.dropTransfer(filename)
+                continue
 
             inNeed=True         #是否需要从其他peer索取
-            for localFile in localFileList:
-                if filename == localFile["name"]:
-                    if fileInfo["mtime"] <= localFile["mtime"]:
-                        inNeed=False    #已有该文件
-                    else:
-                        #有同名文件，但是比较旧，那么就先删除，再索取
-                        if(os.path.exists(sys.path[0]+os.sep+filename)):
-                            os.remove(sys.path[0]+os.sep+filename)
-                            if(fileInfo["blockNum"]!=0):
-                                IOUtils.delFileBlocks(sys.path[0]+os.sep+filename,fileInfo["blockNum"])
-                    break
+            localFile = localFiles.get(filename)
+            if localFile is not None and fileInfo["mtime"] <= localFile["mtime"]:
+                inNeed=False    #已有该文件
+                self.dropTransfer(filename)
+            elif localFile is not None and fileInfo["md5"] == localFile["md5"]:
+                #内容没变只是mtime更新了，改一下mtime就行
+                os.utime(local_path(filename), (time.time(), fileInfo["mtime"]))
+                inNeed=False
+                self.dropTransfer(filename)
+            #有同名文件，但是比较旧。旧文件先保留，没变的块直接从它拷贝，新文件收完后会原子地替换它
                 
             if inNeed:
                 self.lock.acquire()
                 self.fileInProcess.add(filename)
                 self.lock.release()
-                t=threading.Thread(target=self.getFileFromPeer,args=(filename,fileInfo))
-                t.start()
-
-
-        self.client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.client.connect((self.trackerhost, self.trackerport))       #这里重新和tracker建立连接
-
-        t = threading.Timer(5, self.sync)
-        t.start()
+                self.startDownload(filename,fileInfo,localFile)
+
+    #把文件交给下载调度器，由固定数量的工作线程按块下载。本地有旧版本时只下载内容变了的块
+    def startDownload(self,filename,fileInfo,localFile=None):
+        fileInfo=self.withoutSelf(fileInfo)
+        if fileInfo["blockNum"]>0 and (len(fileInfo.get("blocks",()))!=fileInfo["blockNum"]
+                                       or IOUtils.getHashRoot(fileInfo["blocks"],self.hashAlgo)!=fileInfo.get("root")):
+            #块hash列表和根对不上，无法逐块校验，等目录更新后再试
+            log.warning(filename+" 块hash列表无效，稍后重试")
+            self.lock.acquire()
+            self.fileInProcess.discard(filename)
+            self.retryNames.add(filename)
+            self.lock.release()
+            return
+        if self.rolling and fileInfo.get("weak") and localFile is not None and localFile.get("blocks"):
+            #滚动校验要在旧文件中逐字节扫描，很慢，放到localCopies线程中做，不阻塞心跳
+            self.localCopies.submit(self.planInBackground,filename,fileInfo,localFile)
+            return
+        self.planDownload(filename,fileInfo,localFile)
+
+    #在localCopies线程中规划下载，出错时放弃，下一次sync时重新比对
+    def planInBackground(self,filename,fileInfo,localFile):
+        try:
+            self.planDownload(filename,fileInfo,localFile)
+        except Exception as e:
+            log.exception('Plan error: %s', e)
+            self.lock.acquire()
+            self.fileInProcess.discard(filename)
+            self.retryNames.add(filename)
+            self.lock.release()
 
-    # 索取文件
-    def getFileFromPeer(self,filename,fileInfo):                     
-        targetPath=target=sys.path[0] + os.sep + filename
-        if fileInfo["blockNum"]==0:
-            self.getSingleFile(filename,fileInfo)
-        else:                                             #多块文件，每个块开一个线程
-            tPool=[]            #线程池
-            for idx in range(fileInfo["blockNum"]):
-                t=threading.Thread(target=self.getSingleFile,args=(filename,fileInfo,idx+1))
-                t.start()
-                tPool.append(t)
-            
-            for t in tPool:       #等待各block接收完成
-                t.join()   
-
-            #下面合并blocks
-            prefix=sys.path[0] + os.sep + 'MEtemp' +os.sep+filename+ '_PART'         
-            IOUtils.combineFile(prefix,targetPath,fileInfo["blockNum"])
-            os.utime(filename, (os.path.getatime(filename), fileInfo["mtime"]))
-
-        #下面hash校验     如果整个文件不对，重新调用该函数
-        md5 = IOUtils.getMD5(targetPath)
-        if(md5!=fileInfo["md5"]):
-            print(targetPath+" md5校验错误，重新获取文件")
-            if(os.path.exists(sys.path[0]+os.sep+filename)):        #先删除错误文件
-                os.remove(sys.path[0]+os.sep+filename)
-                if(fileInfo["blockNum"]!=0):
-                    IOUtils.delFileBlocks(sys.path[0]+os.sep+filename,fileInfo["blockNum"])
-            self.getFileFromPeer(filename,fileInfo)
+    #比对下载日志和本地文件，决定哪些块从本地拷贝、哪些块从网络下载，然后交给调度器
+    def planDownload(self,filename,fileInfo,localFile):
+        #下载日志中已经完成的块不用再取，日志的版本不对或临时文件不在了就从头开始
+        #不分块的文件只有一块，没有可以续传的部分，不写下载日志，大量小文件时省掉每个文件的日志读写
+        journaled=fileInfo["blockNum"]>0
+        have=self.journal.resume(filename,fileInfo) if journaled else None
+        if have is not None and not self.tempIntact(filename,fileInfo):
+            have=None
+        if have is None:
+            self.dropTransfer(filename)
+            have=BlockBitmap(fileInfo["blockNum"] or 1)
+        done=[idx for idx in self.blockList(fileInfo) if have.has(idx)]
+
+        reuse=self.planReuse(filename,fileInfo,localFile)
+        for idx in done:
+            reuse.pop(idx,None)
+        blocks=[idx for idx in self.blockList(fileInfo) if idx not in reuse and not have.has(idx)]
+        if not blocks:
+            #每一块都在本地的文件里或者已经收到(比如收完最后一块之后、替换到位之前进程退出)，不用经过网络
+            self.localCopies.submit(self.assembleLocal,filename,fileInfo,reuse,done)
+            return
+        if done:
+            log.info("%s: resuming with %d of %d blocks already received", filename, len(done), len(self.blockList(fileInfo)))
+        if reuse:
+            log.info("%s: %d of %d blocks reused from local files", filename, len(reuse), len(self.blockList(fileInfo)))
+        if journaled:
+            self.journal.begin(filename,fileInfo,have)
+        self.scheduler.submit(FileTask(filename,fileInfo,blocks,
+                                       fileInfo["holders"],fileInfo.get("partials",()),reuse,done))
+
+    #返回可以从本地拷贝的块 {块序号: (本地文件名, 偏移)}
+    #先比较本地旧版本相同位置的块；滚动校验模式下再在旧文件中按字节滑动寻找剩下的块，处理中间插入或删除了数据的情况；
+    #剩下的块再到块索引中找其它本地文件里内容相同的块
+    def planReuse(self,filename,fileInfo,localFile):
+        blockBytes=ConversionUtils.megabytes2Bytes(self.blockSize)
+        remoteBlocks=fileInfo.get("blocks")
+        reuse={}
+        if localFile is not None and remoteBlocks and localFile.get("blocks"):
+            localBlocks=localFile["blocks"]
+            for i, md5 in enumerate(remoteBlocks):
+                if i < len(localBlocks) and localBlocks[i] == md5:
+                    reuse[i+1]=(filename,i*blockBytes)
+
+            weaks=fileInfo.get("weak")
+            if self.rolling and weaks:
+                wanted={}
+                for i, md5 in enumerate(remoteBlocks):
+                    fullBlock=(i+1)*blockBytes <= fileInfo["size"]
+                    if i+1 not in reuse and fullBlock:
+                        wanted.setdefault(weaks[i],[]).append((i+1,md5))
+                for idx, offset in IOUtils.findBlocks(local_path(filename),blockBytes,wanted,algo=self.hashAlgo,
+                                                      maxSeconds=FileSynchronizer.ROLLING_SECONDS).items():
+                    reuse[idx]=(filename,offset)
+
+        if fileInfo["size"] > 0:
+            for idx in self.blockList(fileInfo):
+                if idx not in reuse:
+                    found=self.blockIndex.find(self.blockMD5(fileInfo,idx),self.blockLength(fileInfo,idx))
+                    if found is not None:
+                        reuse[idx]=found
+        return reuse
+
+    #目录中的来源可能包括本节点自己(正在下载的文件也会宣告)，去掉它
+    def withoutSelf(self,fileInfo):
+        if fileInfo is None or self.selfAddr is None:
+            return fileInfo
+        me=list(self.selfAddr)
+        fileInfo=dict(fileInfo)
+        fileInfo["holders"]=[holder for holder in fileInfo["holders"] if holder!=me]
+        fileInfo["partials"]=[partial for partial in fileInfo.get("partials",()) if partial[:2]!=me]
+        return fileInfo
+
+    #正在接收的文件先写到MEtemp下的临时文件，收完校验通过后再rename到目标位置
+    #临时文件都放在MEtemp下一层，相对路径中的/转义掉
+    def tempPathOf(self,filename):
+        return sys.path[0] + os.sep + 'MEtemp' + os.sep + urllib.parse.quote(filename, safe='') + '.part'
+
+    #临时文件还在并且大小正确，下载日志中的块才能用
+    def tempIntact(self,filename,fileInfo):
+        try:
+            return os.path.getsize(self.tempPathOf(filename))==fileInfo["size"]
+        except OSError:
+            return False
 
-        else:
+    #丢弃文件的下载日志和临时文件
+    def dropTransfer(self,filename):
+        self.journal.remove(filename)
+        try:
+            os.remove(self.tempPathOf(filename))
+        except FileNotFoundError:
+            pass
+
+    #启动后第一次拿到完整目录时清理MEtemp，此时还没有开始任何下载:
+    #目录中已经没有的文件的下载日志和临时文件都删掉，写到一半的日志临时文件也删掉。
+    #否则下载中途进程退出、之后文件又从目录中删除时，它们会一直留在MEtemp里
+    def sweepTemp(self):
+        tempDir=sys.path[0] + os.sep + 'MEtemp'
+        try:
+            entries=os.listdir(tempDir)
+        except OSError:
+            return
+        removed=0
+        for entry in entries:
+            if entry.endswith('.journal.tmp'):
+                try:
+                    os.remove(tempDir + os.sep + entry)
+                except OSError:
+                    pass
+                continue
+            for suffix in ('.part', '.journal'):
+                if entry.endswith(suffix) and urllib.parse.unquote(entry[:-len(suffix)]) not in self.remoteFiles:
+                    self.dropTransfer(urllib.parse.unquote(entry[:-len(suffix)]))
+                    removed+=1
+        if removed:
+            log.info('removed %d stale transfer files from %s', removed, tempDir)
+
+    #打开文件的临时文件，第一次时按最终大小预分配，并从本地旧版本拷贝可以复用的块。
+    #各个块直接写入自己的偏移处，不再需要合并
+    def openTask(self,task):
+        with task.lock:
+            if task.fd is None:
+                task.fd=IOUtils.preallocate(self.tempPathOf(task.name),task.size)
+                if task.reuse:
+                    self.copyReused(task)
+            return task.fd
+
+    #从本地文件拷贝可以复用的块，拷贝失败或校验不通过的块改为从网络下载
+    def copyReused(self,task):
+        good=self.copyBlocks(task)
+        self.journalBlocks(task,good)
+        self.scheduler.markHave(task,good)
+        bad=[idx for idx in task.reuse if idx not in good]
+        if bad:
+            log.warning("%s: %d reused blocks changed on disk, downloading them", task.name, len(bad))
+            self.scheduler.addBlocks(task,bad)
+
+    #把task.reuse中的块从本地文件拷贝到临时文件，返回成功的块序号
+    #拷贝时和收到的块一样按块hash校验，来源文件在规划之后又被改过的话对不上的块不算成功
+    def copyBlocks(self,task):
+        good=[]
+        fds={}
+        try:
+            for idx, (source, offset) in sorted(task.reuse.items()):
+                if source not in fds:
+                    try:
+                        fds[source]=os.open(local_path(source), os.O_RDONLY)
+                    except OSError as e:
+                        log.warning('Copy error: %s', e)
+                        fds[source]=None
+                srcFd=fds[source]
+                if srcFd is None:
+                    continue
+                length=self.blockLength(task.info,idx)
+                sink=BlockSink(task.fd,self.blockOffset(idx),self.blockMD5(task.info,idx),length,algo=self.hashAlgo)
+                while sink.received < length:
+                    data=os.pread(srcFd, min(length-sink.received, 1048576), offset+sink.received)
+                    if not data:
+                        break
+                    sink.feed(data)
+                sink.close()
+                if sink.ok:
+                    good.append(idx)
+                    if source!=task.name:
+                        self.dedupBytes.inc(length)
+        except OSError as e:
+            log.warning('Copy error: %s', e)
+        finally:
+            for srcFd in fds.values():
+                if srcFd is not None:
+                    os.close(srcFd)
+        return good
+
+    #文件的每一块都能从本地文件拷贝，或者已经收到(done，下载日志中记录过，在临时文件里): 在localCopies线程中
+    #拼出临时文件并直接替换到位。有块拷贝失败时，已经拷贝好的块保留，剩下的块交给调度器从网络下载
+    def assembleLocal(self,filename,fileInfo,reuse,done=()):
+        task=FileTask(filename,fileInfo,[],fileInfo["holders"],fileInfo.get("partials",()),reuse,done)
+        try:
+            task.fd=IOUtils.preallocate(self.tempPathOf(filename),task.size)     #已经收到的块保留在临时文件中
+            good=self.copyBlocks(task)+list(done)
+            bad=[idx for idx in self.blockList(fileInfo) if idx not in good]
+            if not bad:
+                os.fsync(task.fd)
+                self.closeTask(task)
+                if self.finishFile(filename,fileInfo):
+                    if fileInfo["blockNum"]>0:
+                        self.journal.remove(filename)
+                    self.localFiles.inc()
+                    log.info("%s: built from %d local and %d already received blocks", filename, len(good)-len(done), len(done))
+                    self.lock.acquire()
+                    self.fileInProcess.discard(filename)
+                    self.lock.release()
+                    return
+                self.dropTransfer(filename)
+                self.abortTask(task)
+                return
+        except Exception as e:
+            log.exception('Copy error: %s', e)
+            self.closeTask(task)
+            self.dropTransfer(filename)
+            self.abortTask(task)
+            return
+        log.warning("%s: %d local blocks changed on disk, downloading them", filename, len(bad))
+        remote=FileTask(filename,fileInfo,bad,fileInfo["holders"],fileInfo.get("partials",()),None,good)
+        remote.fd=task.fd
+        if fileInfo["blockNum"]>0:
+            self.journal.begin(filename,fileInfo,remote.have)
+        self.scheduler.submit(remote)
+
+    def closeTask(self,task):
+        with task.lock:
+            if task.fd is not None:
+                os.close(task.fd)
+                task.fd=None
+
+    #调度器回调: 从peer下载一批块，返回失败的块序号
+    def fetchTask(self,task,peer,idxs):
+        return self.getBlocks(task.name,task.info,peer,self.openTask(task),idxs,
+                              lambda idx: self.journalBlocks(task,[idx]))
+
+    #调度器回调: 在一个请求里从peer取回一组小文件，每个文件边收边写入自己的临时文件并校验，返回失败的task
+    def fetchBundle(self,tasks,peer):
+        byName=dict((task.name,task) for task in tasks)
+        sinks={}
+
+        def openSink(request,header):
+            task=byName[request["name"]]
+            self.checkHeader(header,task.size)
+            sinks[task.name]=BlockSink(self.openTask(task),0,task.info["md5"],task.size,algo=self.hashAlgo)
+            return sinks[task.name]
+
+        requests=[self.blockRequest(task.name,task.info,0) for task in tasks]
+        conn=None
+        start=time.monotonic()
+        try:
+            conn=self.pool.acquire(peer)
+            conn.fetchBundle(requests,openSink,throttle=self.throttleOf('download',peer,max(task.size for task in tasks)))
+            self.pool.release(conn)
+        except (socket.error, ConnectionError, ValueError) as e:
+            log.warning('Socket error: %s', e)
+            if conn is not None:
+                self.pool.discard(conn)
+        failed=self.collectBlocks('%d small files' % len(tasks),peer,list(byName),sinks,time.monotonic()-start)
+        return [byName[name] for name in failed]
+
+    #块数据落盘之后再记入下载日志。临时文件此时一定已经打开(copyReused中还持有task.lock)
+    def journalBlocks(self,task,idxs):
+        if idxs:
+            os.fdatasync(task.fd)
+            self.journal.record(task.name,idxs)
+
+    #调度器回调: 所有块都收到并校验过了，替换到目标位置
+    def finishTask(self,task):
+        os.fsync(self.openTask(task))
+        self.closeTask(task)
+        journaled=task.info["blockNum"]>0
+        if not self.finishFile(task.name,task.info):
+            if journaled:
+                self.journal.begin(task.name,task.info,BlockBitmap(task.count))     #所有块都要重新下载
+            return False
+        if journaled:
+            self.journal.remove(task.name)
+        self.lock.acquire()
+        self.fileInProcess.discard(task.name)
+        self.lock.release()
+        return True
+
+    #调度器回调: 文件多次失败被放弃，下一次sync时重新比对、重新发起
+    def abortTask(self,task):
+        try:
+            self.closeTask(task)
+        finally:
             self.lock.acquire()
-            self.fileInProcess.remove(filename)
+            self.fileInProcess.discard(task.name)
+            self.retryNames.add(task.name)
             self.lock.release()
-            print(targetPath+" md5校验成功")
+        log.warning(task.name+" 下载失败，稍后重试")
 
-            #删除分块文件
-            # if(fileInfo["blockNum"]!=0):
-            #     IOUtils.delFileBlocks(sys.path[0]+os.sep+filename,fileInfo["blockNum"])
+    #文件的所有块序号，不分块的文件只有一个0号块
+    def blockList(self,fileInfo):
+        if fileInfo["blockNum"]==0:
+            return [0]
+        return list(range(1,fileInfo["blockNum"]+1))
 
-    
-    def getSingleFile(self,filename,fileInfo,idx=0):                   
-        fileSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        fileSocket.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-        fileSocket.settimeout(60.0)
-        fileSocket.connect((fileInfo["ip"], fileInfo["port"]))
-        report={"name":filename,"blockIdx":idx}
-        fileSocket.send(bytes(json.dumps(report), 'utf-8')) 
+    #第idx块应有的md5: 分块的文件取块hash列表中的一项，不分块的文件就是整个文件的md5
+    def blockMD5(self,fileInfo,idx):
+        if idx==0:
+            return fileInfo["md5"]
+        return fileInfo["blocks"][idx-1]
 
+    #块在文件中的偏移
+    def blockOffset(self,idx):
         if idx==0:
-            target=sys.path[0] + os.sep + filename
-        else:
-            target=sys.path[0] + os.sep + 'MEtemp' +os.sep+filename+ '_PART' + str(idx)
+            return 0
+        return (idx-1)*ConversionUtils.megabytes2Bytes(self.blockSize)
 
+    #块的长度，最后一块可能不满，0号块就是整个文件
+    def blockLength(self,fileInfo,idx):
+        if idx==0:
+            return fileInfo["size"]
+        return min(ConversionUtils.megabytes2Bytes(self.blockSize),fileInfo["size"]-self.blockOffset(idx))
+
+    #响应头中的长度必须和目录中的块长度一致(没有这个块的出错响应不带数据)，接收时最多写入这么多数据
+    #不一致时不写入任何数据，抛出ValueError: 连接上后面的数据已经无法对齐，这条连接上剩下的块都算失败
+    def checkHeader(self,header,length):
+        size=header.get("size")
+        if size!=length and not (header.get("error") and size==0):
+            raise ValueError('block size %r does not match the catalog (%d bytes)' % (size,length))
+
+    #所有块都已经在接收时按块hash校验过，不用再把整个文件读一遍，直接原子地替换到目标位置。
+    #文件的hash也已知，直接写入hash缓存。返回是否成功
+    def finishFile(self,filename,fileInfo):
+        targetPath=local_path(filename)
+        tempPath=self.tempPathOf(filename)
         try:
-            md5=fileSocket.recv(32).decode()   
-            print(target+" md5:"+" "+md5)     
-
-            if not os.path.exists(sys.path[0] + os.sep + 'MEtemp'):
-                os.mkdir(sys.path[0] + os.sep + 'MEtemp')      #创建缓存文件夹
-            
-            recvSize=0
-            
-            with open(target, "wb") as file:
-                while True:
-                    content = fileSocket.recv(self.BUFFER_SIZE)
-                    file.write(content)
-                    recvSize+=len(content)
-
-                    #if len(content) < self.BUFFER_SIZE:
-                    if len(content)==0:
-                        break
-                    #time.sleep(0.1)
+            with self.finishSeconds.time():
+                os.makedirs(os.path.dirname(targetPath), exist_ok=True)     #子目录在接收方按需创建
+                os.utime(tempPath, (time.time(), fileInfo["mtime"]))
+                os.replace(tempPath, targetPath)
+                self.hashCache.put(filename, targetPath, fileInfo["md5"], fileInfo.get("blocks", []), fileInfo.get("weak"))
+        except OSError as e:
+            log.error(targetPath+" 替换失败: %s", e)
+            return False
+        self.filesCompleted.inc()
+        log.info(targetPath+" 接收完成")
+        return True
+
+    
+    #在到来源peer的长连接上流水线请求一批块，直接pwrite到临时文件中各块的偏移处
+    #每个块边收边算md5，和目录中的块hash比较，通过后调用onBlock(块序号)。返回没有成功接收(连接出错或md5不对)的块序号
+    def getBlocks(self,filename,fileInfo,peer,fd,idxs,onBlock=None):                   
+        sinks={}
+
+        def openSink(request,header):
+            idx=request["blockIdx"]
+            onDone=(lambda: onBlock(idx)) if onBlock is not None else None
+            length=self.blockLength(fileInfo,idx)
+            self.checkHeader(header,length)
+            sinks[idx]=BlockSink(fd,self.blockOffset(idx),self.blockMD5(fileInfo,idx),length,onDone,self.hashAlgo)
+            return sinks[idx]
+
+        requests=[self.blockRequest(filename,fileInfo,idx) for idx in idxs]
+        conn=None
+        start=time.monotonic()
+        try:
+            conn=self.pool.acquire(peer)
+            conn.fetch(requests,openSink,throttle=self.throttleOf('download',peer,fileInfo["size"]))
+            self.pool.release(conn)
+        except (socket.error, ConnectionError, ValueError) as e:
+            log.warning('Socket error: %s', e)
+            if conn is not None:
+                self.pool.discard(conn)
+        return self.collectBlocks(filename,peer,idxs,sinks,time.monotonic()-start)
+
+    #一个块请求，启用了压缩时带上可以接受的压缩方式
+    def blockRequest(self,filename,fileInfo,idx):
+        request={"name":filename,"md5":fileInfo["md5"],"blockIdx":idx}
+        if self.compress:
+            request["compress"]=self.compress
+        return request
+
+    #统计一批块的接收结果，记录该peer的速度和指标，返回失败的块序号
+    #速度按解压后的字节数计算，即有效吞吐量；压缩传输时同时给出网络上的字节数和压缩比
+    def collectBlocks(self,filename,peer,idxs,sinks,seconds):
+        failed=[]
+        received=0
+        wireBytes=0
+        for idx in idxs:
+            sink=sinks.get(idx)
+            if sink is None or not sink.ok:
+                failed.append(idx)
+            else:
+                received+=sink.received
+                wireBytes+=sink.wireBytes
+        throughput=received/1048576/max(seconds,1e-6)
+        self.blocksReceived.inc(len(idxs)-len(failed))
+        self.blocksFailed.inc(len(failed))
+        self.downloadBytes.inc(received)
+        self.downloadWireBytes.inc(wireBytes)
+        self.batchSeconds.observe(seconds)
+        if received > 0:
+            self.batchThroughput.observe(throughput)
+        log.log(logging.WARNING if failed else logging.DEBUG, 'blocks received',
+                extra=Log.fields(file=filename, blocks=len(idxs)-len(failed), failed=len(failed), bytes=received,
+                                 wire=wireBytes, peer='%s:%s' % (peer[0], peer[1]), seconds=round(seconds,4),
+                                 mbps=round(throughput,1)))
+        if received > 0 and wireBytes < received:
+            log.info("%s: %d bytes in %d on the wire (ratio %.2f), effective %.1f MB/s",
+                     filename, received, wireBytes, received / max(wireBytes, 1), throughput)
+        self.scheduler.recordSpeed(peer,received,seconds)
+        return failed
+        
 
-        except socket.error as e:
-            print('Socket error: %s' % e)
-        fileSocket.close()
 
-        print(target+" received "+str(recvSize)+ "bytes")
+class AsyncFileSynchronizer(FileSynchronizer):
+    '''
+    asyncio版本的peer，协议和线程版完全相同
+    一个事件循环处理所有块服务连接和块下载，不再每个连接/文件开一个线程。
+    阻塞的磁盘操作(打开文件算md5、pwrite、fsync、校验)交给一个固定大小的线程池，
+    同步(扫描目录、与tracker通信)在单独的一个线程里执行。总线程数固定，与并发传输数无关
+    '''
+    def __init__(self, trackerhost, trackerport, port, host='0.0.0.0', scheduler=None, diskWorkers=4, rolling=False,
+                 rescanInterval=300, hashAlgo='md5', hashWorkers=4, compress=None, limiter=None, limitsFile=None,
+                 catalogEncoding='json'):
+        FileSynchronizer.__init__(self, trackerhost, trackerport, port, host, scheduler, rolling, rescanInterval,
+                                  hashAlgo, hashWorkers, compress, limiter, limitsFile, catalogEncoding)
+        self.diskWorkers = diskWorkers
+        self.loop = None
+        #到其他peer的空闲长连接 (ip, port) -> [(reader, writer, 归还时间)]，和线程版的ConnectionPool一样复用，
+        #只在事件循环中使用，不用加锁
+        self.streams = {}
 
-        if idx==0:
-            os.utime(filename, (os.path.getatime(filename), fileInfo["mtime"]))
-        
-        if(md5!=IOUtils.getMD5(target)):
-            #print(target+" 文件md5:"+" "+IOUtils.getMD5(target)) 
-            print(target+" md5校验错误，重新获取文件")
-            if(os.path.exists(target)):
-                os.remove(target)
-            self.getSingleFile(filename,fileInfo,idx)       #重新调用函数
-        
+    def run(self):
+        asyncio.run(self.main())
+
+    async def main(self):
+        self.loop = asyncio.get_running_loop()
+        self.diskPool = ThreadPoolExecutor(self.diskWorkers)
+        self.syncPool = ThreadPoolExecutor(1)
+
+        #调度器由协程而不是线程消费，有新任务时唤醒它们
+        self.jobReady = asyncio.Event()
+        self.scheduler.notify = lambda: self.loop.call_soon_threadsafe(self.jobReady.set)
+        for i in range(self.scheduler.workers):
+            asyncio.ensure_future(self.downloadWorker())
+
+        self.server.setblocking(False)
+        server = await asyncio.start_server(self.serveClient, sock=self.server)
+        log.info('Waiting for connections on port %s (asyncio)', self.port)
+        self.watcher.start()
+        async with server:
+            while True:
+                await self.loop.run_in_executor(self.syncPool, self.waitSync, 5)
+                await self.loop.run_in_executor(self.syncPool, self.syncStep)
+
+    #把阻塞的磁盘操作放到磁盘线程池中执行
+    def runDisk(self, func, *args):
+        return self.loop.run_in_executor(self.diskPool, func, *args)
+
+    #块服务: 和process_message一样，一个连接上可以流水线请求多个块
+    async def serveClient(self, reader, writer):
+        addr = writer.get_extra_info('peername')
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        log.debug('Client connected with %s:%s', addr[0], addr[1])
+        self.uploadConnections.inc()
+        try:
+            while True:
+                requestMsg = await asyncio.wait_for(NetUtils.readMsg(reader), 60.0)
+                if requestMsg is None:
+                    break
+                for request in self.bundleOf(requestMsg):
+                    await self.serveBlock(writer, request, addr)
+        except asyncio.TimeoutError:
+            log.info("Conn socket timeout!")
+        except (OSError, ConnectionError) as e:
+            log.warning('Socket error: %s', e)
+        except (ValueError, KeyError, TypeError, IndexError):
+            log.warning('Incorrect format (JSON required)')
+        self.uploadConnections.dec()
+        writer.close()
+
+    #发送一个块，和sendBlock相同
+    async def serveBlock(self, writer, requestMsg, addr):
+        file, offset, header = await self.runDisk(self.openBlock, requestMsg)
+        NetUtils.writeMsg(writer, header)
+        await writer.drain()
+        if file is None:
+            return
+        throttle = self.throttleAsync('upload', addr, os.fstat(file.fileno()).st_size)
+        start = time.monotonic()
+        if header.get("encoding"):
+            with file:
+                sendSize = await self.sendFramesAsync(writer, file.fileno(), offset, header["size"],
+                                                      header["encoding"], throttle=throttle)
+        else:
+            with file:
+                sendSize = await self.sendFileAsync(writer, file, offset, header["size"], throttle)
+            if sendSize != header["size"]:
+                raise ConnectionError(file.name+' shrank while sending')
+        self.blockSent(file.name, header, sendSize, addr, time.monotonic() - start)
+
+    #asyncio版的限速回调: 返回一个协程函数，没有限速时返回None
+    def throttleAsync(self, direction, peer, fileSize):
+        if not self.limiter.limited(direction):
+            return None
+        urgent = self.limiter.isUrgent(fileSize)
+
+        async def throttle(n):
+            wait = self.limiter.reserve(direction, peer, n, urgent)
+            if wait > 0:
+                await asyncio.sleep(wait)
+        return throttle
+
+    #和NetUtils.sendFile相同: loop.sendfile在支持的平台上使用os.sendfile零拷贝发送，有限速时分段发送
+    async def sendFileAsync(self, writer, file, offset, size, throttle=None, chunkSize=262144):
+        if throttle is None:
+            return await self.loop.sendfile(writer.transport, file, offset, size)
+        sent = 0
+        while sent < size:
+            count = min(chunkSize, size - sent)
+            await throttle(count)
+            count = await self.loop.sendfile(writer.transport, file, offset + sent, count)
+            if count == 0:
+                break
+            sent += count
+        return sent
+
+    #和NetUtils.sendFrames相同的压缩发送，读文件和压缩在磁盘线程池中进行，返回发送的压缩数据字节数
+    async def sendFramesAsync(self, writer, fd, offset, size, encoding, chunkSize=1048576, throttle=None):
+        compressor = Compression.compressor(encoding)
+        sent = 0
+        end = offset + size
+        while offset < end:
+            data = await self.runDisk(os.pread, fd, min(chunkSize, end - offset), offset)
+            if not data:
+                raise ConnectionError('file shrank while sending')
+            offset += len(data)
+            out = await self.runDisk(compressor.compress, data)
+            if out:
+                if throttle is not None:
+                    await throttle(len(out))
+                writer.write(NetUtils.HEADER.pack(len(out)) + out)
+                sent += len(out)
+                await writer.drain()
+        out = compressor.flush()
+        if out:
+            writer.write(NetUtils.HEADER.pack(len(out)) + out)
+            sent += len(out)
+        writer.write(NetUtils.HEADER.pack(0))
+        await writer.drain()
+        return sent
+
+    #接收压缩数据帧，解压在磁盘线程池中进行，解压后的数据写入sink
+    async def recvFramesAsync(self, reader, sink, encoding, throttle=None):
+        decompressor = Compression.decompressor(encoding)
+        remaining = sink.expectedSize
+        while True:
+            frameHeader = await asyncio.wait_for(reader.readexactly(NetUtils.HEADER.size), 60.0)
+            length = NetUtils.HEADER.unpack(frameHeader)[0]
+            if length == 0:
+                break
+            if length > NetUtils.MAX_MESSAGE:
+                raise ValueError('frame too large: %d bytes' % length)
+            data = await asyncio.wait_for(reader.readexactly(length), 60.0)
+            sink.wireBytes += length
+            if throttle is not None:
+                await throttle(length)
+            out = await self.runDisk(Compression.decompress, decompressor, data, remaining)
+            if out:
+                await self.runDisk(sink.feed, out)
+                remaining -= len(out)
+
+    #下载协程: 和DownloadScheduler的工作线程做同样的事，只是块传输是异步的
+    async def downloadWorker(self):
+        while True:
+            self.jobReady.clear()
+            batch = self.scheduler.take(block=False)
+            if batch is None:
+                try:
+                    await asyncio.wait_for(self.jobReady.wait(), 1.0)    #有退避中的块时需要定时醒来
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            task, peer, idxs = batch
+            if isinstance(task, FileBundle):
+                try:
+                    failed = await self.getBundleAsync(task.tasks, peer)
+                except Exception as e:
+                    log.exception('Download error: %s', e)
+                    failed = task.tasks
+                states = self.scheduler.completeBundle(task, peer, failed)
+            else:
+                try:
+                    fd = await self.runDisk(self.openTask, task)
+                    failed = await self.getBlocksAsync(task.name, task.info, peer, fd, idxs,
+                                                       lambda idx: self.journalBlocks(task, [idx]))
+                except Exception as e:
+                    log.exception('Download error: %s', e)
+                    failed = idxs
+                states = [(task, self.scheduler.complete(task, peer, idxs, failed))]
+            #和工作线程一样，完成或放弃文件时出错也不能让协程退出，否则这个文件一直留在下载中
+            for task, state in states:
+                if state == 'done':
+                    try:
+                        ok = await self.runDisk(self.finishTask, task)
+                    except Exception as e:
+                        log.exception('Finish error: %s', e)
+                        ok = False
+                    if not self.scheduler.finished(task, ok):
+                        await self.abortAsync(task)
+                elif state == 'aborted':
+                    await self.abortAsync(task)
+
+    #放弃文件，清理时出错只记录下来
+    async def abortAsync(self, task):
+        try:
+            await self.runDisk(self.abortTask, task)
+        except Exception as e:
+            log.exception('Abort error: %s', e)
+
+    #与getBlocks相同: 一条连接上流水线请求一批块，每个块校验通过后在磁盘线程池中调用onBlock(块序号)，返回失败的块序号
+    async def getBlocksAsync(self, filename, fileInfo, peer, fd, idxs, onBlock=None, window=16, chunkSize=1048576):
+        sinks = {}
+        writer = None
+        start = time.monotonic()
+        throttle = self.throttleAsync('download', peer, fileInfo["size"])
+        try:
+            reader, writer = await self.openStream(peer)
+            sent = 0
+            for idx in idxs:
+                while sent < len(idxs) and sent - len(sinks) < window:
+                    NetUtils.writeMsg(writer, self.blockRequest(filename, fileInfo, idxs[sent]))
+                    sent += 1
+                await writer.drain()
+
+                header = await asyncio.wait_for(NetUtils.readMsg(reader), 60.0)
+                if header is None:
+                    raise ConnectionError('peer closed the connection')
+                length = self.blockLength(fileInfo, idx)
+                self.checkHeader(header, length)
+                sink = BlockSink(fd, self.blockOffset(idx), self.blockMD5(fileInfo, idx), length, algo=self.hashAlgo)
+                await self.recvBlockAsync(reader, sink, header, throttle, chunkSize)
+                sinks[idx] = sink
+                if sink.ok and onBlock is not None:
+                    await self.runDisk(onBlock, idx)
+            #所有响应都收完了，连接上没有残留的数据，可以给下一批用
+            self.releaseStream(peer, reader, writer)
+            writer = None
+        except (OSError, ConnectionError, ValueError, KeyError, TypeError, AttributeError, EOFError,
+                asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            log.warning('Socket error: %s', e)
+        if writer is not None:
+            writer.close()
+
+        return self.collectBlocks(filename, peer, idxs, sinks, time.monotonic() - start)
+
+    #与fetchBundle相同: 一个请求取回一组小文件，每个文件边收边写入自己的临时文件并校验，返回失败的task
+    async def getBundleAsync(self, tasks, peer, chunkSize=1048576):
+        byName = dict((task.name, task) for task in tasks)
+        sinks = {}
+        writer = None
+        start = time.monotonic()
+        throttle = self.throttleAsync('download', peer, max(task.size for task in tasks))
+        try:
+            reader, writer = await self.openStream(peer)
+            NetUtils.writeMsg(writer, {"bundle": [self.blockRequest(task.name, task.info, 0) for task in tasks]})
+            await writer.drain()
+            for task in tasks:
+                header = await asyncio.wait_for(NetUtils.readMsg(reader), 60.0)
+                if header is None:
+                    raise ConnectionError('peer closed the connection')
+                self.checkHeader(header, task.size)
+                fd = await self.runDisk(self.openTask, task)
+                sink = BlockSink(fd, 0, task.info["md5"], task.size, algo=self.hashAlgo)
+                await self.recvBlockAsync(reader, sink, header, throttle, chunkSize)
+                sinks[task.name] = sink
+            self.releaseStream(peer, reader, writer)
+            writer = None
+        except (OSError, ConnectionError, ValueError, KeyError, TypeError, AttributeError, EOFError,
+                asyncio.TimeoutError, asyncio.IncompleteReadError) as e:
+            log.warning('Socket error: %s', e)
+        if writer is not None:
+            writer.close()
+        failed = self.collectBlocks('%d small files' % len(tasks), peer, list(byName), sinks, time.monotonic() - start)
+        return [byName[name] for name in failed]
+
+    #取一条到peer的连接: 优先复用空闲的长连接，空闲太久的对端可能已经关闭，直接丢弃
+    async def openStream(self, peer):
+        peer = tuple(peer)
+        now = time.monotonic()
+        idle = self.streams.get(peer, [])
+        while idle:
+            reader, writer, returned = idle.pop()
+            if now - returned < self.pool.idleTimeout and not writer.is_closing() and not reader.at_eof():
+                return reader, writer
+            writer.close()
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(peer[0], peer[1]), 60.0)
+        writer.get_extra_info('socket').setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return reader, writer
+
+    #用完归还，下次请求同一个peer时复用
+    def releaseStream(self, peer, reader, writer):
+        self.streams.setdefault(tuple(peer), []).append((reader, writer, time.monotonic()))
+
+    #接收一个块的数据(header之后的部分)写入sink并校验。header已经用checkHeader检查过，最多写入sink.expectedSize字节
+    async def recvBlockAsync(self, reader, sink, header, throttle, chunkSize):
+        remaining = min(header["size"], sink.expectedSize)
+        if header.get("encoding"):
+            await self.recvFramesAsync(reader, sink, header["encoding"], throttle)
+            remaining = 0
+        else:
+            sink.wireBytes = remaining
+        buffer = bytearray()
+        while remaining > 0:
+            data = await asyncio.wait_for(reader.read(min(remaining, chunkSize)), 60.0)
+            if not data:
+                raise ConnectionError('connection closed with %d bytes missing' % remaining)
+            remaining -= len(data)
+            buffer += data
+            if throttle is not None:
+                await throttle(len(data))
+            #攒够一段再交给磁盘线程写，减少线程切换
+            if len(buffer) >= chunkSize or remaining == 0:
+                await self.runDisk(sink.feed, buffer)
+                buffer = bytearray()
+        sink.close()
 
 
 if __name__ == '__main__':
     # parse command line arguments  命令行传入tracker的ip:port
-    parser = optparse.OptionParser(usage="%prog ServerIP ServerPort")
+    parser = optparse.OptionParser(usage="%prog [options] ServerIP ServerPort")
+    parser.add_option("-e", "--engine", dest="engine", default="thread", choices=["thread", "async"],
+                      help="peer runtime: thread (one thread per connection/file) or async (asyncio event loop, python3.7+)")
+    parser.add_option("--workers", dest="workers", type="int", default=8,
+                      help="number of download workers")
+    parser.add_option("--max-inflight", dest="maxInFlight", type="int", default=64,
+                      help="max blocks being downloaded at the same time")
+    parser.add_option("--max-per-peer", dest="maxPerPeer", type="int", default=16,
+                      help="max blocks being downloaded from one peer at the same time")
+    parser.add_option("--bundle-files", dest="bundleFiles", type="int", default=64,
+                      help="max small unsplit files fetched from a peer in one request (1: one request per file, "
+                           "at most %d)" % FileSynchronizer.MAX_BUNDLE)
+    parser.add_option("--rescan", dest="rescanInterval", type="int", default=300,
+                      help="seconds between full directory rescans when inotify is watching the directory "
+                           "(at most 60 without inotify, when each heartbeat only checks directory mtimes)")
+    parser.add_option("--hash", dest="hashAlgo", default="md5", choices=["md5", "blake2b"],
+                      help="content hash algorithm to start with; the tracker's choice wins")
+    parser.add_option("--hash-workers", dest="hashWorkers", type="int", default=4,
+                      help="number of threads hashing files in parallel during full scans")
+    parser.add_option("--compress", dest="compress", default="none", choices=["none", "zlib", "lzma"],
+                      help="ask peers to compress blocks sent to us (they send incompressible blocks raw)")
+    parser.add_option("--upload-limit", dest="uploadLimit", type="float", default=0,
+                      help="total upload rate limit in MB/s (0: unlimited)")
+    parser.add_option("--download-limit", dest="downloadLimit", type="float", default=0,
+                      help="total download rate limit in MB/s (0: unlimited)")
+    parser.add_option("--peer-upload-limit", dest="peerUploadLimit", type="float", default=0,
+                      help="upload rate limit to each peer in MB/s (0: unlimited)")
+    parser.add_option("--peer-download-limit", dest="peerDownloadLimit", type="float", default=0,
+                      help="download rate limit from each peer in MB/s (0: unlimited)")
+    parser.add_option("--small-file", dest="smallFile", type="float", default=1,
+                      help="files up to this many MB are transferred ahead of bulk blocks when rate limited")
+    parser.add_option("--limits-file", dest="limitsFile", default=None,
+                      help="json file with the same limits (upload, download, peerUpload, peerDownload, smallFile), "
+                           "reloaded whenever it changes")
+    parser.add_option("--catalog-encoding", dest="catalogEncoding", default="json", choices=list(CatalogCodec.ENCODINGS),
+                      help="encoding of catalog replies from the tracker: json or bin (compact, decoded while receiving)")
+    parser.add_option("--metrics-port", dest="metricsPort", type="int", default=0,
+                      help="serve metrics on http://127.0.0.1:PORT/metrics (prometheus) and /stats (json); 0: off")
+    parser.add_option("--log-level", dest="logLevel", default="info", choices=list(Log.LEVELS),
+                      help="log level; per-block transfer logs are debug")
+    parser.add_option("--log-json", dest="logJson", action="store_true", default=False,
+                      help="write logs as one json object per line")
+    parser.add_option("--rolling", dest="rolling", action="store_true", default=False,
+                      help="also match blocks shifted by insertions with rsync-style rolling checksums (CPU heavy)")
     options, args = parser.parse_args()
     if len(args) < 1:
         parser.error("No ServerIP and ServerPort")
@@ -363,6 +1500,32 @@ if __name__ == '__main__':
         else:
             parser.error("Invalid ServerIP or ServerPort")
 
+    if not 1 <= options.bundleFiles <= FileSynchronizer.MAX_BUNDLE:
+        parser.error("--bundle-files must be between 1 and %d" % FileSynchronizer.MAX_BUNDLE)
+
+    Log.setup(options.logLevel, options.logJson)
+    if options.metricsPort:
+        MetricsServer(options.metricsPort).start()
     synchronizer_port = get_next_available_port(8000)       #找到一个空闲的端口
-    synchronizer_thread = FileSynchronizer(tracker_ip,tracker_port,synchronizer_port)
+    scheduler = DownloadScheduler(workers=options.workers, maxInFlight=options.maxInFlight,
+                                  maxPerPeer=options.maxPerPeer, bundleFiles=options.bundleFiles)
+    compress = [options.compress] if options.compress != "none" else None
+    limiter = RateLimiter(upload=ConversionUtils.megabytes2Bytes(options.uploadLimit),
+                          download=ConversionUtils.megabytes2Bytes(options.downloadLimit),
+                          peerUpload=ConversionUtils.megabytes2Bytes(options.peerUploadLimit),
+                          peerDownload=ConversionUtils.megabytes2Bytes(options.peerDownloadLimit),
+                          smallFile=ConversionUtils.megabytes2Bytes(options.smallFile))
+    if options.engine == "async":
+        synchronizer_thread = AsyncFileSynchronizer(tracker_ip,tracker_port,synchronizer_port,scheduler=scheduler,
+                                                    rolling=options.rolling,rescanInterval=options.rescanInterval,
+                                                    hashAlgo=options.hashAlgo,hashWorkers=options.hashWorkers,
+                                                    compress=compress,limiter=limiter,limitsFile=options.limitsFile,
+                                                    catalogEncoding=options.catalogEncoding)
+    else:
+        synchronizer_thread = FileSynchronizer(tracker_ip,tracker_port,synchronizer_port,scheduler=scheduler,
+                                               rolling=options.rolling,rescanInterval=options.rescanInterval,
+                                               hashAlgo=options.hashAlgo,hashWorkers=options.hashWorkers,
+                                               compress=compress,limiter=limiter,limitsFile=options.limitsFile,
+                                               catalogEncoding=options.catalogEncoding)
     synchronizer_thread.start()
+    synchronizer_thread.join()      #主线程退出会触发解释器关闭流程，线程池将无法再提交任务
@@ -3,7 +3,18 @@
 #usage           :python3 tracker.py trackerIP trackerPort
 #python_version  :3.5
 #==============================================================================
-import socket, sys, threading, json, time, optparse, os
+import socket, sys, threading, time, optparse, os
+import logging
+import multiprocessing
+from Utils.Catalog import Catalog
+from Utils.CatalogStore import CatalogStore
+from Utils.CatalogCodec import CatalogCodec
+from Utils.ShardRouter import ShardRouter
+from Utils.NetUtils import NetUtils
+from Utils.Metrics import REGISTRY, MetricsServer
+from Utils.Log import Log
+
+log = logging.getLogger('tracker')
 
 def validate_ip(s):
     a = s.split('.')
@@ -28,60 +39,77 @@ def validate_port(x):
 
 
 class Tracker(threading.Thread):
-    def __init__(self, port, host='0.0.0.0'):
+    def __init__(self, port, host='0.0.0.0', hashAlgo='md5', stateDir=None, snapshotInterval=300, grace=60,
+                 forwarded=False):
         threading.Thread.__init__(self)
         self.port = port #tracker port
         self.host = host #tracker IP address
-        self.BUFFER_SIZE = 8192
+        #作为分片运行在路由器后面时，连接来自路由器，peer的地址在消息的ip字段里
+        self.forwarded = forwarded
+        #整个网络使用的内容hash算法，目录中所有peer的hash必须用同一种算法才能互相比较
+        self.hashAlgo = hashAlgo
         self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM) #socket to accept tcp connections from peers
+        #重启后马上重新绑定同一个端口，不用等上一个进程的连接退出TIME_WAIT
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 
-         # 记录每个peer (ip, port, exp time)  using a dictionary
-         # (ip,port) as key          注意，这里存的port是peer server的端口，并不是tracker连接端口
-        self.users = {}
+        # 文件目录及其索引，见Utils/Catalog.py
+        # 按文件名直接查字典；peer -> 文件 的反向索引；按心跳时间排序的peer表用于过期检查
+        # (ip,port)中的port是peer server的端口，并不是tracker连接端口
+        # stateDir不为空时目录持久化到这个目录(快照+日志，见Utils/CatalogStore.py)，重启后直接恢复，
+        # 恢复的peer在ttl之外再宽限grace秒
+        # 恢复在后台进行，tracker马上开始监听；恢复完成之前收到的宣告先等着，不会回复不完整的目录
+        self.store = CatalogStore(stateDir, snapshotInterval) if stateDir else None
+        self.catalog = Catalog(ttl=180, store=self.store)
+        self.ready = threading.Event()
+        if self.store is not None:
+            threading.Thread(target=self.restore, args=(grace,)).start()
+        else:
+            self.ready.set()
 
-        # 只有文件的最新时间被记录
-        # {'ip':,'port':,'mtime':,'md5':,'blockNum':}
-        # 字典嵌套  key=filename，value=文件信息字典
-        self.files = {}
+        #指标，见Utils/Metrics.py
+        self.requests = REGISTRY.counter('tracker_requests_total', 'announces handled')
+        self.resyncs = REGISTRY.counter('tracker_resyncs_total', 'announces answered with a resync')
+        self.requestSeconds = REGISTRY.histogram('tracker_request_seconds', 'time to handle one announce')
+        self.connections = REGISTRY.gauge('tracker_connections', 'open peer connections')
+        self.expired = REGISTRY.counter('tracker_expired_peers_total', 'peers dropped after missing heartbeats')
+        self.expireSeconds = REGISTRY.histogram('tracker_expire_seconds', 'time of one expiry check')
+        REGISTRY.gauge('tracker_peers', 'live peers', fn=lambda: len(self.catalog.users))
+        REGISTRY.gauge('tracker_files', 'files in the catalog', fn=lambda: len(self.catalog.files))
+        REGISTRY.gauge('tracker_catalog_version', 'catalog version', fn=lambda: self.catalog.version)
 
-        self.userLock = threading.Lock()
-        self.fileLock = threading.Lock()
         try:
             #Bind to address and port
             self.server.bind((self.host, self.port))
         except socket.error:
-            print(('Bind failed %s' % (socket.error)))
+            log.error('Bind failed %s', socket.error)
             sys.exit()
 
         #listen for connections
         self.server.listen(6)
 
+    def restore(self, grace):
+        try:
+            self.store.restore(self.catalog, grace)
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            #恢复失败时不再持久化，退回到只在内存中的目录，等peer重新全量宣告
+            log.exception('catalog restore failed, running without persistence: %s', e)
+            self.catalog = Catalog(ttl=180)
+            self.store = None
+        self.ready.set()
+
     def check_user(self):
-        deleteUser = []
-        deleteFile = []
-        self.userLock.acquire()
-        for user, TTL in self.users.items():        #遍历user字典
-            if time.perf_counter() - TTL > 180: 
-                self.fileLock.acquire()
-                for file, info in self.files.items():
-                    if info['ip']==user[0] and info['port'] == user[1]:
-                        deleteFile.append(file)               
-                self.fileLock.release()
-            
-                deleteUser.append(user)
-        self.userLock.release()    
-
-        if deleteUser:
-            self.userLock.acquire()
-            for user in deleteUser:
-                del self.users[user]
-            self.userLock.release()
-        
-        if deleteFile:
-            self.fileLock.acquire()
-            for file in deleteFile:
-                del self.files[file]
-            self.fileLock.release()
+        self.ready.wait()
+        #只处理已过期的peer，代价和过期peer的文件数成正比
+        with self.expireSeconds.time():
+            users = self.catalog.expire()
+        for user in users:
+            self.expired.inc()
+            log.info('peer %s:%s expired', user[0], user[1])
+        if self.store is not None and self.store.snapshotDue():
+            try:
+                self.store.snapshot(self.catalog)
+            except OSError as e:
+                log.error('catalog snapshot failed: %s', e)
 
         #间隔20s检查
         t = threading.Timer(20, self.check_user)
@@ -95,76 +123,221 @@ class Tracker(threading.Thread):
         t = threading.Timer(20, self.check_user)        #这里设置间隔20s
         t.start()
 
-        print(('Waiting for connections on port %s' % (self.port)))
+        log.info('Waiting for connections on port %s', self.port)
         while True:             #这里tracker类已经在子线程上了。 死循环，去监听
             conn, addr = self.server.accept()
             #收到请求，就开线程去处理
             threading.Thread(target=self.process_messages, args=(conn, addr)).start()
 
 
+    #peer与tracker保持长连接，每5s发一条带长度前缀的心跳/宣告消息
     def process_messages(self, conn, addr):
         conn.settimeout(180.0)
-        print(('Client connected with ' + addr[0] + ':' + str(addr[1])))
+        log.info('Client connected with %s:%s', addr[0], addr[1])
+        self.connections.inc()
+        self.ready.wait()
         try:
-            #receiving data from a peer
-            data = ''
-            while True:             
-                part = conn.recv(self.BUFFER_SIZE).decode()     #将utf-8编码转成当前程序使用的编码，默认也是unicode
-                data = data + part                              #把conn当成一个IO流，可以一直读取   实际上就是内核态io buffer
-                if len(part) < self.BUFFER_SIZE:
+            while True:
+                #receiving data from a peer  将json解析成python对象，这里为字典
+                data_dic = NetUtils.recvMsg(conn)
+                if data_dic is None:
                     break
+                if not isinstance(data_dic, dict):
+                    raise ValueError('message is not a JSON object')
+                start = time.monotonic()
+                #peer可以要求二进制编码的目录，见Utils/CatalogCodec.py
+                encoding = data_dic.get('catalogEncoding', 'json')
+                if encoding not in CatalogCodec.ENCODINGS:
+                    encoding = 'json'
+                response, files = self.handle_announce(data_dic, addr, encoding)
+                self.requestSeconds.observe(time.monotonic() - start)
+                self.requests.inc()
+                if files is None:
+                    self.resyncs.inc()
+                    NetUtils.sendMsg(conn, response)
+                else:
+                    CatalogCodec.sendReply(conn, response, files, encoding)
 
-            try:
-                #将json解析成python对象，这里为字典
-                data_dic = json.loads(data)     
-            except json.decoder.JSONDecodeError:
-                print('Incorrect format (JSON required)')
-       
-            # Keepalive
-            self.userLock.acquire()
-            self.users[(addr[0], data_dic['port'])] = time.perf_counter()         #心跳时间都是tracker上的时间，只要文件时间戳是peer发过来的时间
-            self.userLock.release() 
-
-            # Check if new file
-            for peerFile in data_dic['files']:
-                newFile = True
-                oldFile = ''
-                for file in self.files:             #遍历字典的key,即文件名
-                    if file == peerFile['name']:
-                        newFile = False
-                        oldFile = file
-                        break
-
-                #记录新文件
-                if newFile:
-                    self.fileLock.acquire()
-                    self.files[peerFile['name']] = {'ip' : addr[0], 
-                                                    'mtime' : peerFile['mtime'], 
-                                                    'port' : data_dic['port'], 
-                                                    'md5': peerFile['md5'],
-                                                    'blockNum': peerFile['blockNum']}
-                    self.fileLock.release()
-                #更新旧文件信息
-                elif self.files[oldFile]['mtime'] > peerFile['mtime']:      #如果这是同名的更新的文件
-                    self.fileLock.acquire()
-                    self.files[oldFile]['ip'] = addr[0]
-                    self.files[oldFile]['mtime'] = peerFile['mtime']
-                    self.files[oldFile]['port'] = data_dic['port']
-                    self.files[oldFile]['md5'] = peerFile['md5']
-                    self.files[oldFile]['blockNum'] = peerFile['blockNum']
-                    self.fileLock.release()
-
-            # Send directory response message
-            conn.send(bytes(json.dumps(self.files), 'utf-8'))         
-            
         except socket.timeout as e:     
             #tcp连接超时，关闭socket连接，并结束线程
-            print("connection timeout!")
+            log.info("connection timeout!")
+        except (socket.error, ConnectionError) as e:
+            log.warning('Socket error: %s', e)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            #格式不对的消息(不是对象、字段类型不对)直接断开这个peer
+            log.warning('Incorrect format (JSON required): %s', e)
+        finally:
+            self.connections.dec()
+            conn.close() # Close
+
+    #处理一条宣告消息，返回回复给peer的目录变化: (回复中目录之外的部分, 按encoding编码好的目录)
+    #需要peer重新全量宣告时目录部分是None
+    def handle_announce(self, data_dic, addr, encoding='json'):
+        # Keepalive   心跳时间都是tracker上的时间，只要文件时间戳是peer发过来的时间
+        ip = data_dic.get('ip', addr[0]) if self.forwarded else addr[0]
+        port = data_dic['port']
+        if not isinstance(ip, str) or not isinstance(port, int) or not 0 < port < 65536:
+            raise ValueError('bad peer address %r:%r' % (ip, port))
+        user = (ip, port)
+        full = data_dic.get('full', False)
+        if data_dic.get('hash', 'md5') != self.hashAlgo:
+            #peer用的hash算法不对，宣告不能进入目录，告诉它换成tracker的算法后重新全量宣告
+            return {'resync': True, 'hash': self.hashAlgo}, None
+        if not full and not self.catalog.isKnown(user):
+            #不认识的peer(比如tracker重启过或者它已经过期)发来的增量无法应用，让它重新全量宣告
+            log.info('unknown peer %s:%s, asking for a full announce', user[0], user[1])
+            return {'resync': True, 'hash': self.hashAlgo}, None
+        self.catalog.keepalive(user)
+
+        # 记录新增/更新/删除的文件，按文件名查字典
+        seq = self.catalog.announce(user, data_dic.get('files', []), data_dic.get('removed', []), full)
+        if self.store is not None:
+            #宣告落盘之后再回复，peer收到回复就认为tracker已经记下了这些变化
+            self.store.wait(seq)
+
+        # Send directory response message  只回复该peer上次看到的版本之后的变化
+        # 编码好的目录按版本缓存，目录没有变化时不再重复序列化
+        full, version, files, removed = self.catalog.encodedSince(data_dic.get('version'), encoding)
+        #you是tracker看到的该peer的地址，peer用它从来源列表中去掉自己
+        return {'version': version, 'full': full, 'removed': removed, 'you': list(user),
+                'hash': self.hashAlgo}, files
+
+
+class TrackerRouter(threading.Thread):
+    '''
+    分片tracker的前端: peer照常连到这里，宣告按文件名拆开转发给各个分片tracker，合并回复后返回，见Utils/ShardRouter.py
+    路由器不保存目录，多个路由器进程可以用SO_REUSEPORT监听同一个端口，由内核分配peer连接
+    '''
+    def __init__(self, port, host, shards, reusePort=False):
+        threading.Thread.__init__(self)
+        self.port = port
+        self.host = host
+        self.router = ShardRouter(shards)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reusePort:
+            self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        #和Tracker用同样的指标名，从外面看路由器就是tracker
+        self.requests = REGISTRY.counter('tracker_requests_total', 'announces handled')
+        self.resyncs = REGISTRY.counter('tracker_resyncs_total', 'announces answered with a resync')
+        self.requestSeconds = REGISTRY.histogram('tracker_request_seconds', 'time to handle one announce')
+        self.connections = REGISTRY.gauge('tracker_connections', 'open peer connections')
+        self.shardErrors = REGISTRY.counter('tracker_shard_errors_total', 'announces that failed on a shard connection')
+        REGISTRY.gauge('tracker_shards', 'catalog shards behind this router', fn=lambda: len(self.router.shards))
+        try:
+            self.server.bind((self.host, self.port))
+        except socket.error as e:
+            log.error('Bind failed %s', e)
+            sys.exit()
+        self.server.listen(64)
+
+    def run(self):
+        log.info('Routing connections on port %s to %d shards', self.port, len(self.router.shards))
+        while True:
+            conn, addr = self.server.accept()
+            threading.Thread(target=self.process_messages, args=(conn, addr)).start()
+
+    def process_messages(self, conn, addr):
+        conn.settimeout(180.0)
+        self.connections.inc()
+        try:
+            while True:
+                data_dic = NetUtils.recvMsg(conn)
+                if data_dic is None:
+                    break
+                if not isinstance(data_dic, dict):
+                    raise ValueError('message is not a JSON object')
+                start = time.monotonic()
+                try:
+                    response = self.router.route(data_dic, addr[0])
+                except (socket.error, ConnectionError, ValueError) as e:
+                    #分片不可用时断开peer，peer下次心跳重新连接并全量宣告
+                    self.shardErrors.inc()
+                    log.warning('shard error: %s', e)
+                    break
+                self.requestSeconds.observe(time.monotonic() - start)
+                self.requests.inc()
+                if response.get('resync'):
+                    self.resyncs.inc()
+                    NetUtils.sendMsg(conn, response)
+                elif data_dic.get('catalogEncoding') == 'bin':
+                    files = response.pop('files')
+                    CatalogCodec.sendReply(conn, response, CatalogCodec.encodeFiles(files, 'bin'), 'bin')
+                else:
+                    NetUtils.sendMsg(conn, response)
+        except socket.timeout:
+            log.info("connection timeout!")
+        except (socket.error, ConnectionError) as e:
+            log.warning('Socket error: %s', e)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            log.warning('Incorrect format (JSON required): %s', e)
+        finally:
+            self.connections.dec()
+            conn.close()
+
+
+#解析 host:port,host:port,...
+def parse_shards(text):
+    shards = []
+    for item in text.split(','):
+        host, _, port = item.strip().rpartition(':')
+        if not validate_ip(host) or not validate_port(port):
+            raise ValueError('invalid shard address: %r' % item)
+        shards.append((host, int(port)))
+    return shards
+
+
+#子进程在主进程退出(包括被kill)之后也退出，不留下占着端口的分片
+def exit_with_parent():
+    parent = os.getppid()
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1)
+        os._exit(0)
+    threading.Thread(target=watch, daemon=True).start()
+
+
+#在子进程中运行一个分片tracker，只监听127.0.0.1
+def run_shard(port, hashAlgo, stateDir, snapshotInterval, grace, metricsPort):
+    exit_with_parent()
+    if metricsPort:
+        MetricsServer(metricsPort).start()
+    shard = Tracker(port, '127.0.0.1', hashAlgo, stateDir, snapshotInterval, grace, forwarded=True)
+    shard.run()
+
+
+#在子进程中运行一个路由器，和主进程共用监听端口
+def run_router(port, host, shards):
+    exit_with_parent()
+    TrackerRouter(port, host, shards, reusePort=True).run()
 
-        conn.close() # Close
 
 if __name__ == '__main__':
-    parser = optparse.OptionParser(usage="%prog ServerIP ServerPort")
+    parser = optparse.OptionParser(usage="%prog [options] ServerIP ServerPort")
+    parser.add_option("--hash", dest="hashAlgo", default="md5", choices=["md5", "blake2b"],
+                      help="content hash algorithm used by all peers: md5 (compatible) or blake2b (faster)")
+    parser.add_option("--state-dir", dest="stateDir", default=None,
+                      help="persist the catalog here (snapshot + write-ahead log) and restore it on restart")
+    parser.add_option("--snapshot-interval", dest="snapshotInterval", type="int", default=300,
+                      help="seconds between catalog snapshots when --state-dir is set")
+    parser.add_option("--grace", dest="grace", type="int", default=60,
+                      help="extra seconds restored peers get to reconnect before they expire")
+    parser.add_option("--shards", dest="shards", type="int", default=0,
+                      help="split the catalog by file name over this many tracker processes on ports "
+                           "ServerPort+1..ServerPort+N of 127.0.0.1, and route peers to them; 0: one process")
+    parser.add_option("--routers", dest="routers", type="int", default=1,
+                      help="router processes sharing ServerPort (SO_REUSEPORT) with --shards or --route")
+    parser.add_option("--route", dest="route", default=None,
+                      help="only route peers to these shard trackers (host:port,host:port,...), e.g. on other hosts; "
+                           "all routers must list them in the same order")
+    parser.add_option("--forwarded", dest="forwarded", action="store_true", default=False,
+                      help="run as a shard behind a router: trust the peer address the router forwards")
+    parser.add_option("--metrics-port", dest="metricsPort", type="int", default=0,
+                      help="serve metrics on http://127.0.0.1:PORT/metrics (prometheus) and /stats (json); 0: off")
+    parser.add_option("--log-level", dest="logLevel", default="info", choices=list(Log.LEVELS),
+                      help="log level")
+    parser.add_option("--log-json", dest="logJson", action="store_true", default=False,
+                      help="write logs as one json object per line")
     options, args = parser.parse_args()
     if len(args) < 1:
         parser.error("No ServerIP and ServerPort")
@@ -176,5 +349,32 @@ if __name__ == '__main__':
             server_port = int(args[1])
         else:
             parser.error("Invalid ServerIP or ServerPort")
-    tracker = Tracker(server_port,server_ip)
-    tracker.start()
+    Log.setup(options.logLevel, options.logJson)
+    shards = None
+    if options.route:
+        try:
+            shards = parse_shards(options.route)
+        except ValueError as e:
+            parser.error(str(e))
+    elif options.shards > 0:
+        #子进程在启动任何线程之前fork出来。每个分片有自己的状态目录和指标端口
+        shards = [('127.0.0.1', server_port + 1 + i) for i in range(options.shards)]
+        for i, shard in enumerate(shards):
+            stateDir = os.path.join(options.stateDir, 'shard-%d' % i) if options.stateDir else None
+            metricsPort = options.metricsPort + 1 + i if options.metricsPort else 0
+            multiprocessing.Process(target=run_shard, daemon=True,
+                                    args=(shard[1], options.hashAlgo, stateDir, options.snapshotInterval,
+                                          options.grace, metricsPort)).start()
+    if shards is not None:
+        for i in range(options.routers - 1):
+            multiprocessing.Process(target=run_router, args=(server_port, server_ip, shards), daemon=True).start()
+        if options.metricsPort:
+            MetricsServer(options.metricsPort).start()
+        router = TrackerRouter(server_port, server_ip, shards, reusePort=options.routers > 1)
+        router.start()
+    else:
+        if options.metricsPort:
+            MetricsServer(options.metricsPort).start()
+        tracker = Tracker(server_port,server_ip,options.hashAlgo,options.stateDir,options.snapshotInterval,
+                          options.grace,options.forwarded)
+        tracker.start()